@@ -0,0 +1,98 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import REGISTRY
+
+
+read_seconds = REGISTRY.histogram('sensor_read_seconds', 'Sensor read duration', ['sensor'])
+read_errors = REGISTRY.counter('sensor_read_errors_total', 'Failed sensor reads', ['sensor'])
+
+
+class SensorAcquisition:
+    """
+    Read independent sensors concurrently.
+
+    Acquisition takes as long as the slowest sensor instead of
+    the sum of all of them.
+    Each DS18B20 device is read once per snapshot, even if it is
+    used by several consumers. Access to a shared I2C bus is
+    serialized by the bus lock (see adc.I2CBus).
+    """
+
+    def __init__(self, ph, supply_tank, solution_tank, temperature=None):
+        self.ph = ph
+        self.supply_tank = supply_tank
+        self.solution_tank = solution_tank
+        self.temperature = temperature
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='acquisition')
+
+    @staticmethod
+    def _timed(sensor, func):
+        start = time.perf_counter()
+        try:
+            return func()
+        except Exception:
+            read_errors.labels(sensor).inc()
+            raise
+        finally:
+            read_seconds.labels(sensor).observe(time.perf_counter() - start)
+
+    @staticmethod
+    def _temperature_key(sensor):
+        # Constant temperature interfaces have no device
+        return getattr(sensor, 'device_id', id(sensor))
+
+    def read(self):
+        """
+        Take a snapshot of all sensors.
+
+        A sensor error is raised when its value is accessed,
+        so callers can check sensors in order.
+        """
+
+        submit = self.executor.submit
+        start = time.monotonic()
+
+        temperatures = {}
+        for sensor in (self.ph.temperature, self.temperature):
+            if sensor is not None:
+                key = self._temperature_key(sensor)
+                if key not in temperatures:
+                    name = 'temperature_' + getattr(sensor, 'device_id', 'const')
+                    temperatures[key] = submit(self._timed, name, sensor.get_temperature)
+
+        futures = {
+            'solution_tank_is_full': submit(self._timed, 'float_switch', self.solution_tank.is_full),
+            'ph_voltage': submit(self._timed, 'ph_voltage', self.ph.get_voltage),
+            'supply_tank_volume': submit(self._timed, 'supply_tank', self.supply_tank.get_volume),
+            'ph_temperature': temperatures[self._temperature_key(self.ph.temperature)]
+        }
+        if self.temperature is not None:
+            futures['temperature'] = temperatures[self._temperature_key(self.temperature)]
+
+        # Wait for all reads to complete, so the snapshot is consistent
+        for f in futures.values():
+            f.exception()
+
+        return Snapshot(self.ph, futures, time.monotonic() - start)
+
+
+class Snapshot:
+    """
+    Sensor values obtained by SensorAcquisition.
+    """
+
+    def __init__(self, ph, futures, duration):
+        self.ph = ph
+        self.futures = futures
+        self.duration = duration
+
+    def __contains__(self, name):
+        return name in self.futures
+
+    def __getitem__(self, name):
+        return self.futures[name].result()
+
+    def get_t_v_ph(self):
+        temperature = self['ph_temperature']
+        voltage = self['ph_voltage']
+        return temperature, voltage, self.ph.compute_ph(temperature, voltage)
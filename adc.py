@@ -1,19 +1,85 @@
-import smbus
-from utils import delay
-from statistics import mean, pstdev
+import os
+import time
+import threading
+import numpy as np
+from fcntl import ioctl
+from timer import PrecisionTimer
+from metrics import REGISTRY
+
+
+class I2CBus:
+    """
+    I2C bus access.
+
+    SMBus block transfers are used for register access.
+    Raw reads of the i2c-dev character device are issued as a single
+    I2C read transaction, letting devices stream data back-to-back.
+
+    Devices on the same bus share a lock, so transfers issued from
+    different threads do not interleave.
+    """
+
+    # Bus number to lock
+    locks = {}
+    locks_guard = threading.Lock()
+
+    # ioctl request to select a slave address (see linux/i2c-dev.h)
+    I2C_SLAVE = 0x0703
+
+    # Largest read accepted by i2c-dev at once
+    max_read_size = 8192
+
+    def __init__(self, busn):
+        import smbus
+        with self.locks_guard:
+            self.lock = self.locks.setdefault(busn, threading.Lock())
+        self.smbus = smbus.SMBus(busn)
+        self.fd = os.open('/dev/i2c-%d' % busn, os.O_RDWR)
+
+    def __del__(self):
+        if hasattr(self, 'fd'):
+            os.close(self.fd)
+
+    def read_i2c_block_data(self, addr, cmd, count):
+        with self.lock:
+            return self.smbus.read_i2c_block_data(addr, cmd, count)
+
+    def write_i2c_block_data(self, addr, cmd, values):
+        with self.lock:
+            self.smbus.write_i2c_block_data(addr, cmd, values)
+
+    def read_bytes(self, addr, count):
+        with self.lock:
+            ioctl(self.fd, self.I2C_SLAVE, addr)
+            data = os.read(self.fd, count)
+        if len(data) != count:
+            raise Exception('Short I2C read: %d of %d bytes' % (len(data), count))
+        return data
 
 
 class MCP3221:
     """
     MCP3221 ADC interface.
+
+    The chip keeps converting while the master reads,
+    so get_values() fetches many samples in a few long transactions.
+
+    At 100 kHz a transaction is much shorter than a mains period, so
+    averaging would not reject mains hum. If `sampling_time` is given
+    (an integer number of mains periods), samples are read in `bursts`
+    evenly spread over it, which cancels the mains frequency.
     """
 
     adc_bits = 12
 
-    def __init__(self, i2c_busn, i2c_addr, v_ref):
+    bursts = 16
+
+    def __init__(self, i2c_busn, i2c_addr, v_ref, i2c=None, sampling_time=None):
         self.i2c_addr = i2c_addr
         self.v_ref = v_ref
-        self.i2c = smbus.SMBus(i2c_busn)
+        self.i2c = i2c if i2c is not None else I2CBus(i2c_busn)
+        self.sampling_time_s = sampling_time.m_as('s') if sampling_time is not None else None
+        self.timer = PrecisionTimer()
 
     def value_to_voltage(self, value):
         return float(value) / (1 << self.adc_bits) * self.v_ref
@@ -22,6 +88,31 @@ class MCP3221:
         reading = self.i2c.read_i2c_block_data(self.i2c_addr, 0x00, 2)
         return (reading[0] << 8) + reading[1]
 
+    def get_values(self, count, out=None):
+        """Read `count` consecutive samples into `out` (a new array by default)."""
+
+        if out is None:
+            out = np.empty(count, dtype=np.uint16)
+
+        chunk = self.i2c.max_read_size // 2
+        if self.sampling_time_s is None:
+            deadlines = None
+        else:
+            chunk = min(chunk, -(-count // self.bursts))
+            if self.timer.spin_margin is None:
+                # Calibration would delay the first bursts
+                self.timer.calibrate()
+            deadlines = self.timer.now() + np.arange(0, count, chunk) * (self.sampling_time_s / count)
+
+        for i, start in enumerate(range(0, count, chunk)):
+            n = min(chunk, count - start)
+            if deadlines is not None:
+                self.timer.wait_until(deadlines[i])
+            data = self.i2c.read_bytes(self.i2c_addr, 2 * n)
+            out[start:start + n] = np.frombuffer(data, dtype='>u2')
+
+        return out
+
     def get_voltage(self):
         value = self.get_value()
         return self.value_to_voltage(value)
@@ -30,6 +121,12 @@ class MCP3221:
 class ADS1115:
     """
     ADS1115 ADC interface.
+
+    The converter runs in continuous mode.
+    If the ALERT/RDY pin is connected to `gpio_rdy`, the comparator is
+    configured to pulse it after each conversion, and reads are paced by
+    that pulse. Otherwise reads are paced by a worst case conversion time.
+    Waiting is done by a precision timer, CPU is mostly idle.
     """
 
     adc_bits = 16
@@ -66,21 +163,31 @@ class ADS1115:
 
     # Comparator
     cfg_comp_disabled = 0b11 << 0
+    cfg_comp_assert_after_one = 0b00 << 0
 
     # Register address
     reg_conversion = 0
     reg_config = 1
+    reg_lo_thresh = 2
+    reg_hi_thresh = 3
 
-    def __init__(self, i2c_busn, i2c_addr):
+    # Thresholds that turn ALERT/RDY into a conversion ready signal
+    rdy_lo_thresh = [0x00, 0x00]
+    rdy_hi_thresh = [0x80, 0x00]
+
+    def __init__(self, i2c_busn, i2c_addr, i2c=None):
         self.i2c_addr = i2c_addr
-        self.i2c = smbus.SMBus(i2c_busn)
+        self.i2c = i2c if i2c is not None else I2CBus(i2c_busn)
         self.conversion_time = 0
         self.v_lsb = None
+        self.gpio_rdy = None
+        self.timer = PrecisionTimer()
+        self.next_sample_time = 0
 
     def value_to_voltage(self, value):
         return value * self.v_lsb
 
-    def config(self, channel, fsr, sps):
+    def config(self, channel, fsr, sps, gpio_rdy=None):
         prev_conversion_time = self.conversion_time
 
         # Data rate variation is +/- 10%
@@ -88,23 +195,86 @@ class ADS1115:
 
         self.v_lsb = fsr * 2 / (1 << self.adc_bits)
 
-        cfg = self.cfg_comp_disabled
-        cfg |= self.cfg_channel[channel]
+        cfg = self.cfg_channel[channel]
         cfg |= self.cfg_fsr_mV[fsr.m_as('mV')]
         cfg |= self.cfg_sps[sps]
+
+        if gpio_rdy is None:
+            cfg |= self.cfg_comp_disabled
+        else:
+            import RPi.GPIO as GPIO
+            GPIO.setmode(GPIO.BCM)
+            # ALERT/RDY is an open drain output
+            GPIO.setup(gpio_rdy, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            self.i2c.write_i2c_block_data(self.i2c_addr, self.reg_lo_thresh, self.rdy_lo_thresh)
+            self.i2c.write_i2c_block_data(self.i2c_addr, self.reg_hi_thresh, self.rdy_hi_thresh)
+            cfg |= self.cfg_comp_assert_after_one
+
         cfg_bytes = list(cfg.to_bytes(2, 'big'))
 
         self.i2c.write_i2c_block_data(self.i2c_addr, self.reg_config, cfg_bytes)
+        self.gpio_rdy = gpio_rdy
 
         # Wait for the previous conversion to finish
-        delay(prev_conversion_time)
+        self.timer.delay(prev_conversion_time)
+
+        self.next_sample_time = self.timer.now() + self.conversion_time
+
+    def _wait_for_sample(self):
+        if self.gpio_rdy is not None:
+            import RPi.GPIO as GPIO
+            timeout_ms = int(1000 * 2 * self.conversion_time) + 1
+            if GPIO.wait_for_edge(self.gpio_rdy, GPIO.FALLING, timeout=timeout_ms) is None:
+                raise Exception('ADS1115 conversion ready timeout')
+            return
+
+        # Keep an absolute schedule to avoid accumulating delays
+        now = self.timer.now()
+        if now < self.next_sample_time:
+            self.timer.wait_until(self.next_sample_time)
+            self.next_sample_time += self.conversion_time
+        else:
+            self.next_sample_time = now + self.conversion_time
+
+    def _read_value(self):
+        reading = self.i2c.read_i2c_block_data(self.i2c_addr, self.reg_conversion, 2)
+        return (reading[0] << 8) + reading[1]
 
     def get_value(self):
         # Wait until next sample is available
-        delay(self.conversion_time)
+        self._wait_for_sample()
+        return self._read_value()
 
-        reading = self.i2c.read_i2c_block_data(self.i2c_addr, self.reg_conversion, 2)
-        return (reading[0] << 8) + reading[1]
+    def stream(self, count=None):
+        """
+        Generate (timestamp, value) pairs of consecutive conversions.
+
+        Timestamps are time.monotonic() values taken when a sample is ready.
+        The generator is endless unless `count` is set.
+        """
+
+        n = 0
+        while count is None or n < count:
+            self._wait_for_sample()
+            timestamp = time.monotonic()
+            yield timestamp, self._read_value()
+            n += 1
+
+    def get_values(self, count, out=None, timestamps=None):
+        """
+        Read `count` consecutive samples into `out` (a new array by default).
+        Sample timestamps are stored into `timestamps` array if it is provided.
+        """
+
+        if out is None:
+            out = np.empty(count, dtype=np.uint16)
+
+        for n, (timestamp, value) in enumerate(self.stream(count)):
+            out[n] = value
+            if timestamps is not None:
+                timestamps[n] = timestamp
+
+        return out
 
     def get_voltage(self):
         value = self.get_value()
@@ -114,19 +284,83 @@ class ADS1115:
 class ADCFilter:
     """
     ADC noise filtering.
+
+    Samples are collected into a preallocated array and reduced
+    with one of the following estimators:
+    - mean: mean and standard deviation of all samples
+    - median: median and standard deviation derived from the median absolute deviation
+    - trimmed_mean: mean of samples left after dropping `trim` fraction
+      of the lowest and the highest ones, and standard deviation derived
+      from the winsorized one (dropped samples clipped to the kept range)
+
+    Median and trimmed mean reject spikes (e.g. produced by pump EMI).
     """
 
-    def __init__(self, adc, samples_count):
+    estimators = ('mean', 'median', 'trimmed_mean')
+
+    # Ratio of standard deviation to median absolute deviation for normal distribution
+    mad_to_std = 1.4826
+
+    @staticmethod
+    def _winsorized_to_std(trim):
+        """Ratio of standard deviation to winsorized one for normal distribution."""
+
+        from statistics import NormalDist
+        if trim == 0:
+            return 1.0
+        normal = NormalDist()
+        z = normal.inv_cdf(1 - trim)
+        variance = 1 - 2 * trim - 2 * z * normal.pdf(z) + 2 * trim * z * z
+        return 1 / np.sqrt(variance)
+
+    def __init__(self, adc, samples_count, estimator='mean', trim=0.1):
+        if estimator not in self.estimators:
+            raise Exception('Unknown estimator "%s"' % estimator)
+        if not 0 <= trim < 0.5:
+            raise Exception('Trim fraction must be within [0, 0.5)')
+
         self.adc = adc
         self.samples_count = samples_count
-
-    def get_voltage(self):
-        samples = []
+        self.estimator = estimator
+        self.trim = trim
+        self.winsorized_to_std = self._winsorized_to_std(trim)
+        self.samples = np.empty(samples_count, dtype=np.float64)
+        self.read_seconds = REGISTRY.histogram(
+            'adc_read_seconds', 'Filtered ADC read duration', ['adc']).labels(type(adc).__name__)
+
+    def _read_samples(self):
+        samples = self.samples
+        if hasattr(self.adc, 'get_values'):
+            return self.adc.get_values(self.samples_count, out=samples)
+
+        get_value = self.adc.get_value
         for n in range(0, self.samples_count):
-            samples.append(self.adc.get_value())
+            samples[n] = get_value()
+        return samples
+
+    def estimate(self, samples):
+        """Return (value, deviation) of samples in ADC units."""
+
+        if self.estimator == 'median':
+            value = np.median(samples)
+            value_dev = self.mad_to_std * np.median(np.abs(samples - value))
+        elif self.estimator == 'trimmed_mean':
+            cut = int(len(samples) * self.trim)
+            kept = np.sort(samples)[cut:len(samples) - cut]
+            value = kept.mean()
+            # Deviation of the kept samples alone is biased low (~0.66 for 10% trim)
+            winsorized = np.clip(samples, kept[0], kept[-1])
+            value_dev = self.winsorized_to_std * winsorized.std()
+        else:
+            value = samples.mean()
+            value_dev = samples.std()
+
+        return float(value), float(value_dev)
 
-        value = mean(samples)
-        value_dev = pstdev(samples)
+    def get_voltage(self):
+        start = time.perf_counter()
+        value, value_dev = self.estimate(self._read_samples())
+        self.read_seconds.observe(time.perf_counter() - start)
 
         voltage = self.adc.value_to_voltage(value)
         voltage_dev = self.adc.value_to_voltage(value_dev)
@@ -1,58 +1,552 @@
 import time
-from math import sin, pi
+import socket
+import struct
+import threading
+import socketserver
 from xmlrpc.server import SimpleXMLRPCServer
 import xmlrpc.client
+import numpy as np
+from timer import PrecisionTimer, realtime
+
+# Binary stream protocol.
+# Request: command, flags, sampling frequency (Hz, ignored by burst and since),
+# samples count (maximal for since), sequence number (since only).
+# Response: header followed by `length` bytes of payload.
+# On success payload holds raw counts as big-endian int16, which are
+# converted to volts by multiplying by `scale` (V per count).
+# With STREAM_TIMES flag, counts are followed by times of samples
+# relative to the first one, in seconds as big-endian float32.
+# Timestamp is the wall time of the first sample, frequency is the
+# actual sampling frequency, sequence is the number of the first sample
+# in the continuous acquisition (0 otherwise). Jitter is the maximal and
+# RMS deviation of sample times from a uniform grid (see sampling_jitter).
+# On error payload holds the message.
+STREAM_REQUEST = struct.Struct('!BBdIQ')
+STREAM_HEADER = struct.Struct('!IBdddQdd')
+STREAM_SAMPLES = 1
+STREAM_BURST = 2
+STREAM_SINCE = 3
+STREAM_TIMES = 1
+STREAM_OK = 0
+STREAM_ERROR = 1
+STREAM_DTYPE = '>i2'
+STREAM_TIMES_DTYPE = '>f4'
+
+
+def sampling_jitter(times, sampling_frequency_Hz):
+    """
+    Deviation of sample times from the best fitting uniform grid,
+    returned as maximal and RMS values in seconds.
+    """
+
+    if len(times) == 0:
+        return 0.0, 0.0
+    deviation = times - times[0] - np.arange(len(times)) / sampling_frequency_Hz
+    deviation -= deviation.mean()
+    return float(np.abs(deviation).max()), float(np.sqrt(np.mean(deviation * deviation)))
+
+
+def resample(times, samples, sampling_frequency_Hz):
+    """
+    Linearly interpolate samples taken at `times` (relative to the first
+    sample) onto the best fitting uniform grid of the same length.
+    """
+
+    grid = np.arange(len(samples)) / sampling_frequency_Hz
+    grid += np.mean(times - grid)
+    return np.interp(grid, times, samples)
 
 
 class ADCServer:
-    def __init__(self, adc, host='0.0.0.0', port=8000):
+    """
+    Serve ADC samples over XML-RPC on `port`, and over the binary
+    stream protocol on `stream_port` (None to disable).
+    Each client connection is served by its own thread.
+
+    If `sampling_frequency_Hz` is set, a dedicated thread samples the ADC
+    continuously into a ring buffer holding `buffer_duration` seconds.
+    Requests are then served from the buffer without extra bus traffic:
+    a window of the latest samples (decimated if a lower integer fraction
+    of the sampling frequency is requested), or the samples following a
+    sequence number. Otherwise each request samples the ADC, one request
+    at a time.
+
+    Continuous sampling keeps a core busy (the timer spins through most
+    of a 1 ms period), so it pauses after `idle_timeout` seconds without
+    requests, and resumes on the next one. A failing ADC read is logged
+    and retried every `error_delay` seconds, requests report the error
+    meanwhile.
+
+    Sampling is timed by PrecisionTimer. Times of samples are recorded,
+    each capture reports its jitter, and may carry the times to allow
+    resampling. If `realtime_cpu` is set, sampling runs with real time
+    priority pinned to that core (see timer.realtime).
+    """
+
+    stream_port = 8001
+
+    # Lag behind schedule at which a capture is aborted, in seconds
+    max_lag = 0.01
+
+    idle_timeout = 10
+    error_delay = 0.1
+
+    def __init__(self, adc, host='0.0.0.0', port=8000, stream_port=stream_port,
+                 sampling_frequency_Hz=None, buffer_duration=10, realtime_cpu=None):
         self.adc = adc
+        self.capture_lock = threading.Lock()
+        self.capture_timer = PrecisionTimer()
+        self.capture_timer.calibrate()
+        self.realtime_cpu = realtime_cpu
 
-        self.server = SimpleXMLRPCServer((host, port))
+        self.sampling_frequency_Hz = sampling_frequency_Hz
+        self.stopping = False
+        self.acquisition = None
+        if sampling_frequency_Hz is not None:
+            self.capacity = int(sampling_frequency_Hz * buffer_duration)
+            self.ring_values = np.zeros(self.capacity, dtype=np.int32)
+            self.ring_times = np.zeros(self.capacity)
+            # Total count of samples taken, the sequence number of the next sample
+            self.written = 0
+            self.overruns = 0
+            # Sequence number of the first sample since sampling (re)started
+            self.resumed = 0
+            self.error = None
+            self.last_request = time.monotonic()
+            self.requested = threading.Event()
+            self.acquisition = threading.Thread(target=self._acquire, name='adc-acquisition', daemon=True)
+            self.acquisition.start()
+
+        class Server(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+            daemon_threads = True
+
+        self.server = Server((host, port))
         self.server.register_function(self.get_samples_V, 'get_samples_V')
+        if hasattr(adc, 'get_values'):
+            self.server.register_function(self.get_burst_V, 'get_burst_V')
+        self.server.register_function(self.get_capture_V, 'get_capture_V')
+        if self.acquisition is not None:
+            self.server.register_function(self.get_since_V, 'get_since_V')
+
+        self.stream_server = None
+        if stream_port is not None:
+            self.stream_server = self._create_stream_server(host, stream_port)
+
+    def _create_stream_server(self, host, port):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def setup(self):
+                super().setup()
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def handle(self):
+                # Connection is kept open for any number of requests
+                while True:
+                    request = self.rfile.read(STREAM_REQUEST.size)
+                    if len(request) < STREAM_REQUEST.size:
+                        break
+                    self.wfile.write(server._stream_response(*STREAM_REQUEST.unpack(request)))
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        stream_server = Server((host, port), Handler)
+        thread = threading.Thread(target=stream_server.serve_forever, daemon=True)
+        thread.start()
+        return stream_server
 
     def serve_forever(self):
         self.server.serve_forever()
 
-    def get_samples_V(self, sampling_frequency_Hz, samples_count):
-        samples_raw = []
+    def close(self):
+        self.stopping = True
+        if self.acquisition is not None:
+            self.requested.set()
+            self.acquisition.join()
+        self.server.server_close()
+        if self.stream_server is not None:
+            self.stream_server.shutdown()
+            self.stream_server.server_close()
+
+    def _acquire(self):
+        if self.realtime_cpu is None:
+            self._acquire_loop()
+            return
+
+        with realtime(self.realtime_cpu) as enabled:
+            if not enabled:
+                print('Real time scheduling is not permitted')
+            self._acquire_loop()
+
+    def _acquire_loop(self):
+        timer = PrecisionTimer()
+        timer.calibrate()
+        period = 1 / self.sampling_frequency_Hz
+        wall_offset = time.time() - time.monotonic()
+
+        deadline = timer.now()
+        while not self.stopping:
+            if timer.now() - self.last_request > self.idle_timeout:
+                self.requested.clear()
+                # Set before pausing, for requests to wait for new samples
+                self.resumed = self.written
+                # A request may have come in before the event was cleared
+                if timer.now() - self.last_request > self.idle_timeout:
+                    self.requested.wait()
+                deadline = timer.now()
+                continue
+
+            timer.wait_until(deadline)
+            now = timer.now()
+            try:
+                value = self.adc.get_value()
+            except Exception as e:
+                if self.error is None:
+                    print('ADC read failed: %s' % e)
+                self.error = e
+                self.resumed = self.written
+                time.sleep(self.error_delay)
+                deadline = timer.now()
+                continue
+            if self.error is not None:
+                print('ADC read restored')
+                self.error = None
+
+            # Sample is stored before it is published by the counter
+            n = self.written % self.capacity
+            self.ring_values[n] = value
+            self.ring_times[n] = now + wall_offset
+            self.written += 1
+
+            deadline += period
+            now = timer.now()
+            if now > deadline:
+                # Fell behind, skip missed samples instead of bunching them
+                missed = int((now - deadline) / period) + 1
+                self.overruns += missed
+                deadline += missed * period
+
+    def _copy(self, start, count):
+        """
+        Copy samples [start, start + count) from the ring buffer.
+
+        The writer does not lock, so samples are checked to be
+        still valid after copying.
+        """
+
+        indexes = np.arange(start, start + count) % self.capacity
+        values = self.ring_values[indexes]
+        times = self.ring_times[indexes]
+        if start <= self.written - self.capacity:
+            raise Exception('Samples were overwritten, try requesting fewer samples')
+        return values, times
+
+    def _request(self):
+        """Keep continuous sampling running, see idle_timeout."""
+        self.last_request = time.monotonic()
+        self.requested.set()
+
+    def _wait_for(self, written):
+        while self.written < written:
+            if self.error is not None:
+                raise Exception('ADC read failed: {}'.format(self.error))
+            if not self.acquisition.is_alive():
+                raise Exception('Sampling has stopped')
+            time.sleep(min((written - self.written) / self.sampling_frequency_Hz, self.error_delay))
+
+    def _latest(self, sampling_frequency_Hz, samples_count):
+        step = self.sampling_frequency_Hz / sampling_frequency_Hz
+        if abs(step - round(step)) > 1e-6 or round(step) < 1:
+            raise Exception('Sampling frequency must be {} Hz divided by an integer'.format(
+                self.sampling_frequency_Hz))
+        step = round(step)
+
+        span = (samples_count - 1) * step + 1
+        if span >= self.capacity:
+            raise Exception('Buffer holds only {} samples'.format(self.capacity))
+        self._request()
+        # Samples taken before a pause are not contiguous with the following ones
+        self._wait_for(self.resumed + span)
+
+        end = self.written
+        values, times = self._copy(end - span, span)
+        return end - span, times[::step], values[::step]
+
+    def _since(self, sequence, max_count):
+        self._request()
+        if max_count == 0:
+            # No samples, only the sequence number of the next one
+            return self.written, np.empty(0), np.empty(0, dtype=np.int32)
+
+        # At least one sample is returned
+        self._wait_for(sequence + 1)
+
+        end = self.written
+        start = max(sequence, end - self.capacity + 1)
+        count = min(end - start, max_count)
+        values, times = self._copy(start, count)
+        return start, times, values
+
+    def _stream_response(self, command, flags, sampling_frequency_Hz, samples_count, sequence):
+        try:
+            if command == STREAM_SAMPLES:
+                sequence, times, samples_raw = self._capture(sampling_frequency_Hz, samples_count)
+            elif command == STREAM_BURST and hasattr(self.adc, 'get_values'):
+                times, sampling_frequency_Hz, samples_raw = self._burst(samples_count)
+                sequence = 0
+            elif command == STREAM_SINCE and self.acquisition is not None:
+                sequence, times, samples_raw = self._since(sequence, samples_count)
+                sampling_frequency_Hz = self.sampling_frequency_Hz
+            else:
+                raise Exception('Unsupported command {}'.format(command))
+
+            timestamp = times[0] if len(times) > 0 else time.time()
+            data = np.asarray(samples_raw).astype(STREAM_DTYPE).tobytes()
+            if flags & STREAM_TIMES:
+                data += (times - timestamp).astype(STREAM_TIMES_DTYPE).tobytes()
+            jitter_max, jitter_rms = sampling_jitter(times, sampling_frequency_Hz)
+            header = STREAM_HEADER.pack(len(data), STREAM_OK, timestamp, sampling_frequency_Hz,
+                                        self._scale_V(), sequence, jitter_max, jitter_rms)
+        except Exception as e:
+            message = str(e).encode('utf-8')
+            return STREAM_HEADER.pack(len(message), STREAM_ERROR, 0, 0, 0, 0, 0, 0) + message
+
+        return header + data
 
-        sample_time = time.monotonic() + 1 / sampling_frequency_Hz
+    def _scale_V(self):
+        return self.adc.value_to_voltage(1).m_as('V')
 
-        for _ in range(0, samples_count):
-            if time.monotonic() > sample_time:
+    def _capture(self, sampling_frequency_Hz, samples_count):
+        """Returns sequence number, wall times and raw values of samples."""
+
+        if samples_count < 1:
+            raise Exception('At least one sample is required')
+
+        if self.acquisition is not None:
+            return self._latest(sampling_frequency_Hz, samples_count)
+
+        with self.capture_lock:
+            if self.realtime_cpu is None:
+                return (0,) + self._sample(sampling_frequency_Hz, samples_count)
+            with realtime(self.realtime_cpu):
+                return (0,) + self._sample(sampling_frequency_Hz, samples_count)
+
+    def _sample(self, sampling_frequency_Hz, samples_count):
+        timer = self.capture_timer
+        period = 1 / sampling_frequency_Hz
+        times = np.empty(samples_count)
+        samples_raw = np.empty(samples_count, dtype=np.int32)
+        wall_offset = time.time() - time.monotonic()
+
+        sample_time = timer.now() + period
+
+        for n in range(0, samples_count):
+            # Short stalls (e.g. preemption) are reported as jitter,
+            # a growing lag means the ADC can't keep up
+            if timer.now() > sample_time + self.max_lag:
                 raise Exception('Sampling takes too long, try reducing the sampling frequency')
 
-            while time.monotonic() < sample_time:
-                pass
-            sample_time += 1 / sampling_frequency_Hz
+            timer.wait_until(sample_time)
+            times[n] = timer.now()
+            sample_time += period
+
+            samples_raw[n] = self.adc.get_value()
+
+        return times + wall_offset, samples_raw
+
+    def _burst(self, samples_count):
+        if self.acquisition is not None:
+            raise Exception('Burst is not available during continuous sampling')
+
+        with self.capture_lock:
+            timestamp = time.time()
+            start = time.monotonic()
+            samples_raw = self.adc.get_values(samples_count)
+            duration = time.monotonic() - start
 
-            samples_raw.append(self.adc.get_value())
+        # Times of single samples are unknown within a bulk read
+        sampling_frequency_Hz = samples_count / duration
+        times = timestamp + np.arange(samples_count) / sampling_frequency_Hz
+        return times, sampling_frequency_Hz, samples_raw
 
-        samples_V = [self.adc.value_to_voltage(x).m_as('V') for x in samples_raw]
+    def get_samples_V(self, sampling_frequency_Hz, samples_count):
+        _, _, samples_raw = self._capture(sampling_frequency_Hz, samples_count)
+
+        samples_V = (samples_raw * self._scale_V()).tolist()
 
         return samples_V
 
+    def get_capture_V(self, sampling_frequency_Hz, samples_count, with_times=False):
+        """
+        Samples with their timing: sequence number and timestamp of the
+        first sample, sampling jitter, and if `with_times` is set,
+        times of samples relative to the first one.
+        """
+
+        sequence, times, samples_raw = self._capture(sampling_frequency_Hz, samples_count)
+        jitter_max, jitter_rms = sampling_jitter(times, sampling_frequency_Hz)
+
+        capture = {
+            'sequence': sequence,
+            'timestamp': float(times[0]),
+            'sampling_frequency_Hz': sampling_frequency_Hz,
+            'samples_V': (samples_raw * self._scale_V()).tolist(),
+            'jitter_max_s': jitter_max,
+            'jitter_rms_s': jitter_rms
+        }
+        if with_times:
+            capture['times_s'] = (times - times[0]).tolist()
+
+        return capture
+
+    def get_since_V(self, sequence, max_count):
+        """
+        Samples of the continuous acquisition starting at `sequence`,
+        or at the oldest sample still buffered.
+
+        Returns the sequence number and timestamp of the first sample,
+        the sampling frequency and the samples.
+        """
+
+        sequence, times, samples_raw = self._since(sequence, max_count)
+        samples_V = (samples_raw * self._scale_V()).tolist()
+        timestamp = float(times[0]) if len(times) > 0 else time.time()
+
+        return sequence, timestamp, self.sampling_frequency_Hz, samples_V
+
+    def get_burst_V(self, samples_count):
+        """
+        Read samples back-to-back at the fastest rate the bus allows.
+
+        Returns the achieved sampling frequency and the samples.
+        """
+
+        _, sampling_frequency_Hz, samples_raw = self._burst(samples_count)
+        samples_V = (samples_raw * self._scale_V()).tolist()
+
+        return sampling_frequency_Hz, samples_V
+
 
 class ADCClient:
-    def __init__(self, host, port=8000):
+    """
+    ADCServer client.
+
+    If `stream_port` is set, samples are fetched with the binary stream
+    protocol over a kept open connection and returned as numpy arrays.
+    """
+
+    def __init__(self, host, port=8000, stream_port=None):
         self.client = xmlrpc.client.ServerProxy('http://{}:{}/'.format(host, port))
 
+        self.stream = None
+        if stream_port is not None:
+            self.stream = socket.create_connection((host, stream_port))
+            self.stream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.stream_file = self.stream.makefile('rb')
+
+    def close(self):
+        if self.stream is not None:
+            self.stream_file.close()
+            self.stream.close()
+            self.stream = None
+
+    def _read(self, size):
+        data = self.stream_file.read(size)
+        if len(data) < size:
+            raise Exception('Stream connection closed')
+        return data
+
+    def get_frame(self, command, sampling_frequency_Hz, samples_count, sequence=0, flags=0):
+        """
+        Request samples with the stream protocol.
+        Returns a capture, see ADCServer.get_capture_V().
+        """
+
+        self.stream.sendall(STREAM_REQUEST.pack(command, flags, sampling_frequency_Hz, samples_count, sequence))
+        length, status, timestamp, sampling_frequency_Hz, scale_V, sequence, jitter_max, jitter_rms = \
+            STREAM_HEADER.unpack(self._read(STREAM_HEADER.size))
+        payload = self._read(length)
+
+        if status != STREAM_OK:
+            raise Exception(payload.decode('utf-8'))
+
+        item_size = np.dtype(STREAM_DTYPE).itemsize
+        if flags & STREAM_TIMES:
+            item_size += np.dtype(STREAM_TIMES_DTYPE).itemsize
+        samples_raw = np.frombuffer(payload, dtype=STREAM_DTYPE, count=length // item_size)
+
+        capture = {
+            'sequence': sequence,
+            'timestamp': timestamp,
+            'sampling_frequency_Hz': sampling_frequency_Hz,
+            'samples_V': samples_raw * scale_V,
+            'jitter_max_s': jitter_max,
+            'jitter_rms_s': jitter_rms
+        }
+        if flags & STREAM_TIMES:
+            capture['times_s'] = np.frombuffer(payload, dtype=STREAM_TIMES_DTYPE, offset=samples_raw.nbytes)
+
+        return capture
+
     def get_samples_V(self, sampling_frequency_Hz, samples_count):
+        if self.stream is not None:
+            return self.get_frame(STREAM_SAMPLES, sampling_frequency_Hz, samples_count)['samples_V']
         return self.client.get_samples_V(sampling_frequency_Hz, samples_count)
 
+    def get_capture_V(self, sampling_frequency_Hz, samples_count, resample_uniform=False):
+        """
+        See ADCServer.get_capture_V().
+        If `resample_uniform` is set, samples are resampled onto
+        a uniform grid using times of samples.
+        """
+
+        if self.stream is not None:
+            flags = STREAM_TIMES if resample_uniform else 0
+            capture = self.get_frame(STREAM_SAMPLES, sampling_frequency_Hz, samples_count, flags=flags)
+        else:
+            capture = self.client.get_capture_V(sampling_frequency_Hz, samples_count, resample_uniform)
+
+        if resample_uniform:
+            capture['samples_V'] = resample(np.asarray(capture['times_s']), np.asarray(capture['samples_V']),
+                                            capture['sampling_frequency_Hz'])
+
+        return capture
+
+    def get_burst_V(self, samples_count):
+        if self.stream is not None:
+            capture = self.get_frame(STREAM_BURST, 0, samples_count)
+            return capture['sampling_frequency_Hz'], capture['samples_V']
+        return self.client.get_burst_V(samples_count)
+
+    def get_since_V(self, sequence, max_count):
+        """See ADCServer.get_since_V()."""
+        if self.stream is not None:
+            capture = self.get_frame(STREAM_SINCE, 0, max_count, sequence)
+            return capture['sequence'], capture['timestamp'], capture['sampling_frequency_Hz'], capture['samples_V']
+        return self.client.get_since_V(sequence, max_count)
+
 
 class ADCTestSignalClient:
     def __init__(self, frequency_Hz, offset_V, amplitude_V):
         self.frequency_Hz = frequency_Hz
         self.offset_V = offset_V
         self.amplitude_V = amplitude_V
+        self.stream_start = time.time()
 
     def get_samples_V(self, sampling_frequency_Hz, samples_count):
-        samples_V = []
+        phase = self.frequency_Hz * 2 * np.pi / sampling_frequency_Hz * np.arange(samples_count)
+        return self.offset_V + self.amplitude_V * np.sin(phase)
 
-        for n in range(0, samples_count):
-            phase = self.frequency_Hz * 2 * pi * n / sampling_frequency_Hz
-            samples_V.append(self.offset_V + self.amplitude_V * sin(phase))
+    # Sampling frequency of the continuous stream, see get_since_V()
+    stream_frequency_Hz = 1000
 
-        return samples_V
+    def get_since_V(self, sequence, max_count):
+        """Continuous test signal, as if sampled since the client was created."""
+        f = self.stream_frequency_Hz
+        available = int((time.time() - self.stream_start) * f)
+        start = max(sequence, available - max_count)
+        indexes = np.arange(start, available)
+        phase = self.frequency_Hz * 2 * np.pi / f * indexes
+        return start, self.stream_start + start / f, f, self.offset_V + self.amplitude_V * np.sin(phase)
@@ -0,0 +1,928 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import subprocess
+import threading
+import random
+from itertools import cycle
+from statistics import mean, pstdev
+
+
+def measure(job, repeat):
+    """Average CPU time of a single job call, in seconds."""
+
+    start = time.process_time()
+    for _ in range(0, repeat):
+        job()
+    return (time.process_time() - start) / repeat
+
+
+def report(name, secs, baseline_secs=None):
+    line = '{:<40} {:>10.1f} us'.format(name, secs * 1e6)
+    if baseline_secs is not None:
+        line += '  x{:.1f}'.format(baseline_secs / secs)
+    print(line)
+
+
+class NoiseADC:
+    """
+    ADC stub producing a noisy constant signal with occasional spikes.
+    """
+
+    adc_bits = 12
+
+    def __init__(self, level=2048, noise=4, spike_probability=0.02, spike=400):
+        from settings import UR
+        self.v_ref = 2.5 * UR.V
+
+        rnd = random.Random(0)
+        values = []
+        for _ in range(0, 4096):
+            value = level + rnd.gauss(0, noise)
+            if rnd.random() < spike_probability:
+                value += rnd.choice((-spike, spike))
+            values.append(min(max(int(value), 0), (1 << self.adc_bits) - 1))
+        self.values = cycle(values)
+
+    def get_value(self):
+        return next(self.values)
+
+    def value_to_voltage(self, value):
+        return float(value) / (1 << self.adc_bits) * self.v_ref
+
+
+def bench_adc_filter():
+    from adc import ADCFilter
+
+    adc = NoiseADC()
+    samples_count = 256
+    repeat = 200
+
+    def legacy():
+        samples = []
+        for n in range(0, samples_count):
+            samples.append(adc.get_value())
+        value = mean(samples)
+        value_dev = pstdev(samples)
+        return adc.value_to_voltage(value).plus_minus(adc.value_to_voltage(value_dev))
+
+    baseline = measure(legacy, repeat)
+    report('statistics mean/pstdev', baseline)
+
+    for estimator in ADCFilter.estimators:
+        f = ADCFilter(adc, samples_count, estimator=estimator)
+        report('ADCFilter ' + estimator, measure(f.get_voltage, repeat), baseline)
+        print('  {:~.4fP}'.format(f.get_voltage()))
+
+    # Reduction step alone, excluding sample acquisition
+    samples = [adc.get_value() for _ in range(0, samples_count)]
+    baseline = measure(lambda: (mean(samples), pstdev(samples)), repeat)
+    report('reduce: statistics mean/pstdev', baseline)
+    for estimator in ADCFilter.estimators:
+        f = ADCFilter(adc, samples_count, estimator=estimator)
+        f.samples[:] = samples
+        report('reduce: ADCFilter ' + estimator, measure(lambda: f.estimate(f.samples), repeat), baseline)
+
+
+def bench_i2c_bulk():
+    from adc import MCP3221
+    from fakes import FakeI2CBus
+
+    samples_count = 256
+
+    for clock_Hz in (None, 100000):
+        bus = FakeI2CBus(clock_Hz=clock_Hz)
+        adc = MCP3221(i2c_busn=None, i2c_addr=0x4F, v_ref=None, i2c=bus)
+        clock = '{} Hz bus'.format(clock_Hz) if clock_Hz else 'instant bus'
+        repeat = 20 if clock_Hz else 200
+
+        def single():
+            return [adc.get_value() for _ in range(0, samples_count)]
+
+        for name, job in (('get_value x{}'.format(samples_count), single),
+                          ('get_values({})'.format(samples_count), lambda: adc.get_values(samples_count))):
+            bus.transactions = 0
+            start = time.perf_counter()
+            cpu = measure(job, repeat)
+            wall = (time.perf_counter() - start) / repeat
+            report('{}, {}'.format(name, clock), cpu)
+            print('  wall {:.1f} ms, {:.0f} samples/s, {} transactions'.format(
+                wall * 1e3, samples_count / wall, bus.transactions // repeat))
+
+
+def bench_ads1115_stream():
+    from adc import ADS1115
+    from fakes import FakeI2CBus
+    from settings import UR
+
+    samples_count = 64
+
+    for sps in (64, 860):
+        adc = ADS1115(i2c_busn=None, i2c_addr=0x48, i2c=FakeI2CBus())
+        adc.config(channel=2, fsr=1024 * UR.mV, sps=sps)
+
+        def legacy():
+            for _ in range(0, samples_count):
+                # Busy-wait for a conversion
+                end = time.monotonic() + adc.conversion_time
+                while time.monotonic() < end:
+                    pass
+                adc._read_value()
+
+        for name, job in (('delay per sample', legacy),
+                          ('get_values', lambda: adc.get_values(samples_count))):
+            start = time.perf_counter()
+            cpu = measure(job, 1)
+            wall = time.perf_counter() - start
+            report('{} SPS, {}'.format(sps, name), cpu)
+            print('  wall {:.0f} ms, CPU load {:.0f}%'.format(wall * 1e3, 100 * cpu / wall))
+
+
+def bench_timer():
+    import timer
+    timer.main()
+
+
+def bench_step_pulses():
+    from pump import PumpInterface, StepPulseEngine, pump_concurrently
+    from fakes import FakeGPIO
+    from settings import UR, PUMP_X_CONFIG, PUMP_Y_CONFIG
+
+    gpio = FakeGPIO()
+    volume = 0.05 * UR.mL
+
+    for ramp_time in (0 * UR.s, 0.2 * UR.s):
+        pump_x = PumpInterface(dict(PUMP_X_CONFIG, ramp_time=ramp_time), gpio=gpio)
+        pump_y = PumpInterface(dict(PUMP_Y_CONFIG, ramp_time=ramp_time), gpio=gpio)
+
+        start = time.process_time()
+        report_x = pump_x.pump(volume)
+        report_y = pump_y.pump(volume)
+        cpu = time.process_time() - start
+        sequential = report_x['achieved_s'] + report_y['achieved_s']
+        print('{} ramp, sequential: {:.3f} s, CPU {:.3f} s'.format(ramp_time, sequential, cpu))
+
+        start = time.process_time()
+        report = pump_concurrently((pump_x, pump_y), (volume, volume))
+        cpu = time.process_time() - start
+        print('{} ramp, concurrent: {:.3f} s, CPU {:.3f} s'.format(ramp_time, report['achieved_s'], cpu))
+        print('  ' + StepPulseEngine.format_report(report))
+
+    import tracemalloc
+    tracemalloc.start()
+    start = time.process_time()
+    edges = sum(1 for _ in StepPulseEngine.schedule([(pump_x, 420000), (pump_y, 420000)]))
+    cpu = time.process_time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('25 mL schedule for two pumps: {} edges computed in {:.2f} s, peak memory {:.1f} MB'.format(
+        edges, cpu, peak / 1e6))
+
+
+def bench_units():
+    import numpy as np
+    from ph import PHTheory, PHCalibration
+    from water_tank import LinearInterpolation, PressureSensorCalibration
+    from settings import UR, PH_CONFIG, SUPPLY_TANK_CONFIG
+
+    repeat = 2000
+
+    calibration = PHCalibration(
+        adc_offset=PH_CONFIG['adc']['v_off'],
+        temp=PH_CONFIG['calibration']['temperature'],
+        points=PH_CONFIG['calibration']['points'])
+    temp = 22.5 * UR.degC
+    voltage = (1.3123 * UR.V).plus_minus(0.0021 * UR.V)
+
+    # Fast paths match these references, see tests/test_units.py
+    def ph_reference():
+        return PHTheory.compute_ph(temp, calibration.offset, calibration.slope, voltage)
+
+    baseline = measure(ph_reference, repeat)
+    report('pH: pint', baseline)
+    report('pH: floats', measure(lambda: calibration.compute_ph(temp, voltage), repeat), baseline)
+    voltages = np.random.uniform(1.1, 1.4, 10000) * UR.V
+    report('pH: 10k values array', measure(lambda: calibration.compute_ph(temp, voltages), 100), 10000 * baseline)
+
+    sensor = PressureSensorCalibration(SUPPLY_TANK_CONFIG['calibration']['pressure_offset'])
+    voltage = (0.3217 * UR.V).plus_minus(0.0004 * UR.V)
+
+    def pressure_reference():
+        return voltage / sensor.sensitivity - sensor.pressure_offset
+
+    baseline = measure(pressure_reference, repeat)
+    report('pressure: pint', baseline)
+    report('pressure: floats', measure(lambda: sensor.compute_pressure(voltage), repeat), baseline)
+
+    points = SUPPLY_TANK_CONFIG['calibration']['points']
+    interpolation = LinearInterpolation(
+        x=[p['pressure'] for p in points],
+        y=[p['volume'] for p in points])
+    pressure = (31.7 * UR.cmH2O).plus_minus(0.2 * UR.cmH2O)
+
+    def interpolation_reference():
+        x1, x2 = interpolation.x[0], interpolation.x[1]
+        y1, y2 = interpolation.y[0], interpolation.y[1]
+        y = y1 + (pressure - x1) / (x2 - x1) * (y2 - y1)
+        return UR.Measurement(y.magnitude.nominal_value, y.magnitude.std_dev, y.units)
+
+    baseline = measure(interpolation_reference, repeat)
+    report('interpolation: pint', baseline)
+    report('interpolation: floats', measure(lambda: interpolation(pressure), repeat), baseline)
+
+
+def import_times(module):
+    """
+    Import a module in a fresh interpreter.
+    Returns cumulative import times in seconds by module name.
+    """
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=script_dir, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise Exception(result.stderr.strip().splitlines()[-1])
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def bench_startup():
+    entry_points = ('ph', 'pump', 'temperature', 'water_tank', 'solution_tank',
+                    'google', 'thingspeak', 'controller')
+    heavy = ('settings', 'pint', 'numpy', 'oauth2client', 'http.client', 'urllib.request', 'RPi.GPIO')
+
+    # The first import fills the units cache
+    import_times('settings')
+
+    for module in entry_points:
+        try:
+            times = import_times(module)
+        except Exception as e:
+            print('{:<40} unavailable: {}'.format(module, e))
+            continue
+        print('{:<40} {:>10.0f} ms'.format('import ' + module, times[module] * 1e3))
+        print('  ' + ', '.join('{} {:.0f} ms'.format(m, times[m] * 1e3) for m in heavy if m in times))
+
+    for name, times in sensor_startup_times().items():
+        print('{:<40} {:>10.0f} ms'.format(name + ' startup', sum(times.values()) * 1e3))
+        print('  ' + ', '.join('{} {:.0f} ms'.format(stage, t * 1e3) for stage, t in times.items()))
+
+
+# Sensors are created with fake I2C and 1-Wire backends, in a fresh interpreter
+SENSOR_STARTUP_SCRIPT = '''
+import sys
+import time
+import tempfile
+from fakes import FakeI2CBus, FakeW1Tree
+from temperature import TemperatureService
+from settings import PH_CONFIG, SUPPLY_TANK_CONFIG
+from ph import PHInterface
+from water_tank import WaterTankInterface
+
+with tempfile.TemporaryDirectory() as tmp:
+    FakeW1Tree(tmp, {PH_CONFIG['temperature']['device_id']: 25})
+
+    start = time.perf_counter()
+    if sys.argv[1] == 'ph':
+        sensor = PHInterface(PH_CONFIG, FakeI2CBus(), TemperatureService(tmp))
+        read = sensor.get_t_v_ph
+    else:
+        sensor = WaterTankInterface(SUPPLY_TANK_CONFIG, FakeI2CBus())
+        read = sensor.get_volume
+    created = time.perf_counter()
+    read()
+    print(created - start, time.perf_counter() - created)
+'''
+
+
+def sensor_startup_times():
+    """
+    Construction and first read times in seconds, by sensor, each
+    measured in a fresh interpreter. Reads include conversion times.
+    """
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    out = {}
+    for name in ('ph', 'water_tank'):
+        result = subprocess.run([sys.executable, '-c', SENSOR_STARTUP_SCRIPT, name], cwd=script_dir,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            raise Exception(result.stderr.strip().splitlines()[-1])
+        # Calibration reports are printed before
+        times = result.stdout.strip().splitlines()[-1].split()
+        out[name] = dict(zip(('construction', 'first read'), map(float, times)))
+    return out
+
+
+def sample_records(count, start=1500000000):
+    from local_store import timestamp_to_date
+    return [{'date': timestamp_to_date(start + 900 * n), 'temperature_C': '25.0', 'pH': '6.00',
+             'supply_tank_L': '250', 'nutrients_mL': '0.0'} for n in range(0, count)]
+
+
+def bench_google():
+    from google import GoogleSheet, SheetsConnection
+    from fakes import StaticCredentials, FakeSheetsServer
+
+    server = FakeSheetsServer()
+    credentials = StaticCredentials()
+    connection = SheetsConnection(credentials=credentials, api_url=server.url)
+    sheet = GoogleSheet(connection=connection, sheet_id='test')
+    records = sample_records(100)
+
+    def reconnecting_append(data):
+        connection.close()
+        sheet.append(data)
+
+    for name, job in (('append, new connection', lambda: [reconnecting_append(d) for d in records]),
+                      ('append, kept connection', lambda: [sheet.append(d) for d in records]),
+                      ('append_many', lambda: sheet.append_many(records))):
+        server.requests = 0
+        server.connections = 0
+        start = time.perf_counter()
+        job()
+        wall = time.perf_counter() - start
+        print('{:<40} {:>10.1f} ms, {} requests, {} connections for {} rows'.format(
+            name, wall * 1e3, server.requests, server.connections, len(records)))
+
+    # Server error: the connection is reopened and the request repeated
+    server.fail_requests = 1
+    server.fail_status = 503
+    try:
+        sheet.append(records[0])
+        raise Exception('Server error was not reported')
+    except Exception as e:
+        print('server error reported: ' + str(e)[:40])
+
+    # Token revoked: a new token is obtained and the request repeated
+    server.token = credentials.token = 'new-token'
+    sheet.append(records[0])
+    print('token refreshes: {}'.format(credentials.refreshes))
+
+    rows = connection.get_values('test', sheet.columns)
+    if len(rows) != 3 * len(records) + 1:
+        raise Exception('Unexpected rows count {}'.format(len(rows)))
+
+    server.close()
+
+
+def bench_google_sync():
+    import tempfile
+    from google import GoogleSheet, SheetsConnection
+    from fakes import StaticCredentials, FakeSheetsServer
+
+    server = FakeSheetsServer()
+    connection = SheetsConnection(credentials=StaticCredentials(), api_url=server.url)
+    records = sample_records(20000)
+    server.sheets['test'] = [['date', 'temperature_C', 'pH', 'supply_tank_L', 'nutrients_mL']]
+    server.sheets['test'] += [[d[k] for k in server.sheets['test'][0]] for d in records]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        mirror = os.path.join(tmp, 'mirror.csv')
+
+        def load(name):
+            start = time.perf_counter()
+            sheet = GoogleSheet(keep_data=True, connection=connection, sheet_id='test', mirror_file_name=mirror)
+            print('{:<40} {:>10.1f} ms, {} rows'.format(name, (time.perf_counter() - start) * 1e3, len(sheet.history)))
+            return sheet
+
+        load('no mirror, full download')
+        load('mirror up to date')
+        server.sheets['test'] += [list(r) for r in server.sheets['test'][-10:]]
+        load('mirror, 10 new rows')
+        server.sheets['test'][-1][1] = '0.0'
+        sheet = load('mirror inconsistent, full download')
+
+        if len(sheet.history) != len(server.sheets['test']) - 1:
+            raise Exception('History does not match the sheet')
+
+    server.close()
+
+
+def bench_history():
+    import tracemalloc
+    from history import DataHistory
+
+    count = 100000
+    records = sample_records(count)
+    rows = [[d[k] for k in ('date', 'temperature_C', 'pH', 'supply_tank_L', 'nutrients_mL')] for d in records]
+
+    tracemalloc.start()
+    values = [list(r) for r in rows]
+    for r in values:
+        # Cells parsed from a response are distinct objects
+        r[:] = [''.join(c) for c in r]
+    list_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del values
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    history = DataHistory()
+    history.extend(rows)
+    duration = time.perf_counter() - start
+    history_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print('{} rows: list of lists {:.1f} MB, DataHistory {:.1f} MB, built in {:.0f} ms'.format(
+        count, list_bytes / 1e6, history_bytes / 1e6, duration * 1e3))
+
+    window_start = history.column('date')[count // 2]
+    report('window of one day', measure(lambda: history.window(window_start, window_start + 86400), 1000))
+    start = time.process_time()
+    for r in rows[:10000]:
+        history.append(r)
+    report('append', (time.process_time() - start) / 10000)
+
+
+def bench_thingspeak():
+    import json
+    import urllib.request
+    from thingspeak import Thingspeak
+    from fakes import FakeThingspeakServer
+
+    server = FakeThingspeakServer(update_interval=0)
+    records = sample_records(200)
+    t = Thingspeak(key='key', channel_id='1', api_url=server.url)
+    t.update_interval = 0
+
+    def new_connection_per_point():
+        # Former upload scheme, one urlopen per point
+        for data in records:
+            body = json.dumps({'write_api_key': 'key', 'updates': [t._to_point(data)]}).encode('utf-8')
+            req = urllib.request.Request(server.url + t.path, body, {'Content-Type': 'application/json'})
+            urllib.request.urlopen(req).read()
+
+    for name, job in (('urlopen per point', new_connection_per_point),
+                      ('kept connection per point', lambda: [t.append(d) for d in records]),
+                      ('bulk update', lambda: t.append_many(records))):
+        server.requests = 0
+        server.connections = 0
+        start = time.perf_counter()
+        job()
+        wall = time.perf_counter() - start
+        print('{:<40} {:>10.1f} ms, {:.0f} points/s, {} requests, {} connections'.format(
+            name, wall * 1e3, len(records) / wall, server.requests, server.connections))
+
+    # Rate limited points are left to the caller, failures are raised
+    t.update_interval = server.update_interval = 0.2
+    time.sleep(0.2)
+    sent = [t.append_many(records[:3]), t.append_many(records[3:5])]
+    server.fail_requests = 1
+    time.sleep(0.2)
+    try:
+        t.append_many(records[5:6])
+        raise Exception('Failure was not raised')
+    except Exception as e:
+        print('sent {} of 5 points within the update interval, then: {}'.format(sum(sent), e))
+    time.sleep(0.2)
+    if t.append_many(records[3:6]) != 3:
+        raise Exception('Points were not sent')
+
+    server.close()
+
+
+class BenchSensors:
+    """
+    pH and supply tank sensors on fake MCP3221 ADCs, with the
+    filtering and unit conversions of the real interfaces.
+    """
+
+    def __init__(self):
+        from adc import MCP3221, ADCFilter
+        from fakes import FakeI2CBus
+        from ph import PHCalibration
+        from water_tank import LinearInterpolation, PressureSensorCalibration
+        from temperature import ConstTemperatureInterface
+        from settings import UR, PH_CONFIG, SUPPLY_TANK_CONFIG
+
+        def adc_filter(level):
+            adc = MCP3221(i2c_busn=None, i2c_addr=0x4d, v_ref=PH_CONFIG['adc']['v_ref'],
+                          i2c=FakeI2CBus(level=level))
+            return ADCFilter(adc, PH_CONFIG['adc']['filter_samples'], PH_CONFIG['adc']['filter_estimator'])
+
+        self.ph_adc = adc_filter(2150)
+        self.ph_calibration = PHCalibration(
+            adc_offset=PH_CONFIG['adc']['v_off'],
+            temp=PH_CONFIG['calibration']['temperature'],
+            points=PH_CONFIG['calibration']['points'])
+        self.temperature = ConstTemperatureInterface(22.5 * UR.degC)
+
+        self.tank_adc = adc_filter(600)
+        self.pressure = PressureSensorCalibration(SUPPLY_TANK_CONFIG['calibration']['pressure_offset'])
+        points = SUPPLY_TANK_CONFIG['calibration']['points']
+        self.volume = LinearInterpolation(
+            x=[p['pressure'] for p in points],
+            y=[p['volume'] for p in points])
+
+    def get_voltage(self):
+        return self.ph_adc.get_voltage()
+
+    def compute_ph(self, temperature, voltage):
+        return self.ph_calibration.compute_ph(temperature, voltage)
+
+    def get_volume(self):
+        return self.volume(self.pressure.compute_pressure(self.tank_adc.get_voltage()))
+
+    @staticmethod
+    def is_full():
+        return True
+
+
+def bench_sampler():
+    from acquisition import SensorAcquisition
+    from sampler import Sampler
+    from settings import UR
+
+    sensors = BenchSensors()
+    acquisition = SensorAcquisition(ph=sensors, supply_tank=sensors, solution_tank=sensors)
+    duration = 2
+
+    for interval in (0.05, 0.2, 1, 5):
+        sampler = Sampler(acquisition, interval * UR.s, capacity=1000)
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        sampler.start()
+        time.sleep(duration)
+        sampler.stop()
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - start
+
+        stats = sampler.aggregate((duration + 1) * UR.s)
+        print('{:>5} s interval: {:>3} samples, CPU load {:.2f}%, {:.1f} ms per sample, {} skipped'.format(
+            interval, stats['ph']['count'], 100 * cpu / wall, 1e3 * cpu / max(stats['ph']['count'], 1),
+            sampler.skipped))
+    print('  ' + Sampler.format_aggregates(stats))
+
+
+def bench_adc_rpc():
+    import xmlrpc.client
+    from adc import MCP3221
+    from fakes import FakeI2CBus
+    from adc_rpc import ADCServer, ADCClient, STREAM_HEADER
+    from settings import UR
+
+    adc = MCP3221(i2c_busn=None, i2c_addr=0x4d, v_ref=2.5 * UR.V, i2c=FakeI2CBus())
+    server = ADCServer(adc, host='127.0.0.1', port=0, stream_port=0)
+    server.server.logRequests = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server.server_address[1]
+    stream_port = server.stream_server.server_address[1]
+
+    xmlrpc_client = ADCClient('127.0.0.1', port)
+    stream_client = ADCClient('127.0.0.1', port, stream_port=stream_port)
+
+    for samples_count, repeat in ((256, 50), (4096, 10)):
+        for name, client in (('XML-RPC', xmlrpc_client), ('stream', stream_client)):
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+            for _ in range(0, repeat):
+                _, samples_V = client.get_burst_V(samples_count)
+            wall = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+
+            if client is xmlrpc_client:
+                size = len(xmlrpc.client.dumps((client.get_burst_V(samples_count),), methodresponse=True))
+            else:
+                size = STREAM_HEADER.size + 2 * samples_count
+            print('{:>4} samples, {:<8} {:>9.0f} samples/s, {:>5.1f} bytes/sample, CPU {:.1f} ms per request'.format(
+                samples_count, name, repeat * samples_count / wall, size / samples_count, cpu * 1e3 / repeat))
+
+    # Paced sampling, both transports must return the same shape of data
+    for name, client in (('XML-RPC', xmlrpc_client), ('stream', stream_client)):
+        start = time.perf_counter()
+        samples_V = client.get_samples_V(500, 100)
+        print('500 Hz x 100 samples, {:<8} {:.0f} ms, mean {:.3f} V'.format(
+            name, (time.perf_counter() - start) * 1e3, sum(samples_V) / len(samples_V)))
+
+    stream_client.close()
+    server.close()
+
+    # Continuous sampling, concurrent clients are served from the ring buffer
+    bus = FakeI2CBus()
+    adc = MCP3221(i2c_busn=None, i2c_addr=0x4d, v_ref=2.5 * UR.V, i2c=bus)
+    server = ADCServer(adc, host='127.0.0.1', port=0, stream_port=0, sampling_frequency_Hz=1000)
+    server.server.logRequests = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stream_port = server.stream_server.server_address[1]
+
+    duration = 1
+    frames = []
+
+    def oscilloscope():
+        client = ADCClient('127.0.0.1', port, stream_port=stream_port)
+        count = 0
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            client.get_samples_V(500, 256)
+            count += 1
+        client.close()
+        frames.append(count)
+
+    clients = [threading.Thread(target=oscilloscope) for _ in range(0, 4)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    server.close()
+    print('continuous 1000 Hz, {} clients: {:.0f} frames/s each, {} samples taken, {} bus transactions'.format(
+        len(clients), sum(frames) / len(frames) / duration, server.written, bus.transactions))
+
+
+def bench_sampling_jitter():
+    from adc import MCP3221
+    from fakes import FakeI2CBus
+    from adc_rpc import ADCServer, ADCClient
+    from settings import UR
+
+    adc = MCP3221(i2c_busn=None, i2c_addr=0x4d, v_ref=2.5 * UR.V, i2c=FakeI2CBus())
+    samples_count = 1000
+
+    for realtime_cpu in (None, max(os.sched_getaffinity(0))):
+        server = ADCServer(adc, host='127.0.0.1', port=0, stream_port=0, realtime_cpu=realtime_cpu)
+        server.server.logRequests = False
+        client = ADCClient('127.0.0.1', server.server.server_address[1],
+                           stream_port=server.stream_server.server_address[1])
+        mode = 'normal' if realtime_cpu is None else 'real time on CPU {}'.format(realtime_cpu)
+
+        for sampling_frequency_Hz in (1000, 5000, 20000):
+            try:
+                capture = client.get_capture_V(sampling_frequency_Hz, samples_count)
+            except Exception as e:
+                print('{:>5} Hz, {}: {}'.format(sampling_frequency_Hz, mode, e))
+                continue
+            print('{:>5} Hz, {}: jitter max {:.1f} us, rms {:.1f} us'.format(
+                sampling_frequency_Hz, mode, capture['jitter_max_s'] * 1e6, capture['jitter_rms_s'] * 1e6))
+
+        client.close()
+        server.close()
+
+
+def bench_scope_frame():
+    import numpy as np
+    from adc_rpc import ADCTestSignalClient
+    from oscilloscope import FrameProcessor
+
+    adc = ADCTestSignalClient(frequency_Hz=50, offset_V=1.25, amplitude_V=0.1)
+    sampling_frequency_Hz = 1000
+    max_points = 640
+
+    for samples_count in (256, 4096, 65536):
+        samples_V = adc.get_samples_V(sampling_frequency_Hz, samples_count)
+        samples_list = samples_V.tolist()
+        repeat = max(10, 200000 // samples_count)
+
+        def legacy():
+            # Former render path, with numpy FFT in place of scipy.fftpack
+            samples_mV = np.array(samples_list) * 1000
+            mean_mV = np.mean(samples_mV)
+            np.std(samples_mV)
+            fft = np.abs(np.fft.fft(samples_mV - mean_mV)[:samples_count // 2])
+            fft /= max(fft)
+
+        frame = FrameProcessor(sampling_frequency_Hz, samples_count, max_points)
+        frame.process(samples_V)
+        peak_Hz = frame.x_freq[np.argmax(frame.spectrum)]
+        if abs(peak_Hz - 50) > sampling_frequency_Hz / samples_count:
+            raise Exception('Spectrum peak at {} Hz'.format(peak_Hz))
+
+        baseline = measure(legacy, repeat)
+        report('{} samples: legacy'.format(samples_count), baseline)
+        report('{} samples: FrameProcessor'.format(samples_count),
+               measure(lambda: frame.process(samples_V), repeat), baseline)
+        print('  plotted points {} + {}'.format(len(frame.plot_time), len(frame.plot_freq)))
+
+
+def bench_spectrogram():
+    import tempfile
+    import tracemalloc
+    import numpy as np
+    from adc_rpc import ADCTestSignalClient
+    from oscilloscope import Spectrogram, FrameRecorder, FrameReplay
+
+    adc = ADCTestSignalClient(frequency_Hz=50, offset_V=1.25, amplitude_V=0.1)
+    sampling_frequency_Hz = 1000
+    chunk = 50
+    duration_s = 600
+    samples_V = adc.get_samples_V(sampling_frequency_Hz, duration_s * sampling_frequency_Hz)
+    chunks = np.split(samples_V, len(samples_V) // chunk)
+
+    spectrogram = Spectrogram(sampling_frequency_Hz)
+    spectrogram.feed(chunks[0])
+    tracemalloc.start()
+    start = time.process_time()
+    for n, c in enumerate(chunks[1:]):
+        spectrogram.feed(c)
+        if n % 20 == 0:
+            # Display refresh every second of signal
+            spectrogram.image()
+    secs = time.process_time() - start
+    growth = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print('{} s of {} Hz signal in {} sample chunks: {} spectra'.format(
+        duration_s, sampling_frequency_Hz, chunk, spectrogram.spectra))
+    report('CPU per signal second', secs / duration_s)
+    print('  real time factor x{:.0f}, memory growth {} B'.format(duration_s / secs, growth))
+
+    peak_Hz = spectrogram.x_freq[np.argmax(spectrogram.image()[0])]
+    if abs(peak_Hz - 50) > sampling_frequency_Hz / len(spectrogram.window):
+        raise Exception('Spectrum peak at {} Hz'.format(peak_Hz))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file_name = os.path.join(tmp, 'frames.bin')
+        recorder = FrameRecorder(file_name)
+        for n, c in enumerate(chunks[:200]):
+            recorder.write(n * chunk, n * chunk / sampling_frequency_Hz, sampling_frequency_Hz, c)
+        recorder.close()
+
+        replay = FrameReplay(file_name, realtime=False)
+        replayed = []
+        try:
+            while True:
+                replayed.append(replay.get_since_V(0, chunk)[3])
+        except EOFError:
+            pass
+        replay.file.close()
+        error = np.abs(np.concatenate(replayed) - samples_V[:200 * chunk]).max()
+        print('  record/replay {} frames, {} B, max error {:.1g} V'.format(
+            len(replayed), os.path.getsize(file_name), error))
+
+
+def bench_interpolation():
+    import numpy as np
+    from water_tank import LinearInterpolation
+    from settings import UR
+
+    # Horizontal cylinder tank, 60 cm diameter, 1 m long: volume by water level
+    radius_cm = 30
+    levels_cm = np.linspace(0, 2 * radius_cm, 500)
+    angles = 2 * np.arccos(1 - levels_cm / radius_cm)
+    volumes_L = radius_cm ** 2 / 2 * (angles - np.sin(angles)) * 100 / 1000
+    interpolation = LinearInterpolation(
+        x=[v * UR.cmH2O for v in levels_cm],
+        y=[v * UR.L for v in volumes_L])
+    pressure = (31.7 * UR.cmH2O).plus_minus(0.2 * UR.cmH2O)
+    repeat = 2000
+
+    def legacy(x_new):
+        # Former lookup: sort points by distance, extrapolate from the two nearest
+        x_values, y_values = interpolation.x_values, interpolation.y_values
+        distances = [abs(v - x_new) for v in x_values]
+        indexes = list(range(len(distances)))
+        indexes.sort(key=distances.__getitem__)
+        i1, i2 = indexes[0], indexes[1]
+        slope = (y_values[i2] - y_values[i1]) / (x_values[i2] - x_values[i1])
+        return y_values[i1] + (x_new - x_values[i1]) * slope
+
+    baseline = measure(lambda: legacy(31.7), repeat)
+    report('500 points: legacy (floats)', baseline)
+    report('500 points: bisect (floats)', measure(lambda: interpolation.interpolate(31.7), repeat), baseline)
+    report('500 points: bisect (Measurement)', measure(lambda: interpolation(pressure), repeat), baseline)
+
+    batch = np.random.uniform(0, 2 * radius_cm, 100000)
+    batch_repeat = 10
+    loop = measure(lambda: [interpolation.interpolate(x) for x in batch[:1000]], batch_repeat) * 100
+    report('100k values: scalar calls', loop)
+    report('100k values: array', measure(lambda: interpolation.interpolate(batch), batch_repeat), loop)
+
+
+def bench_temperature():
+    import tempfile
+    from temperature import TemperatureService, TemperatureInterface
+    from settings import UR
+    from fakes import FakeW1Tree
+
+    devices = {'28-00000000000%d' % n: 20 + n for n in range(4)}
+    bad_device = '28-0000000000ff'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = FakeW1Tree(tmp, dict(devices, **{bad_device: 0}), crc_errors=(bad_device,))
+
+        for resolution in (12, 9):
+            service = TemperatureService(tmp, max_age=2 * UR.s, resolution=resolution)
+            sensors = [TemperatureInterface(d, service) for d in list(devices) + [bad_device]]
+            if tree.resolution(bad_device) != resolution:
+                raise Exception('Resolution was not set')
+
+            # Consumers in several threads, e.g. pH interface and controller
+            results = {}
+
+            def consume(sensor):
+                try:
+                    results[sensor.device_id] = sensor.get_temperature().m_as('degC')
+                except Exception as e:
+                    results[sensor.device_id] = str(e)
+
+            start = time.monotonic()
+            threads = [threading.Thread(target=consume, args=(s,)) for s in sensors]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.monotonic() - start
+
+            if any(results[d] != devices[d] for d in devices) or results[bad_device] != 'CRC check failed':
+                raise Exception('Unexpected readings {}'.format(results))
+            legacy = len(sensors) * TemperatureService.conversion_times[12]
+            print('{} bit, {} devices: {:.3f} s, {} conversion(s) (sequential reads ~{:.1f} s)'.format(
+                resolution, len(sensors), elapsed, service.conversions, legacy))
+
+            start = time.monotonic()
+            for s in sensors[:len(devices)]:
+                s.get_temperature()
+            print('  cached reads within max age: {:.1f} us'.format(
+                (time.monotonic() - start) / len(devices) * 1e6))
+
+
+def bench_metrics():
+    import tracemalloc
+    import urllib.request
+    from metrics import Registry, MetricsServer
+
+    registry = Registry()
+    counter = registry.counter('bench_events_total', 'Events')
+    histogram = registry.histogram('bench_latency_seconds', 'Latency', ['stage'])
+    stage = histogram.labels('read')
+    repeat = 100000
+
+    report('counter inc', measure(lambda: counter.inc(), repeat))
+    report('histogram observe', measure(lambda: stage.observe(0.0123), repeat))
+    report('histogram labels + observe', measure(lambda: histogram.labels('read').observe(0.0123), repeat))
+
+    def timed():
+        with stage.time():
+            pass
+
+    report('histogram time()', measure(timed, repeat))
+
+    tracemalloc.start()
+    for n in range(repeat):
+        stage.observe(n * 1e-5)
+    growth = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('  memory growth over {} observations: {} B'.format(repeat, growth))
+
+    server = MetricsServer('127.0.0.1', 0, registry)
+    server.start()
+    url = 'http://127.0.0.1:{}/metrics'.format(server.server.server_address[1])
+    start = time.monotonic()
+    text = urllib.request.urlopen(url).read().decode()
+    print('  scrape: {} lines in {:.1f} ms'.format(len(text.splitlines()), (time.monotonic() - start) * 1e3))
+    server.close()
+
+    expected = 'bench_latency_seconds_count{{stage="read"}} {}'.format(4 * repeat)
+    if expected not in text.splitlines():
+        raise Exception('Unexpected exposition:\n' + text)
+
+    errors = registry.counter('bench_errors_total', 'Errors', ['message'])
+    for n in range(2 * errors.max_label_sets):
+        errors.labels('error %d' % n).inc()
+    print('  {} label sets used, {} merged into "{}"'.format(
+        len(errors.children), errors.labels(errors.overflow_value).value, errors.overflow_value))
+
+
+BENCHMARKS = {
+    'adc_filter': bench_adc_filter,
+    'i2c_bulk': bench_i2c_bulk,
+    'ads1115_stream': bench_ads1115_stream,
+    'timer': bench_timer,
+    'step_pulses': bench_step_pulses,
+    'units': bench_units,
+    'temperature': bench_temperature,
+    'interpolation': bench_interpolation,
+    'startup': bench_startup,
+    'google': bench_google,
+    'google_sync': bench_google_sync,
+    'history': bench_history,
+    'thingspeak': bench_thingspeak,
+    'sampler': bench_sampler,
+    'adc_rpc': bench_adc_rpc,
+    'sampling_jitter': bench_sampling_jitter,
+    'scope_frame': bench_scope_frame,
+    'spectrogram': bench_spectrogram,
+    'metrics': bench_metrics,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print('Unknown benchmark "{}", choose from: {}'.format(name, ', '.join(BENCHMARKS)))
+            return
+
+    for name in names:
+        print('== ' + name)
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,29 @@
 #!/usr/bin/env python3
 
 from datetime import datetime
-from google import GoogleSheet
-from thingspeak import Thingspeak
 from scheduler import Scheduler
 from utils import log_init, log_info, log_warn, log_err, log_exception_trace
-from utils import wait_for_ntp, retry, in_range, drop_uncertainty
+from utils import wait_for_ntp, in_range, drop_uncertainty
 from ph import PHInterface
-from pump import PumpInterface
+from pump import PumpInterface, StepPulseEngine, pump_concurrently
 from solution_tank import SolutionTankInterface
 from water_tank import WaterTankInterface
 from temperature import TemperatureInterface
+from acquisition import SensorAcquisition
+from sampler import Sampler
+from local_store import LocalStore
+from uploader import Uploader
+from metrics import REGISTRY, MetricsServer
 from settings import UR
 from settings import CONTROLLER_CONFIG, PH_CONFIG, PUMP_X_CONFIG, PUMP_Y_CONFIG, \
-    SOLUTION_TANK_CONFIG, SUPPLY_TANK_CONFIG
+    SOLUTION_TANK_CONFIG, SUPPLY_TANK_CONFIG, LOCAL_STORE_CONFIG, METRICS_CONFIG
+
+
+stage_seconds = REGISTRY.histogram('iteration_stage_seconds', 'Control iteration stage duration', ['stage'])
+iteration_failures = REGISTRY.counter('iteration_failures_total', 'Failed control iterations')
+iteration_values = REGISTRY.gauge('iteration_value', 'Values the last iteration decided on', ['name'])
+pumped = REGISTRY.counter('pumped_milliliters_total', 'Volume requested from pumps', ['pump'])
+pump_lateness = REGISTRY.gauge('pump_lateness_max_seconds', 'Maximal step pulse lateness of the last run')
 
 
 class FatalException(Exception):
@@ -30,9 +40,11 @@ class Controller:
     """
 
     def __init__(self, config, ph_config, pump_x_config, pump_y_config,
-                 solution_tank_config, supply_tank_config):
-        self.database = None
-        self.thingspeak = None
+                 solution_tank_config, supply_tank_config, local_store_config, metrics_config=None):
+        self.local_store_config = local_store_config
+        self.metrics_config = metrics_config
+        self.store = LocalStore(local_store_config)
+        self.uploader = None
         self.ph = PHInterface(ph_config)
         self.pump_x = PumpInterface(pump_x_config)
         self.pump_y = PumpInterface(pump_y_config)
@@ -50,14 +62,44 @@ class Controller:
         self.solution_tank_is_full = True
         if 'temperature_device_id' in config:
             self.temperature = TemperatureInterface(config['temperature_device_id'])
+        self.acquisition = SensorAcquisition(
+            ph=self.ph, supply_tank=self.supply_tank, solution_tank=self.solution_tank,
+            temperature=getattr(self, 'temperature', None))
+        self.iteration_period = config['iteration_period']
+        self.sampler = None
+        if config.get('sampling_interval') is not None:
+            # Keep samples of two periods
+            capacity = int(2 * self.iteration_period / config['sampling_interval']) + 1
+            self.sampler = Sampler(self.acquisition, config['sampling_interval'], capacity)
 
     def run(self):
+        if self.metrics_config is not None:
+            # Metrics are optional, e.g. the port may be taken
+            try:
+                MetricsServer(self.metrics_config['host'], self.metrics_config['port']).start()
+            except OSError as e:
+                log_warn('Metrics server not started: %s' % e)
+
         # Synchronize clock (we don't have a RTC module)
         wait_for_ntp()
 
+        # Cloud clients take long to import, load them after sensors are ready
+        from google import GoogleSheet
+        from thingspeak import Thingspeak
+
         # These objects require internet connection
-        self.database = GoogleSheet()
-        self.thingspeak = Thingspeak()
+        database = GoogleSheet()
+        thingspeak = Thingspeak()
+
+        # Uploads run in background, not to delay the control loop
+        self.uploader = Uploader(self.local_store_config, {
+            'google': database.append_many,
+            'thingspeak': thingspeak.append_many
+        })
+        self.uploader.start()
+
+        if self.sampler is not None:
+            self.sampler.start()
 
         # Enter the control loop
         self.scheduler.run()
@@ -78,14 +120,38 @@ class Controller:
         else:
             return nutrients
 
+    @staticmethod
+    def _period_mean(aggregates, name, latest):
+        """Mean of sampled values, or the latest value if none were sampled."""
+        a = aggregates[name]
+        if a['count'] == 0:
+            return latest
+        return a['mean'] * Sampler.channels[name]
+
     def _do_iteration(self):
         log_info('Starting a new iteration')
+        job = self.scheduler.jobs[0]
+        log_info('Started %.3f s late (max %.3f s), %d overruns, %d ticks skipped' % (
+            job.last_jitter, job.jitter_max, job.overruns, job.skipped))
 
         date = datetime.utcnow()
 
+        if self.sampler is None:
+            with stage_seconds.labels('acquire').time():
+                snapshot = self.acquisition.read()
+            log_info('Sensors acquired in %.1f s' % snapshot.duration)
+            aggregates = None
+        else:
+            # Sensors are only read by the sampler, not to share ADC filters between threads
+            snapshot = self.sampler.latest
+            if snapshot is None:
+                raise Exception('No samples taken yet')
+            aggregates = self.sampler.aggregate(self.iteration_period)
+            log_info('Sampled over period: ' + Sampler.format_aggregates(aggregates))
+
         # Update the solution tank state
         solution_tank_was_full = self.solution_tank_is_full
-        self.solution_tank_is_full = self.solution_tank.is_full()
+        self.solution_tank_is_full = snapshot['solution_tank_is_full']
 
         # Volume is unknown and pH sensor can be dry
         if not self.solution_tank_is_full:
@@ -95,20 +161,32 @@ class Controller:
         if not solution_tank_was_full:
             raise Exception('Solution tank has been empty for a while')
 
-        temperature, _, ph = drop_uncertainty(*self.ph.get_t_v_ph())
+        temperature, _, ph = drop_uncertainty(*snapshot.get_t_v_ph())
+        if aggregates is not None:
+            # Decide on period means, not to react to short excursions
+            ph = self._period_mean(aggregates, 'ph', ph)
+            temperature = self._period_mean(aggregates, 'ph_temperature', temperature)
         if not in_range(ph, self.valid_ph_range):
             raise FatalException('Invalid pH: {:~.3gP}'.format(ph))
         if not in_range(temperature, self.valid_ph_temperature_range):
             raise FatalException('Invalid pH temperature: {:~.3gP}'.format(temperature))
 
-        if hasattr(self, 'temperature'):
-            temperature = self.temperature.get_temperature()
+        if 'temperature' in snapshot:
+            temperature = snapshot['temperature']
+            if aggregates is not None:
+                temperature = self._period_mean(aggregates, 'temperature', temperature)
 
-        supply_tank_volume = drop_uncertainty(self.supply_tank.get_volume())
+        supply_tank_volume = drop_uncertainty(snapshot['supply_tank_volume'])
+        if aggregates is not None:
+            supply_tank_volume = self._period_mean(aggregates, 'supply_tank_volume', supply_tank_volume)
         if not in_range(supply_tank_volume, self.valid_supply_tank_volume_range):
             raise FatalException('Invalid supply tank volume: {:~.3gP}'.format(supply_tank_volume))
 
         nutrients = self._estimate_nutrients(ph)
+        iteration_values.labels('ph').set(ph.m_as('pH'))
+        iteration_values.labels('temperature_C').set(temperature.m_as('degC'))
+        iteration_values.labels('supply_tank_L').set(supply_tank_volume.m_as('L'))
+        iteration_values.labels('nutrients_mL').set(nutrients.m_as('mL'))
 
         data = {
             'date': date.strftime('%Y-%m-%dT%H:%M:%SZ'),
@@ -118,14 +196,28 @@ class Controller:
             'nutrients_mL': '%.1f' % nutrients.m_as('mL')
         }
 
-        retry(lambda: self.database.append(data), 'Database append failed')
+        # Local store is the primary record, a failure here stops the iteration
+        with stage_seconds.labels('store').time():
+            self.store.append(data)
 
-        # Data is already in DB, ignore Thingspeak errors
-        retry(lambda: self.thingspeak.append(data), 'Thingspeak append failed', rethrow=False)
-
-        # We only add nutrients after their amount was logged to DB
-        self.pump_x.pump(nutrients)
-        self.pump_y.pump(nutrients)
+        # We only add nutrients after their amount was logged.
+        # Remote databases replicate from the local store, only after
+        # pumping so the uploads do not compete with the pulses timing.
+        try:
+            with stage_seconds.labels('pumps').time():
+                if self.sampler is None:
+                    report = pump_concurrently((self.pump_x, self.pump_y), (nutrients, nutrients))
+                else:
+                    with self.sampler.busy:
+                        report = pump_concurrently((self.pump_x, self.pump_y), (nutrients, nutrients))
+        finally:
+            self.uploader.notify()
+            log_info('Uploads: ' + self.uploader.format_stats())
+        pumped.labels('x').inc(nutrients.m_as('mL'))
+        pumped.labels('y').inc(nutrients.m_as('mL'))
+        if report:
+            pump_lateness.set(report['lateness_max_s'])
+            log_info('Pumps: ' + StepPulseEngine.format_report(report))
 
     def _do_iteration_throw_only_fatal(self):
         try:
@@ -135,6 +227,7 @@ class Controller:
             raise
         except Exception as e:
             # Ignore all other possibly transient errors
+            iteration_failures.inc()
             log_warn('Iteration failed: ' + str(e))
             log_exception_trace()
 
@@ -145,7 +238,7 @@ def main():
 
     try:
         ctrl = Controller(CONTROLLER_CONFIG, PH_CONFIG, PUMP_X_CONFIG, PUMP_Y_CONFIG,
-                          SOLUTION_TANK_CONFIG, SUPPLY_TANK_CONFIG)
+                          SOLUTION_TANK_CONFIG, SUPPLY_TANK_CONFIG, LOCAL_STORE_CONFIG, METRICS_CONFIG)
         ctrl.run()
 
         log_err('Controller stopped running')
@@ -0,0 +1,300 @@
+"""
+Stand-ins for the hardware and web services, to run tests and benchmarks without them.
+"""
+
+import os
+import re
+import json
+import time
+import random
+import threading
+import urllib.parse
+from collections import namedtuple
+from adc import I2CBus
+
+
+class FakeI2CBus:
+    """
+    I2C bus stand-in to run without hardware.
+
+    Each 16-bit word read from the bus is the next value of a noisy
+    constant signal, which mimics MCP3221 streaming conversions.
+    If `clock_Hz` is set, transfer time of a real bus is emulated.
+    """
+
+    max_read_size = I2CBus.max_read_size
+
+    # Start, address, ack and stop conditions
+    transaction_bits = 11
+
+    # Data byte with ack
+    byte_bits = 9
+
+    # Number of distinct words generated in advance
+    pattern_words = 4096
+
+    def __init__(self, level=2048, noise=4, bits=12, clock_Hz=None):
+        self.clock_Hz = clock_Hz
+        self.transactions = 0
+
+        rnd = random.Random(0)
+        max_value = (1 << bits) - 1
+        words = [min(max(int(rnd.gauss(level, noise)), 0), max_value) for _ in range(0, self.pattern_words)]
+        self.pattern = b''.join(w.to_bytes(2, 'big') for w in words)
+        self.position = 0
+
+    def _transfer(self, count):
+        self.transactions += 1
+        if self.clock_Hz:
+            time.sleep((self.transaction_bits + count * self.byte_bits) / self.clock_Hz)
+
+    def _next_bytes(self, count):
+        data = bytearray()
+        while len(data) < count:
+            n = min(count - len(data), len(self.pattern) - self.position)
+            data += self.pattern[self.position:self.position + n]
+            self.position = (self.position + n) % len(self.pattern)
+        return bytes(data)
+
+    def read_i2c_block_data(self, addr, cmd, count):
+        self._transfer(count + 1)
+        return list(self._next_bytes(count))
+
+    def write_i2c_block_data(self, addr, cmd, values):
+        self._transfer(len(values) + 1)
+
+    def read_bytes(self, addr, count):
+        self._transfer(count)
+        return self._next_bytes(count)
+
+
+class FakeGPIO:
+    """
+    RPi.GPIO stand-in to run without hardware.
+
+    Output edges are counted per pin.
+    """
+
+    BCM = 11
+    OUT = 0
+    IN = 1
+
+    def __init__(self):
+        self.levels = {}
+        self.edges = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, mode, **kwargs):
+        self.levels.setdefault(pin, False)
+
+    def output(self, pin, level):
+        if self.levels.get(pin) != level:
+            self.edges[pin] = self.edges.get(pin, 0) + 1
+        self.levels[pin] = level
+
+    def input(self, pin):
+        return self.levels.get(pin, False)
+
+    def cleanup(self):
+        pass
+
+
+class FakeHTTPServer:
+    """
+    Local stand-in for a JSON web API, to run without internet.
+
+    Subclasses override handle(method, path, headers, body) returning
+    response status and a JSON-serializable body, any path is not found otherwise.
+    Set `fail_requests` to respond with `fail_status` to a number of next requests.
+    """
+
+    def __init__(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.requests = 0
+        self.connections = 0
+        self.fail_requests = 0
+        self.fail_status = 500
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length', 0))
+                data = self.rfile.read(length) if length else b''
+                if self.headers.get('Content-Type') == 'application/json':
+                    body = json.loads(data.decode('utf-8'))
+                else:
+                    body = data
+
+                with server.lock:
+                    server.requests += 1
+                    failing = server.fail_requests > 0
+                    if failing:
+                        server.fail_requests -= 1
+
+                if failing:
+                    status, response = server.fail_status, {'error': 'injected failure'}
+                else:
+                    status, response = server.handle(self.command, self.path, self.headers, body)
+
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.http = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.http.server_port)
+        self.thread = threading.Thread(target=self.http.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.http.shutdown()
+        self.http.server_close()
+
+    def handle(self, method, path, headers, body):
+        return 404, {'error': 'not found'}
+
+
+class StaticCredentials:
+    """
+    Credentials with a fixed access token, to be used with FakeSheetsServer.
+    """
+
+    Token = namedtuple('Token', ['access_token', 'expires_in'])
+
+    def __init__(self, token='test-token'):
+        self.token = token
+        self.access_token = token
+        self.refreshes = 0
+
+    def get_access_token(self):
+        if self.access_token is None:
+            self.access_token = self.token
+            self.refreshes += 1
+        return self.Token(self.access_token, 3600)
+
+
+class FakeSheetsServer(FakeHTTPServer):
+    """
+    Local stand-in for the Sheets API values endpoints.
+
+    Rows of each spreadsheet are kept in memory.
+    """
+
+    def __init__(self, token='test-token'):
+        self.token = token
+        self.sheets = {}
+        super().__init__()
+
+    @staticmethod
+    def _parse_range(cell_range):
+        """Row bounds (first, last) of a range like A:E, A10:E or A10:E20; last is None if open."""
+        m = re.fullmatch(r'[A-Z]+(\d*):[A-Z]+(\d*)', cell_range)
+        if m is None:
+            raise Exception('Unsupported range ' + cell_range)
+        first = int(m.group(1)) if m.group(1) else 1
+        last = int(m.group(2)) if m.group(2) else None
+        return first, last
+
+    def handle(self, method, path, headers, body):
+        if headers.get('Authorization') != 'Bearer ' + self.token:
+            return 401, {'error': 'unauthorized'}
+
+        url = urllib.parse.urlsplit(path)
+        m = re.fullmatch(r'/v4/spreadsheets/([^/]+)/values/(.+?)(:append)?', urllib.parse.unquote(url.path))
+        if m is None:
+            return 404, {'error': 'not found'}
+
+        with self.lock:
+            rows = self.sheets.setdefault(m.group(1), [])
+            if method == 'POST' and m.group(3):
+                rows.extend(body['values'])
+                return 200, {'updates': {'updatedRows': len(body['values'])}}
+            if method == 'GET' and not m.group(3):
+                first, last = self._parse_range(m.group(2))
+                values = rows[first - 1:last]
+                return 200, {'range': m.group(2), 'values': values} if values else {'range': m.group(2)}
+
+        return 400, {'error': 'bad request'}
+
+
+class FakeThingspeakServer(FakeHTTPServer):
+    """
+    Local stand-in for the Thingspeak bulk update endpoint.
+
+    Updates sent more often than `update_interval` are rejected.
+    """
+
+    def __init__(self, update_interval=None):
+        if update_interval is None:
+            from thingspeak import Thingspeak
+            update_interval = Thingspeak.update_interval
+        self.update_interval = update_interval
+        self.points = []
+        self.last_update = None
+        super().__init__()
+
+    def handle(self, method, path, headers, body):
+        if method != 'POST' or re.fullmatch(r'/channels/[^/]+/bulk_update.json', path) is None:
+            return 404, {'error': 'not found'}
+
+        with self.lock:
+            now = time.monotonic()
+            if self.last_update is not None and now - self.last_update < self.update_interval:
+                return 429, {'error': 'rate limit'}
+            self.last_update = now
+            self.points.extend(body['updates'])
+
+        return 202, {'success': True}
+
+
+class FakeW1Tree:
+    """
+    Fake /sys/bus/w1/devices tree of DS18B20 devices behind one bus master.
+    Devices in `crc_errors` report a failed CRC check.
+    """
+
+    def __init__(self, root, temperatures_C, crc_errors=()):
+        self.root = root
+        master = os.path.join(root, 'w1_bus_master1')
+        os.makedirs(master)
+        with open(os.path.join(master, 'therm_bulk_read'), 'w') as f:
+            f.write('0\n')
+
+        for device_id, temp_C in temperatures_C.items():
+            os.makedirs(os.path.join(root, device_id))
+            self.set_temperature(device_id, temp_C, device_id in crc_errors)
+            with open(os.path.join(root, device_id, 'resolution'), 'w') as f:
+                f.write('12\n')
+
+    def set_temperature(self, device_id, temp_C, crc_error=False):
+        with open(os.path.join(self.root, device_id, 'w1_slave'), 'w') as f:
+            f.write('72 01 4b 46 7f ff 0e 10 57 : crc=57 {}\n'.format('NO' if crc_error else 'YES'))
+            f.write('72 01 4b 46 7f ff 0e 10 57 t={}\n'.format(int(temp_C * 1000)))
+
+    def resolution(self, device_id):
+        with open(os.path.join(self.root, device_id, 'resolution')) as f:
+            return int(f.read())
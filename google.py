@@ -1,56 +1,158 @@
 #!/usr/bin/env python3
 
+import csv
 import json
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import urllib.parse
 from datetime import datetime
-from utils import config_file_path
+from keepalive import KeepAliveConnection
+from utils import config_file_path, log_info
+from history import DataHistory
 import settings
 
 
+class SheetsConnection:
+    """
+    Google Sheets API v4 connection.
+
+    HTTP connection is kept alive between requests (see KeepAliveConnection),
+    and the access token is refreshed only when it expires. After an
+    authorization error the token is renewed and the request is repeated once.
+    """
+
+    api_url = 'https://sheets.googleapis.com'
+    scope = ['https://www.googleapis.com/auth/spreadsheets']
+
+    def __init__(self, json_key=None, credentials=None, api_url=None):
+        if credentials is None:
+            # Cloud libraries take long to import, load them on demand
+            from oauth2client.service_account import ServiceAccountCredentials
+            credentials = ServiceAccountCredentials.from_json_keyfile_dict(json_key, self.scope)
+
+        self.credentials = credentials
+        self.connection = KeepAliveConnection(api_url or self.api_url)
+
+    def close(self):
+        self.connection.close()
+
+    def request(self, method, path, body=None):
+        for attempt in (1, 2):
+            headers = {'Authorization': 'Bearer ' + self.credentials.get_access_token().access_token}
+            status, data = self.connection.request(method, path, body, headers)
+
+            if status == 401 and attempt == 1:
+                # Force a token refresh
+                self.credentials.access_token = None
+                continue
+
+            if status != 200:
+                raise Exception('Sheets API error {}: {}'.format(status, data[:200]))
+
+            return json.loads(data.decode('utf-8'))
+
+    def _values_path(self, sheet_id, cell_range, action=''):
+        return '/v4/spreadsheets/{}/values/{}{}'.format(
+            urllib.parse.quote(sheet_id), urllib.parse.quote(cell_range), action)
+
+    def get_values(self, sheet_id, cell_range):
+        response = self.request('GET', self._values_path(sheet_id, cell_range))
+        return response.get('values', [])
+
+    def append_values(self, sheet_id, cell_range, rows):
+        path = self._values_path(sheet_id, cell_range, ':append')
+        path += '?valueInputOption=RAW&insertDataOption=INSERT_ROWS'
+        self.request('POST', path, {'values': rows})
+
+
 class GoogleSheet:
     """
     Use Google Sheet as online database.
 
-    Connection is recreated for each sheet access to avoid timeout issues.
+    The first sheet of a spreadsheet is used.
+    Connection is kept between accesses (see SheetsConnection).
 
-    If keep_data is set, a copy of sheet contents will be kept in memory,
-    and previously stored values will be read at object creation.
-    It takes 1 minute to obtain 20k rows on Raspberry Pi 3.
+    If keep_data is set, a copy of sheet contents will be kept in memory
+    as typed columns (see DataHistory), and previously stored values
+    will be read at object creation.
+    Values are mirrored to a local file, so only rows added since the
+    previous run are downloaded. The mirror is checked against the sheet
+    by comparing its last row, and is rebuilt if they differ.
     """
 
-    def __init__(self, keep_data=False):
-        with open(config_file_path('google_key.json')) as f:
-            self.json_key = json.load(f)
+    def __init__(self, keep_data=False, connection=None, sheet_id=None,
+                 mirror_file_name='google_sheet_mirror.csv'):
+        if connection is None:
+            with open(config_file_path('google_key.json')) as f:
+                connection = SheetsConnection(json_key=json.load(f))
+
+        if sheet_id is None:
+            with open(config_file_path('google_sheet_id.txt')) as f:
+                sheet_id = f.read().strip()
+
+        self.connection = connection
+        self.sheet_id = sheet_id
 
-        with open(config_file_path('google_sheet_id.txt')) as f:
-            self.sheet_id = f.read().strip()
+        # Columns range of the data
+        self.last_column = chr(ord('A') + len(settings.DATA_SPEC) - 1)
+        self.columns = 'A:' + self.last_column
 
         self.keep_data = keep_data
         if self.keep_data:
-            self.values = self._get_all_values()
-
-    def _open_sheet(self):
-        scope = ['https://spreadsheets.google.com/feeds']
-        credentials = ServiceAccountCredentials.from_json_keyfile_dict(self.json_key, scope)
-        client = gspread.authorize(credentials)
-        return client.open_by_key(self.sheet_id).sheet1
+            self.mirror_file_path = config_file_path(mirror_file_name)
+            self.history = DataHistory()
+            self.history.extend(self._sync_values())
 
     def _get_all_values(self):
-        sheet = self._open_sheet()
-        return sheet.get_all_values()
-
-    def _append_row(self, values):
-        sheet = self._open_sheet()
-        sheet.append_row(values)
+        return self.connection.get_values(self.sheet_id, self.columns)
+
+    def _get_values_from_row(self, row):
+        return self.connection.get_values(self.sheet_id, 'A{}:{}'.format(row, self.last_column))
+
+    def _read_mirror(self):
+        try:
+            with open(self.mirror_file_path, newline='') as f:
+                return list(csv.reader(f))
+        except FileNotFoundError:
+            return []
+
+    def _write_mirror(self, rows, append):
+        with open(self.mirror_file_path, 'a' if append else 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+
+    def _sync_values(self):
+        values = self._read_mirror()
+
+        if values:
+            # Fetch the last known row along with the new ones
+            rows = self._get_values_from_row(len(values))
+            if rows and rows[0] == values[-1]:
+                new_rows = rows[1:]
+                self._write_mirror(new_rows, append=True)
+                return values + new_rows
+            log_info('Sheet mirror is inconsistent, downloading the whole sheet')
+
+        values = self._get_all_values()
+        self._write_mirror(values, append=False)
+        return values
+
+    def _append_rows(self, rows):
+        self.connection.append_values(self.sheet_id, self.columns, rows)
         if self.keep_data:
-            self.values.append(values)
+            self.history.extend(rows)
 
-    def append(self, data):
+    @staticmethod
+    def _to_row(data):
         if len(data) != len(settings.DATA_SPEC):
             raise Exception('Invalid data fields count')
-        values = [data[k] for k in settings.DATA_SPEC]
-        self._append_row(values)
+        return [data[k] for k in settings.DATA_SPEC]
+
+    def append(self, data):
+        self._append_rows([self._to_row(data)])
+
+    def append_many(self, data_list):
+        """Append several records with a single request."""
+        rows = [self._to_row(data) for data in data_list]
+        if rows:
+            self._append_rows(rows)
 
 
 def main():
@@ -0,0 +1,119 @@
+import numpy as np
+import settings
+from utils import log_warn
+
+
+class DataHistory:
+    """
+    Data records kept as typed columns (see settings.DATA_SPEC).
+
+    Date is stored as UTC epoch seconds (int64), other fields as float32
+    (NaN if a value is missing or not a number).
+    Columns grow by doubling, so appending is amortised O(1).
+    Records are expected in chronological order, which allows
+    time window lookups by binary search.
+    """
+
+    initial_capacity = 1024
+
+    def __init__(self):
+        self.size = 0
+        self.arrays = {}
+        for k in settings.DATA_SPEC:
+            dtype = np.int64 if k == 'date' else np.float32
+            self.arrays[k] = np.empty(self.initial_capacity, dtype=dtype)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.arrays.values())
+
+    def _reserve(self, size):
+        capacity = len(self.arrays['date'])
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for k, a in self.arrays.items():
+            grown = np.empty(capacity, dtype=a.dtype)
+            grown[:self.size] = a[:self.size]
+            self.arrays[k] = grown
+
+    @staticmethod
+    def _parse_dates(values):
+        """Epoch seconds, and a mask of the valid dates."""
+
+        # Drop the 'Z' suffix, numpy treats times without zone as UTC
+        try:
+            dates = np.array([v.rstrip('Z') for v in values], dtype='datetime64[s]')
+        except ValueError:
+            dates = np.empty(len(values), dtype='datetime64[s]')
+            for n, v in enumerate(values):
+                try:
+                    dates[n] = np.datetime64(v.rstrip('Z'), 's')
+                except ValueError:
+                    dates[n] = np.datetime64('NaT')
+        valid = ~np.isnat(dates)
+        return dates.astype(np.int64), valid
+
+    @staticmethod
+    def _parse_numbers(values):
+        try:
+            return np.array(values, dtype=np.float32)
+        except ValueError:
+            out = np.empty(len(values), dtype=np.float32)
+            for n, v in enumerate(values):
+                try:
+                    out[n] = float(v)
+                except ValueError:
+                    out[n] = np.nan
+            return out
+
+    def extend(self, rows):
+        """
+        Append rows of values ordered as in settings.DATA_SPEC
+        (e.g. as read from a sheet). A header row is skipped,
+        as well as rows with a missing or malformed date.
+        """
+
+        rows = [r for r in rows if r and r[0] != 'date']
+        dates, valid = self._parse_dates([r[0] for r in rows])
+        if not valid.all():
+            bad = [r[0] for r, ok in zip(rows, valid) if not ok]
+            log_warn('Skipped {} records with bad dates: {}'.format(len(bad), ', '.join(repr(d) for d in bad[:5])))
+            rows = [r for r, ok in zip(rows, valid) if ok]
+            dates = dates[valid]
+        if not rows:
+            return
+
+        start = self.size
+        end = start + len(rows)
+        self._reserve(end)
+
+        for i, k in enumerate(settings.DATA_SPEC):
+            if k == 'date':
+                self.arrays[k][start:end] = dates
+            else:
+                values = [r[i] if i < len(r) else '' for r in rows]
+                self.arrays[k][start:end] = self._parse_numbers(values)
+
+        self.size = end
+
+    def append(self, row):
+        self.extend([row])
+
+    def column(self, name):
+        """Column values as a view (no copy)."""
+        return self.arrays[name][:self.size]
+
+    def window(self, start=None, end=None):
+        """
+        Columns of records within [start, end) epoch seconds, as views.
+        """
+
+        dates = self.column('date')
+        first = 0 if start is None else np.searchsorted(dates, start, side='left')
+        last = self.size if end is None else np.searchsorted(dates, end, side='left')
+        return {k: a[first:last] for k, a in self.arrays.items()}
@@ -0,0 +1,70 @@
+import json
+import time
+import http.client
+import urllib.parse
+
+
+class KeepAliveConnection:
+    """
+    HTTP(S) connection kept open between requests.
+
+    The connection is reopened after a network error or timeout, and
+    the request is repeated once. Requests which are not idempotent (POST)
+    are only repeated if sending them failed: once sent, the server may
+    have handled them. Servers close idle connections, so a connection
+    idle for `max_idle` seconds is reopened before sending.
+    """
+
+    idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    max_idle = 15
+
+    def __init__(self, url, timeout=30):
+        self.url = urllib.parse.urlsplit(url)
+        self.timeout = timeout
+        self.connection = None
+        self.connects = 0
+        self.last_used = 0
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _connect(self):
+        if self.connection is not None and time.monotonic() - self.last_used > self.max_idle:
+            self.close()
+        if self.connection is None:
+            if self.url.scheme == 'https':
+                self.connection = http.client.HTTPSConnection(self.url.netloc, timeout=self.timeout)
+            else:
+                self.connection = http.client.HTTPConnection(self.url.netloc, timeout=self.timeout)
+            self.connects += 1
+        return self.connection
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Send a request, `body` is encoded as JSON if set.
+        Returns response status and data.
+        """
+
+        headers = dict(headers or {})
+        if body is not None:
+            # Bytes body is sent together with headers, avoiding Nagle delays
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        for attempt in (1, 2):
+            sent = False
+            try:
+                connection = self._connect()
+                connection.request(method, path, body, headers)
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+                self.last_used = time.monotonic()
+                return response.status, data
+            except (OSError, http.client.HTTPException):
+                self.close()
+                if attempt == 2 or (sent and method not in self.idempotent_methods):
+                    raise
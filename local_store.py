@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import calendar
+from datetime import datetime
+from utils import config_file_path
+import settings
+from settings import LOCAL_STORE_CONFIG
+
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def date_to_timestamp(date):
+    return calendar.timegm(datetime.strptime(date, DATE_FORMAT).timetuple())
+
+
+def timestamp_to_date(ts):
+    return datetime.utcfromtimestamp(ts).strftime(DATE_FORMAT)
+
+
+class LocalStore:
+    """
+    Local append-only store of data records (SQLite in WAL mode).
+
+    Records are keyed by an increasing id, in the order they were
+    appended. The clock may step back (there is no RTC and NTP sync may be
+    skipped), so timestamps are neither unique nor ordered. They are
+    indexed for time range queries. Values are stored exactly as given.
+
+    To limit SD card wear, WAL is not synced at each commit. It is synced
+    to the database file every `sync_every` appends (and at close).
+    A power loss can drop the unsynced records, but never corrupts the file.
+
+    Remote databases replicate from the store: each consumer has a
+    cursor, the id of the last record it has received.
+    """
+
+    def __init__(self, config):
+        self.file_path = config_file_path(config['file_name'])
+        self.sync_every = config['sync_every']
+        self.unsynced = 0
+        self.columns = [k for k in settings.DATA_SPEC if k != 'date']
+
+        # WAL files are created next to the database, on first use. Fail now,
+        # rather than when the first record is stored.
+        if not os.access(os.path.dirname(self.file_path), os.W_OK):
+            raise Exception(self._not_writable_message('directory is not writable'))
+
+        try:
+            self.db = sqlite3.connect(self.file_path)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            # Checkpoints are done explicitly
+            self.db.execute('PRAGMA wal_autocheckpoint=0')
+
+            columns = [r[1] for r in self.db.execute('PRAGMA table_info(records)')]
+            if columns and 'id' not in columns:
+                self._migrate_timestamp_keys()
+            else:
+                self.db.executescript(self._schema())
+        except sqlite3.Error as e:
+            raise Exception(self._not_writable_message(e))
+
+    def _schema(self, records='records', cursors='cursors'):
+        return '''
+            CREATE TABLE IF NOT EXISTS {records} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, ts INTEGER NOT NULL, {columns});
+            CREATE INDEX IF NOT EXISTS {records}_ts ON {records} (ts);
+            CREATE TABLE IF NOT EXISTS {cursors} (name TEXT PRIMARY KEY, id INTEGER NOT NULL);
+        '''.format(records=records, cursors=cursors, columns=', '.join(self.columns))
+
+    def _migrate_timestamp_keys(self):
+        """Stores used to be keyed, and cursors set, by record timestamp."""
+
+        columns = ', '.join(['ts'] + self.columns)
+        self.db.executescript('''
+            BEGIN;
+            ALTER TABLE records RENAME TO records_by_ts;
+            ALTER TABLE cursors RENAME TO cursors_by_ts;
+            {schema}
+            INSERT INTO records ({columns}) SELECT {columns} FROM records_by_ts ORDER BY ts;
+            INSERT INTO cursors SELECT name, (SELECT COALESCE(MAX(id), 0) FROM records
+                                              WHERE records.ts <= cursors_by_ts.ts) FROM cursors_by_ts;
+            DROP TABLE records_by_ts;
+            DROP TABLE cursors_by_ts;
+            COMMIT;
+        '''.format(schema=self._schema(), columns=columns))
+
+    def _not_writable_message(self, reason):
+        return ('Cannot open local store %s (%s), set LOCAL_STORE_CONFIG[\'file_name\'] '
+                'to a path on a writable persistent file system' % (self.file_path, reason))
+
+    def close(self):
+        self.sync()
+        self.db.close()
+
+    def sync(self):
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.unsynced = 0
+
+    def append(self, data):
+        if len(data) != len(settings.DATA_SPEC):
+            raise Exception('Invalid data fields count')
+
+        values = [date_to_timestamp(data['date'])] + [data[k] for k in self.columns]
+        with self.db:
+            self.db.execute('INSERT INTO records ({}) VALUES ({})'.format(
+                ', '.join(['ts'] + self.columns), ', '.join('?' * len(values))), values)
+
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def _to_data(self, row):
+        data = dict(zip(self.columns, row[2:]))
+        data['date'] = timestamp_to_date(row[1])
+        return data
+
+    def query(self, start=None, end=None, limit=None):
+        """
+        Records within [start, end) timestamps range, ordered by time.
+        """
+
+        sql = 'SELECT * FROM records WHERE ts >= ? AND ts < ? ORDER BY ts, id'
+        args = [start if start is not None else 0, end if end is not None else 1 << 62]
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        return [self._to_data(row) for row in self.db.execute(sql, args)]
+
+    def last_id(self):
+        row = self.db.execute('SELECT MAX(id) FROM records').fetchone()
+        return row[0] if row[0] is not None else 0
+
+    def last_timestamp(self):
+        row = self.db.execute('SELECT MAX(ts) FROM records').fetchone()
+        return row[0] if row[0] is not None else 0
+
+    def register_consumer(self, name):
+        """
+        Create a cursor for a new consumer, starting after the latest record.
+        """
+
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO cursors VALUES (?, ?)', (name, self.last_id()))
+
+    def cursor(self, name):
+        row = self.db.execute('SELECT id FROM cursors WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            raise Exception('Unknown consumer "%s"' % name)
+        return row[0]
+
+    def pending_count(self, name):
+        row = self.db.execute('SELECT COUNT(*) FROM records WHERE id > ?', (self.cursor(name),)).fetchone()
+        return row[0]
+
+    def _pending(self, name, limit=None):
+        """(id, record) the consumer has not received yet, in append order."""
+
+        sql = 'SELECT * FROM records WHERE id > ? ORDER BY id'
+        args = [self.cursor(name)]
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        return [(row[0], self._to_data(row)) for row in self.db.execute(sql, args)]
+
+    def pending(self, name, limit=None):
+        return [data for _, data in self._pending(name, limit)]
+
+    def acknowledge(self, name, record_id):
+        """Set the consumer cursor, records up to `record_id` were received."""
+        with self.db:
+            self.db.execute('UPDATE cursors SET id = ? WHERE name = ?', (record_id, name))
+
+    def replicate(self, name, append):
+        """
+        Pass records the consumer has not received yet to `append`, oldest first.
+        The cursor is advanced after each successful call.
+        """
+
+        for record_id, data in self._pending(name):
+            append(data)
+            self.acknowledge(name, record_id)
+
+    def replicate_batch(self, name, append_many, batch_size=500):
+        """
+        Pass records the consumer has not received yet to `append_many`
+        in lists of up to `batch_size` records.
+
+        `append_many` may return the number of leading records it sent
+        (None means all of them). The cursor is advanced past the sent
+        records only. Returns False if some records were not sent.
+        """
+
+        while True:
+            batch = self._pending(name, limit=batch_size)
+            if not batch:
+                return True
+            sent = append_many([data for _, data in batch])
+            if sent is None:
+                sent = len(batch)
+            if sent > 0:
+                self.acknowledge(name, batch[sent - 1][0])
+            if sent < len(batch):
+                return False
+
+
+def main():
+    s = LocalStore(LOCAL_STORE_CONFIG)
+    for data in s.query(start=s.last_timestamp() - 24 * 3600):
+        print(' '.join(str(data[k]) for k in settings.DATA_SPEC))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+from bisect import bisect_left
+
+
+class Counter:
+    """Value which only goes up, e.g. a count of events (named *_total)."""
+
+    type = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Gauge:
+    """Value which goes up and down, e.g. a queue length."""
+
+    type = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Histogram:
+    """
+    Distribution of observed values in fixed buckets,
+    memory does not depend on the observations count.
+    """
+
+    type = 'histogram'
+
+    # Upper bounds of buckets, in seconds
+    default_buckets = (0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        # Last one counts values above the largest bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing its duration."""
+        return Timer(self)
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+
+        out = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            out.append((name + '_bucket', labels + (('le', format_value(bound)),), cumulative))
+        out.append((name + '_sum', labels, total))
+        out.append((name + '_count', labels, cumulative))
+        return out
+
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    """
+    Metric family: one metric of `kind` per set of label values.
+
+    Label sets are limited to `max_label_sets`, so memory stays bounded
+    even if labels are misused, e.g. for error messages. Further label
+    sets are merged into one with all values set to `overflow_value`.
+    """
+
+    max_label_sets = 64
+
+    overflow_value = 'other'
+
+    def __init__(self, kind, name, help, label_names=(), **kwargs):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.kwargs = kwargs
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        """Metric of label values, given in `label_names` order."""
+
+        child = self.children.get(values)
+        if child is not None:
+            return child
+
+        if len(values) != len(self.label_names):
+            raise Exception('Metric %s expects labels %s' % (self.name, ', '.join(self.label_names)))
+        with self.lock:
+            if values not in self.children:
+                if len(self.children) >= self.max_label_sets:
+                    values = (self.overflow_value,) * len(values)
+                    if values in self.children:
+                        return self.children[values]
+                self.children[values] = self.kind(**self.kwargs)
+            return self.children[values]
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind.type)]
+        for values, child in list(self.children.items()):
+            for name, labels, value in child.samples(self.name, tuple(zip(self.label_names, values))):
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join('%s="%s"' % (k, v) for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """
+    Named metrics, exported in the Prometheus text format.
+    Getting a registered metric again returns the same one.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, kind, name, help, label_names, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = Metric(kind, name, help, label_names, **kwargs)
+            elif metric.kind is not kind or metric.label_names != tuple(label_names):
+                raise Exception('Metric %s is already registered differently' % name)
+
+        # Unlabelled metrics are used directly
+        return metric.labels() if not label_names else metric
+
+    def counter(self, name, help, label_names=()):
+        return self._get(Counter, name, help, label_names)
+
+    def gauge(self, name, help, label_names=()):
+        return self._get(Gauge, name, help, label_names)
+
+    def histogram(self, name, help, label_names=(), buckets=None):
+        return self._get(Histogram, name, help, label_names, buckets=buckets)
+
+    def expose(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return ''.join(m.expose() + '\n' for m in metrics)
+
+
+# Metrics of this process
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    """
+    HTTP server of the registry metrics at /metrics, for Prometheus to scrape.
+    """
+
+    def __init__(self, host, port, registry=REGISTRY):
+        # Only the controller serves metrics, keep imports of instrumented modules fast
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.expose().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes are frequent, keep them out of the log
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    latency = REGISTRY.histogram('demo_sleep_seconds', 'Duration of a sleep', ['duration'])
+    sleeps = REGISTRY.counter('demo_sleeps_total', 'Sleeps taken')
+    for duration in (0.001, 0.01, 0.1):
+        for _ in range(3):
+            with latency.labels(str(duration)).time():
+                time.sleep(duration)
+            sleeps.inc()
+    print(REGISTRY.expose())
+
+
+if __name__ == '__main__':
+    main()
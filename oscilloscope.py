@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
 
-import sys
+import abc
+import time
+import struct
+import argparse
 from math import ceil
-from adc_rpc import ADCClient, ADCTestSignalClient
-from scipy import fftpack
 import numpy as np
-import matplotlib.pyplot as pyplot
-import matplotlib.animation as animation
+from adc_rpc import ADCServer, ADCClient, ADCTestSignalClient
 
 
 def round_to_multiple(x, multiple):
@@ -17,88 +17,421 @@ def ceil_to_multiple(x, multiple):
     return ceil(x / multiple) * multiple
 
 
-class Oscilloscope:
+class FrameProcessor:
+    """
+    Compute the plotted data of a frame into preallocated buffers.
+
+    Frames longer than `max_points` are decimated for plotting:
+    the signal to min and max of each chunk, so short spikes stay
+    visible, and the spectrum to the peak of each chunk.
+    """
+
+    def __init__(self, sampling_frequency_Hz, samples_count, max_points):
+        count = samples_count
+        duration_ms = 1000 * count / sampling_frequency_Hz
+
+        self.samples_mV = np.zeros(count)
+        self.centered_mV = np.zeros(count)
+        self.window = np.hanning(count)
+
+        self.x_time = np.linspace(0, duration_ms, count, endpoint=False)
+        self.x_freq = np.fft.rfftfreq(count, 1 / sampling_frequency_Hz)
+        self.spectrum = np.zeros(len(self.x_freq))
+
+        self.time_edges = None
+        self.plot_x_time = self.x_time
+        self.plot_time = self.samples_mV
+        if count > max_points:
+            bins = max_points // 2
+            self.time_edges = np.linspace(0, count, bins, endpoint=False).astype(int)
+            self.plot_x_time = np.repeat(self.x_time[self.time_edges], 2)
+            self.plot_time = np.zeros(2 * bins)
+
+        self.freq_edges = None
+        self.plot_x_freq = self.x_freq
+        self.plot_freq = self.spectrum
+        if len(self.x_freq) > max_points:
+            self.freq_edges = np.linspace(0, len(self.x_freq), max_points, endpoint=False).astype(int)
+            self.plot_x_freq = self.x_freq[self.freq_edges]
+            self.plot_freq = np.zeros(max_points)
+
+    def process(self, samples_V):
+        """
+        Update plot buffers with new samples.
+        Returns mean and standard deviation of the samples in mV.
+        """
+
+        np.multiply(samples_V, 1000, out=self.samples_mV)
+        mean_mV = self.samples_mV.mean()
+        dev_mV = self.samples_mV.std()
+
+        np.subtract(self.samples_mV, mean_mV, out=self.centered_mV)
+        self.centered_mV *= self.window
+        np.abs(np.fft.rfft(self.centered_mV), out=self.spectrum)
+        peak = self.spectrum.max()
+        if peak > 0:
+            self.spectrum /= peak
+
+        if self.time_edges is not None:
+            np.minimum.reduceat(self.samples_mV, self.time_edges, out=self.plot_time[0::2])
+            np.maximum.reduceat(self.samples_mV, self.time_edges, out=self.plot_time[1::2])
+        if self.freq_edges is not None:
+            np.maximum.reduceat(self.spectrum, self.freq_edges, out=self.plot_freq)
+
+        return mean_mV, dev_mV
+
+
+class Spectrogram:
+    """
+    Short-time spectrum of a sample stream, computed incrementally.
+
+    Windows of `window_size` samples overlap, a new one starts every
+    `hop` samples. The last `history` spectra (in dB re 1 mV amplitude)
+    are kept in a preallocated array, so memory does not grow with time.
+    """
+
+    floor_dB = -60
+
+    def __init__(self, sampling_frequency_Hz, window_size=256, hop=64, history=600):
+        self.sampling_frequency_Hz = sampling_frequency_Hz
+        self.hop = hop
+        self.window = np.hanning(window_size)
+        # Amplitude of a sine matching the window bin
+        self.scale = 2 / self.window.sum()
+        self.x_freq = np.fft.rfftfreq(window_size, 1 / sampling_frequency_Hz)
+
+        self.samples_mV = np.zeros(window_size)
+        self.windowed_mV = np.zeros(window_size)
+        self.received = 0
+        self.since_hop = 0
+
+        self.rows = np.full((history, len(self.x_freq)), self.floor_dB, dtype=np.float32)
+        self.row = 0
+        self.spectra = 0
+        self.display = np.full_like(self.rows, self.floor_dB)
+        self.order = np.arange(history)
+
+    def feed(self, samples_V):
+        """Add samples, spectra are computed for each completed hop."""
+
+        samples_V = np.asarray(samples_V)
+        size = len(self.samples_mV)
+        n = 0
+        while n < len(samples_V):
+            take = min(self.hop - self.since_hop, len(samples_V) - n)
+            self.samples_mV[:size - take] = self.samples_mV[take:]
+            np.multiply(samples_V[n:n + take], 1000, out=self.samples_mV[size - take:])
+            n += take
+            self.received += take
+            self.since_hop += take
+
+            if self.since_hop == self.hop:
+                self.since_hop = 0
+                if self.received >= size:
+                    self._add_spectrum()
+
+    def _add_spectrum(self):
+        np.subtract(self.samples_mV, self.samples_mV.mean(), out=self.windowed_mV)
+        self.windowed_mV *= self.window
+        amplitude = np.abs(np.fft.rfft(self.windowed_mV)) * self.scale
+        np.maximum(amplitude, 10 ** (self.floor_dB / 20), out=amplitude)
+        self.rows[self.row] = 20 * np.log10(amplitude)
+        self.row = (self.row + 1) % len(self.rows)
+        self.spectra += 1
+
+    def image(self):
+        """Spectra history, the newest one in the first row."""
+        np.take(self.rows, (self.row - 1 - self.order) % len(self.rows), axis=0, out=self.display)
+        return self.display
+
+
+class FrameRecorder:
+    """
+    Append raw frames to a file, to replay them with FrameReplay.
+    Each frame is a header (sequence number, timestamp, sampling
+    frequency, samples count) followed by samples in volts.
+    """
+
+    header = struct.Struct('<QddI')
+    dtype = '<f4'
+
+    def __init__(self, file_name):
+        self.file = open(file_name, 'ab')
+
+    def close(self):
+        self.file.close()
+
+    def write(self, sequence, timestamp, sampling_frequency_Hz, samples_V):
+        samples = np.asarray(samples_V, dtype=self.dtype)
+        self.file.write(self.header.pack(sequence, timestamp, sampling_frequency_Hz, len(samples)))
+        self.file.write(samples.tobytes())
+
+
+class FrameReplay:
+    """
+    ADC client stand-in returning frames recorded by FrameRecorder.
+
+    Frames are returned in recorded order, at the recorded pace if
+    `realtime` is set. EOFError is raised at the end of the recording.
+    Requesting 0 samples returns the next frame empty, without consuming it.
+    """
+
+    def __init__(self, file_name, realtime=True):
+        self.file = open(file_name, 'rb')
+        self.realtime = realtime
+        self.start = None
+        self.next_frame = self._read()
+
+    def _read(self):
+        data = self.file.read(FrameRecorder.header.size)
+        if len(data) < FrameRecorder.header.size:
+            return None
+        sequence, timestamp, sampling_frequency_Hz, count = FrameRecorder.header.unpack(data)
+        samples_V = np.frombuffer(self.file.read(4 * count), dtype=FrameRecorder.dtype)
+        return sequence, timestamp, sampling_frequency_Hz, samples_V
+
+    def get_since_V(self, sequence, max_count):
+        frame = self.next_frame
+        if frame is None:
+            raise EOFError('End of recording')
+
+        if max_count == 0:
+            return frame[0], frame[1], frame[2], frame[3][:0]
+
+        if self.realtime:
+            if self.start is None:
+                self.start = (time.monotonic(), frame[1])
+            if time.monotonic() - self.start[0] < frame[1] - self.start[1]:
+                # Not yet due, return no samples
+                return frame[0], frame[1], frame[2], frame[3][:0]
+
+        self.next_frame = self._read()
+        return frame
+
+
+class LivePlot(abc.ABC):
+    """
+    Figure updated by a timer.
+
+    Only animated artists are redrawn for each frame (blitting) over
+    a cached background, the full figure is redrawn on axes changes.
+    Frame rate is printed with a status line once in `status_interval`.
+    """
+
+    # Interval between status lines, in seconds
+    status_interval = 1
+
+    def __init__(self, figure, artists, interval_ms):
+        self.figure = figure
+        self.artists = artists
+        self.background = None
+        figure.canvas.mpl_connect('draw_event', self._on_draw)
+
+        self.frames = 0
+        self.status_time = time.monotonic()
+        self.status = ''
+
+        self.timer = figure.canvas.new_timer(interval=interval_ms)
+        self.timer.add_callback(self._tick)
+        self.timer.start()
+
+    def _on_draw(self, event):
+        # Full redraw, e.g. on resize, cache the background without artists
+        self.background = self.figure.canvas.copy_from_bbox(self.figure.bbox)
+        for a in self.artists:
+            self.figure.draw_artist(a)
+
+    def _blit(self):
+        canvas = self.figure.canvas
+        canvas.restore_region(self.background)
+        for a in self.artists:
+            self.figure.draw_artist(a)
+        canvas.blit(self.figure.bbox)
+        canvas.flush_events()
+
+    def _tick(self):
+        if self.background is not None:
+            self._update()
+
+    @abc.abstractmethod
+    def _update(self):
+        """Update the artists with the next frame, and blit them."""
+
+    def _count_frame(self, status):
+        self.frames += 1
+        self.status = status
+
+        now = time.monotonic()
+        elapsed = now - self.status_time
+        if elapsed >= self.status_interval:
+            print('%s, %.1f FPS' % (self.status, self.frames / elapsed))
+            self.frames = 0
+            self.status_time = now
+
+
+class Oscilloscope(LivePlot):
+    """
+    Live plot of the signal and its spectrum.
+    """
+
     voltage_scale_step_mV = 50
 
-    def __init__(self, adc, sampling_frequency_Hz, samples_count, autoscale):
+    def __init__(self, adc, sampling_frequency_Hz, samples_count, autoscale, interval_ms=10):
+        import matplotlib.pyplot as pyplot
+
         self.adc = adc
         self.sampling_frequency_Hz = sampling_frequency_Hz
         self.samples_count = samples_count
         self.autoscale = autoscale
 
-        # Shorten var names
-        count = self.samples_count
-        duration_mS = 1000 * count / sampling_frequency_Hz
-
-        self.x_time = np.linspace(0, duration_mS, count)
-        self.x_freq = np.linspace(0, sampling_frequency_Hz / 2, count // 2)
-
         figure, (ax_time, ax_freq) = pyplot.subplots(2)
         self.ax_time = ax_time
 
+        # No point in plotting more points than there are pixels
+        width_px = int(figure.get_figwidth() * figure.dpi)
+        self.frame = FrameProcessor(sampling_frequency_Hz, samples_count, max_points=width_px)
+        duration_ms = 1000 * samples_count / sampling_frequency_Hz
+
         ax_time.set_xlabel('Time, ms')
-        ax_time.set_xlim([0, duration_mS])
+        ax_time.set_xlim([0, duration_ms])
         ax_time.set_ylabel('Voltage, mV')
         ax_time.set_ylim([0, 2500])
-        self.plot_time, = ax_time.plot(self.x_time, np.zeros(count))
+        self.plot_time, = ax_time.plot(self.frame.plot_x_time, self.frame.plot_time, animated=True)
 
         ax_freq.set_xlabel('Frequency, Hz')
         ax_freq.set_xlim([0, sampling_frequency_Hz / 2])
         ax_freq.set_ylabel('Norm. spectral density')
         ax_freq.set_ylim([0, 1])
-        self.plot_freq, = ax_freq.plot(self.x_freq, np.zeros(count // 2))
+        self.plot_freq, = ax_freq.plot(self.frame.plot_x_freq, self.frame.plot_freq, animated=True)
 
-        self.animation = animation.FuncAnimation(figure, self._animate, None, interval=25)
+        super().__init__(figure, (self.plot_time, self.plot_freq), interval_ms)
 
-    def show(self):
-        pyplot.show()
+    def _acquire(self):
+        """Returns samples and a description of sampling quality."""
 
-    def _animate(self, i):
-        # Shorten var names
-        sampling_frequency_Hz = self.sampling_frequency_Hz
-        count = self.samples_count
+        if hasattr(self.adc, 'get_capture_V'):
+            # FFT assumes uniform sampling, resample with actual sample times
+            capture = self.adc.get_capture_V(self.sampling_frequency_Hz, self.samples_count, resample_uniform=True)
+            jitter = ', jitter max %.0f us, rms %.0f us' % (
+                capture['jitter_max_s'] * 1e6, capture['jitter_rms_s'] * 1e6)
+            return capture['samples_V'], jitter
 
+        return self.adc.get_samples_V(self.sampling_frequency_Hz, self.samples_count), ''
+
+    def _update(self):
         try:
-            samples_V = self.adc.get_samples_V(sampling_frequency_Hz, count)
+            samples_V, jitter = self._acquire()
         except Exception as e:
             print(e)
-            return self._clear()
-
-        samples_mV = np.array(samples_V) * 1000
-
-        mean_mV = np.mean(samples_mV)
-        dev_mV = np.std(samples_mV)
-
-        print('(%3.0f ± %2.0f) mV' % (mean_mV, dev_mV))
-
-        fft = np.abs(fftpack.fft(samples_mV - mean_mV)[:count // 2])
-        fft /= max(fft)
+            self._clear()
+            self._blit()
+            return
 
-        self.plot_time.set_ydata(samples_mV)
-        self.plot_freq.set_ydata(fft)
+        mean_mV, dev_mV = self.frame.process(samples_V)
+        self.plot_time.set_ydata(self.frame.plot_time)
+        self.plot_freq.set_ydata(self.frame.plot_freq)
+        self._count_frame('(%3.0f ± %2.0f) mV%s' % (mean_mV, dev_mV, jitter))
 
         if self.autoscale:
             self.autoscale = False
             center_mV = round_to_multiple(mean_mV, self.voltage_scale_step_mV)
             span_mV = 3 * ceil_to_multiple(dev_mV, self.voltage_scale_step_mV)
             self.ax_time.set_ylim([center_mV - span_mV, center_mV + span_mV])
+            # Axes changed, the cached background is redrawn
+            self.figure.canvas.draw()
+            return
 
-        return self.plot_time, self.plot_freq
+        self._blit()
 
     def _clear(self):
-        self.plot_time.set_ydata(np.ma.array(self.x_time, mask=True))
-        self.plot_freq.set_ydata(np.ma.array(self.x_freq, mask=True))
-        return self.plot_time, self.plot_freq
+        self.plot_time.set_ydata(np.ma.masked_all(len(self.frame.plot_time)))
+        self.plot_freq.set_ydata(np.ma.masked_all(len(self.frame.plot_freq)))
+
+
+class Waterfall(LivePlot):
+    """
+    Scrolling spectrogram of the continuous sample stream
+    (see ADCServer.get_since_V), the newest spectrum on top.
+
+    Frames are optionally saved by `recorder` (a FrameRecorder).
+    """
+
+    # Maximal samples fetched per update, in seconds of signal
+    max_fetch = 1
+
+    def __init__(self, adc, window_size=256, hop=64, history=600, recorder=None, interval_ms=20):
+        import matplotlib.pyplot as pyplot
+
+        self.adc = adc
+        self.recorder = recorder
+
+        # First frame tells the sampling frequency
+        sequence, timestamp, sampling_frequency_Hz, samples_V = adc.get_since_V(0, 0)
+        self.sequence = sequence
+        self.dropped = 0
+        self.spectrogram = Spectrogram(sampling_frequency_Hz, window_size, hop, history)
+        self.max_count = int(sampling_frequency_Hz * self.max_fetch)
+
+        figure, ax = pyplot.subplots()
+        history_s = history * hop / sampling_frequency_Hz
+        ax.set_xlabel('Frequency, Hz')
+        ax.set_ylabel('Age, s')
+        self.image = ax.imshow(self.spectrogram.image(), aspect='auto', animated=True,
+                               extent=[0, sampling_frequency_Hz / 2, history_s, 0],
+                               vmin=Spectrogram.floor_dB, vmax=20 * np.log10(2500))
+        figure.colorbar(self.image, ax=ax, label='Amplitude, dB re 1 mV')
+
+        super().__init__(figure, (self.image,), interval_ms)
+
+    def _update(self):
+        try:
+            sequence, timestamp, sampling_frequency_Hz, samples_V = \
+                self.adc.get_since_V(self.sequence, self.max_count)
+        except EOFError as e:
+            print(e)
+            self.timer.stop()
+            return
+        except Exception as e:
+            print(e)
+            return
+
+        if sequence > self.sequence:
+            # Samples were overwritten before they were fetched
+            self.dropped += sequence - self.sequence
+        self.sequence = sequence + len(samples_V)
+
+        if self.recorder is not None and len(samples_V) > 0:
+            self.recorder.write(sequence, timestamp, sampling_frequency_Hz, samples_V)
+
+        self.spectrogram.feed(samples_V)
+        self.image.set_data(self.spectrogram.image())
+        self._count_frame('%d spectra, %d samples dropped' % (self.spectrogram.spectra, self.dropped))
+        self._blit()
 
 
 def main():
-    if len(sys.argv) < 2:
+    parser = argparse.ArgumentParser(description='Live plot of the ADC signal.')
+    parser.add_argument('host', nargs='?', help='ADC server address, a test signal is shown if omitted')
+    parser.add_argument('--waterfall', action='store_true', help='show a scrolling spectrogram')
+    parser.add_argument('--record', metavar='FILE', help='append raw frames to a file (waterfall only)')
+    parser.add_argument('--replay', metavar='FILE', help='replay recorded frames (waterfall only)')
+    args = parser.parse_args()
+
+    if args.replay is not None:
+        adc = FrameReplay(args.replay)
+    elif args.host is None:
         adc = ADCTestSignalClient(frequency_Hz=50, offset_V=1.25, amplitude_V=0.1)
     else:
-        adc = ADCClient(host=sys.argv[1])
+        adc = ADCClient(host=args.host, stream_port=ADCServer.stream_port)
+
+    if args.waterfall or args.replay is not None:
+        recorder = FrameRecorder(args.record) if args.record is not None else None
+        plot = Waterfall(adc, recorder=recorder)
+    else:
+        plot = Oscilloscope(adc, sampling_frequency_Hz=500, samples_count=256, autoscale=True)
 
-    osc = Oscilloscope(adc, sampling_frequency_Hz=500, samples_count=256, autoscale=True)
-    osc.show()
+    import matplotlib.pyplot as pyplot
+    pyplot.show()
 
 
 if __name__ == '__main__':
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
+import numpy as np
 from settings import UR, PH_CONFIG
+from utils import split_uncertainty
 from adc import MCP3221, ADCFilter
 from temperature import TemperatureInterface, ConstTemperatureInterface
 
@@ -14,6 +16,24 @@ class PHTheory:
     Voffset = V_pH7 + V_ADC_Offset
     """
 
+    # Properties of this Universe
+    gas_const = 8.3144
+    faraday_const = 96485
+    ln_10 = 2.3026
+
+    # Valid temperature range, in K
+    temp_range_K = (273.15, 373.15)
+
+    @staticmethod
+    def ideal_slope_V_pH(temp_K):
+        """Slope of the ideal pH electrode for a temperature in K, in V/pH (float)"""
+
+        # Make sure value is valid
+        if not PHTheory.temp_range_K[0] <= temp_K <= PHTheory.temp_range_K[1]:
+            raise Exception('Temperature is out of range')
+
+        return PHTheory.gas_const * temp_K * PHTheory.ln_10 / PHTheory.faraday_const
+
     @staticmethod
     def ideal_slope(temp):
         """Slope of the ideal pH electrode, in V/pH"""
@@ -22,13 +42,8 @@ class PHTheory:
         if temp < 0 * UR.degC or temp > 100 * UR.degC:
             raise Exception('Temperature is out of range')
 
-        # Properties of this Universe
-        gas_const = 8.3144
-        faraday_const = 96485
-        ln_10 = 2.3026
-
         temp_K = temp.to('degK').magnitude
-        slope_V_pH = gas_const * temp_K * ln_10 / faraday_const
+        slope_V_pH = PHTheory.gas_const * temp_K * PHTheory.ln_10 / PHTheory.faraday_const
 
         return slope_V_pH * UR.volt / UR.pH
 
@@ -56,24 +71,48 @@ class PHTheory:
 class PHCalibration:
     """
     pH electrode calibration.
+
+    Slope and offset are fitted to two or more buffer points by least
+    squares. Points are weighted by the inverse variance of their
+    voltage if all of them have uncertainty, equally otherwise. Quality of the fit
+    is the RMS of residuals, in pH.
+
+    Calibration is converted to floats once, so that pH computation
+    does not involve pint arithmetic (see PHTheory.compute_ph for the reference).
+    Temperature compensation is a division by the temperature in K.
     """
 
     # Acceptable electrode properties
     max_slope_drift = 0.2
     max_offset_drift = 30 * UR.mV
+    max_residual = 0.1 * UR.pH
 
     def __init__(self, adc_offset, temp, points):
-        if len(points) != 2:
-            raise Exception('Only two point calibration is supported')
-
-        self.slope = PHTheory.compute_slope(
-            temp,
-            points[0]['ph'], points[0]['v'],
-            points[1]['ph'], points[1]['v'])
-
-        self.offset = PHTheory.compute_offset(
-            temp, self.slope,
-            points[0]['ph'], points[0]['v'])
+        if len(points) < 2:
+            raise Exception('At least two calibration points are required')
+
+        ph = np.array([p['ph'].m_as(UR.pH) for p in points])
+        v, v_dev = zip(*(split_uncertainty(p['v'], UR.V) for p in points))
+        v = np.array(v)
+        if all(v_dev):
+            weights = 1 / np.array(v_dev) ** 2
+        else:
+            weights = np.ones(len(points))
+        if np.ptp(ph) == 0:
+            raise Exception('Calibration points must have different pH')
+
+        # Weighted least squares fit of v = a + b * pH
+        weights /= weights.sum()
+        ph_mean = np.dot(weights, ph)
+        v_mean = np.dot(weights, v)
+        b = np.dot(weights, (ph - ph_mean) * (v - v_mean)) / np.dot(weights, (ph - ph_mean) ** 2)
+        a = v_mean - b * ph_mean
+        self.residuals_pH = (v - (a + b * ph)) / abs(b)
+        self.residual_pH = float(np.sqrt(np.dot(weights, self.residuals_pH ** 2)))
+
+        self.slope = float(-b / PHTheory.ideal_slope_V_pH(temp.m_as(UR.degK))) * UR.dimensionless
+        self.offset = float(a + 7 * b) * UR.V
+        self.residual = self.residual_pH * UR.pH
 
         # Check slope
         if abs(self.slope - 1) > self.max_slope_drift:
@@ -84,27 +123,75 @@ class PHCalibration:
         if abs(offset) > self.max_offset_drift:
             raise Exception('pH electrode offset {:~.0f} is unacceptable'.format(offset.to('mV')))
 
-        print('pH electrode slope={:~.2f} offset={:~.0f}'.format(self.slope, offset.to('mV')))
+        # Check fit
+        if self.residual > self.max_residual:
+            raise Exception('pH calibration residual {:~.2f} is unacceptable'.format(self.residual))
+
+        print('pH electrode slope={:~.2f} offset={:~.0f} residual={:~.3f}'.format(
+            self.slope, offset.to('mV'), self.residual))
+
+        self.offset_V = self.offset.m_as('V')
+        self.slope_value = self.slope.m_as('dimensionless')
+        # pH per volt is k_K / T
+        self.k_K = PHTheory.faraday_const / (self.slope_value * PHTheory.gas_const * PHTheory.ln_10)
+
+        # Parsing units is expensive, keep them
+        self.unit_K = UR.degK
+        self.unit_degC = UR.degC
+        self.unit_V = UR.V
+        self.unit_pH = UR.pH
+
+    def compute_ph_values(self, temp_K, v_V):
+        """
+        pH of floats or arrays of temperatures in K and voltages in V.
+        Returns (pH, pH per volt).
+        """
+
+        low, high = PHTheory.temp_range_K
+        if np.ndim(temp_K) == 0:
+            if not low <= temp_K <= high:
+                raise Exception('Temperature is out of range')
+        elif np.min(temp_K) < low or np.max(temp_K) > high:
+            raise Exception('Temperature is out of range')
+
+        k = self.k_K / temp_K
+        return 7 + (self.offset_V - v_V) * k, k
 
     def compute_ph(self, temp, v):
-        return PHTheory.compute_ph(temp, self.offset, self.slope, v)
+        # Offset units conversion by pint is slow, sensors report degC
+        if temp.units == self.unit_degC:
+            temp_K = temp.magnitude + 273.15
+        else:
+            temp_K = temp.m_as(self.unit_K)
+        v_V, v_dev_V = split_uncertainty(v, self.unit_V)
+
+        ph, k = self.compute_ph_values(temp_K, v_V)
+
+        if v_dev_V is None:
+            return ph * self.unit_pH
+        return UR.Measurement(ph, abs(k) * v_dev_V, self.unit_pH)
 
 
 class PHInterface:
     """
     Complete pH electrode interface with
     calibration and temperature compensation.
+
+    I2C bus and temperature service can be given, e.g. fakes to run without hardware.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, i2c=None, temperature_service=None):
         adc = MCP3221(
             i2c_busn=config['adc']['i2c_busn'],
             i2c_addr=config['adc']['i2c_addr'],
-            v_ref=config['adc']['v_ref'])
+            v_ref=config['adc']['v_ref'],
+            i2c=i2c,
+            sampling_time=config['adc'].get('sampling_time'))
 
         self.adc = ADCFilter(
             adc=adc,
-            samples_count=config['adc']['filter_samples'])
+            samples_count=config['adc']['filter_samples'],
+            estimator=config['adc']['filter_estimator'])
 
         self.calibration = PHCalibration(
             adc_offset=config['adc']['v_off'],
@@ -112,14 +199,20 @@ class PHInterface:
             points=config['calibration']['points'])
 
         if 'device_id' in config['temperature']:
-            self.temperature = TemperatureInterface(config['temperature']['device_id'])
+            self.temperature = TemperatureInterface(config['temperature']['device_id'], temperature_service)
         else:
             self.temperature = ConstTemperatureInterface(config['temperature']['value'])
 
+    def get_voltage(self):
+        return self.adc.get_voltage()
+
+    def compute_ph(self, temperature, voltage):
+        return self.calibration.compute_ph(temperature, voltage)
+
     def get_t_v_ph(self):
         temperature = self.temperature.get_temperature()
-        voltage = self.adc.get_voltage()
-        ph = self.calibration.compute_ph(temperature, voltage)
+        voltage = self.get_voltage()
+        ph = self.compute_ph(temperature, voltage)
         return temperature, voltage, ph
 
 
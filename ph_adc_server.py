@@ -10,7 +10,8 @@ def main():
                   i2c_addr=PH_CONFIG['adc']['i2c_addr'],
                   v_ref=PH_CONFIG['adc']['v_ref'])
 
-    server = ADCServer(adc)
+    # Sample continuously, so clients share the samples
+    server = ADCServer(adc, sampling_frequency_Hz=1000)
     server.serve_forever()
 
 
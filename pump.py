@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import sys
-import RPi.GPIO as GPIO
-from utils import delay
+import heapq
+import numpy as np
+from math import sqrt
+from timer import PrecisionTimer
 from settings import UR, PUMP_X_CONFIG, PUMP_Y_CONFIG
 
 
@@ -16,42 +18,191 @@ class PumpInterface:
         step_freq = max_frequency * UR.turn / step_angle
         return 1 / step_freq
 
-    def __init__(self, config):
+    def __init__(self, config, gpio=None):
+        if gpio is None:
+            import RPi.GPIO as gpio
+
+        self.gpio = gpio
         self.gpio_sleep = config['gpio_sleep']
         self.gpio_step = config['gpio_step']
         self.wake_up_time_s = config['wake_up_time'].m_as('s')
+        self.ramp_time_s = config['ramp_time'].m_as('s')
         self.steps_per_volume = config['steps_per_volume']
         self.microsteps = config['microsteps']
         self.step_period_s = self._get_step_period(
             step_angle=config['step_angle'], max_frequency=config['max_frequency']).m_as('s')
 
-        GPIO.setmode(GPIO.BCM)
+        gpio.setmode(gpio.BCM)
 
-        GPIO.setup(self.gpio_sleep, GPIO.OUT)
-        GPIO.setup(self.gpio_step, GPIO.OUT)
+        gpio.setup(self.gpio_sleep, gpio.OUT)
+        gpio.setup(self.gpio_step, gpio.OUT)
 
-        GPIO.output(self.gpio_sleep, False)
-        GPIO.output(self.gpio_step, False)
+        gpio.output(self.gpio_sleep, False)
+        gpio.output(self.gpio_step, False)
 
     def __del__(self):
-        GPIO.cleanup()
+        self.gpio.cleanup()
 
-    def step(self, count):
-        GPIO.output(self.gpio_sleep, True)
-        delay(self.wake_up_time_s)
+    @property
+    def pulse_frequency(self):
+        return self.microsteps / self.step_period_s
+
+    def pulse_times(self, count, start=0, stop=None):
+        """
+        Rising edge times of `count` microstep pulses, in seconds from the start.
+        Only pulses [start, stop) are returned, to compute long runs in parts.
+
+        Speed is ramped linearly up to pulse_frequency during ramp_time,
+        and then down at the end.
+        """
+
+        frequency = self.pulse_frequency
+        ramp_time = self.ramp_time_s
+        ramp_pulses = frequency * ramp_time / 2
+
+        def time_at(x):
+            if ramp_time == 0:
+                return x / frequency
+            return np.where(x < ramp_pulses,
+                            np.sqrt(2 * x * ramp_time / frequency),
+                            ramp_time / 2 + x / frequency)
 
-        delay_s = 0.5 * self.step_period_s / self.microsteps
+        k = np.arange(start, count if stop is None else stop, dtype=np.float64)
+        middle = (count - 1) / 2
+        total = 2 * time_at(np.float64(middle))
 
-        for t in range(0, int(count * self.microsteps)):
-            GPIO.output(self.gpio_step, True)
-            delay(delay_s)
-            GPIO.output(self.gpio_step, False)
-            delay(delay_s)
+        # Deceleration mirrors acceleration
+        return np.where(k <= middle, time_at(k), total - time_at(count - 1 - k))
 
-        GPIO.output(self.gpio_sleep, False)
+    def pulse_width(self):
+        return 0.5 / self.pulse_frequency
+
+    def volume_to_pulses(self, volume):
+        return int(volume * self.steps_per_volume * self.microsteps)
+
+    def step(self, count):
+        StepPulseEngine(self.gpio).run([(self, int(count * self.microsteps))])
 
     def pump(self, volume):
-        self.step(volume * self.steps_per_volume)
+        return StepPulseEngine(self.gpio).run([(self, self.volume_to_pulses(volume))])
+
+
+class StepPulseEngine:
+    """
+    Drive STEP pins of several pumps from a single timing loop.
+
+    Edges of each pump are computed in chunks of `chunk_pulses`, merged
+    and played back against absolute deadlines, so pumps run concurrently.
+    If an edge is late by more than half a pulse period (e.g. the thread
+    was preempted), the rest of the schedule is shifted by the lateness:
+    the run is stretched instead of sending overdue pulses back-to-back,
+    which the motor could not follow.
+    """
+
+    chunk_pulses = 4096
+
+    def __init__(self, gpio, timer=None):
+        self.gpio = gpio
+        self.timer = timer if timer is not None else PrecisionTimer()
+
+    @classmethod
+    def pump_edges(cls, pump, count):
+        """(time, pin, level) edges of a pump, ordered by time."""
+
+        width = pump.pulse_width()
+        pin = pump.gpio_step
+        levels = [True, False] * cls.chunk_pulses
+        for start in range(0, count, cls.chunk_pulses):
+            rising = pump.pulse_times(count, start, min(start + cls.chunk_pulses, count))
+            # Pulse is shorter than the period, edges alternate
+            times = np.empty(2 * len(rising))
+            times[0::2] = rising
+            times[1::2] = rising + width
+            yield from zip(times.tolist(), [pin] * len(times), levels)
+
+    @classmethod
+    def schedule(cls, jobs):
+        """
+        Merge edges of (pump, pulses count) jobs.
+
+        Returns an iterator of (time, pin, level) edges, ordered by time.
+        """
+        return heapq.merge(*(cls.pump_edges(pump, count) for pump, count in jobs))
+
+    def run(self, jobs):
+        """
+        Pump (pump, pulses count) jobs concurrently.
+
+        Returns a report of requested versus achieved timing.
+        """
+
+        jobs = [(pump, count) for pump, count in jobs if count > 0]
+        if not jobs:
+            return None
+
+        gpio = self.gpio
+        timer = self.timer
+        max_lateness = min(pump.pulse_width() for pump, _ in jobs)
+
+        for pump, _ in jobs:
+            gpio.output(pump.gpio_sleep, True)
+        start = timer.now() + max(pump.wake_up_time_s for pump, _ in jobs)
+        first_start = start
+
+        edges = 0
+        t = 0
+        lateness_sum = 0
+        lateness_sq_sum = 0
+        lateness_max = 0
+        shifts = 0
+
+        try:
+            for t, pin, level in self.schedule(jobs):
+                deadline = start + t
+                timer.wait_until(deadline)
+                gpio.output(pin, level)
+                lateness = timer.now() - deadline
+                if lateness > max_lateness:
+                    start += lateness
+                    shifts += 1
+                edges += 1
+                lateness_sum += lateness
+                lateness_sq_sum += lateness * lateness
+                lateness_max = max(lateness_max, lateness)
+            end = timer.now()
+        finally:
+            for pump, _ in jobs:
+                gpio.output(pump.gpio_step, False)
+                gpio.output(pump.gpio_sleep, False)
+
+        return {
+            'edges': edges,
+            'requested_s': t,
+            'achieved_s': end - first_start,
+            'lateness_mean_s': lateness_sum / edges,
+            'lateness_rms_s': sqrt(lateness_sq_sum / edges),
+            'lateness_max_s': lateness_max,
+            'shifts': shifts
+        }
+
+    @staticmethod
+    def format_report(report):
+        return '{} edges in {:.3f} s (requested {:.3f} s), lateness mean {:.0f} us, rms {:.0f} us, max {:.0f} us, ' \
+               '{} shifts'.format(
+                   report['edges'], report['achieved_s'], report['requested_s'],
+                   report['lateness_mean_s'] * 1e6, report['lateness_rms_s'] * 1e6, report['lateness_max_s'] * 1e6,
+                   report['shifts'])
+
+
+def pump_concurrently(pumps, volumes):
+    """
+    Pump volumes with several pumps at the same time.
+
+    Pumps must share a GPIO backend.
+    """
+
+    engine = StepPulseEngine(pumps[0].gpio)
+    return engine.run([(p, p.volume_to_pulses(v)) for p, v in zip(pumps, volumes)])
 
 
 def main():
@@ -78,7 +229,9 @@ def main():
         return
 
     print('Pumping {} with {}'.format(volume, name))
-    pump.pump(volume)
+    report = pump.pump(volume)
+    if report:
+        print(StepPulseEngine.format_report(report))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,168 @@
+import time
+import threading
+import numpy as np
+from settings import UR
+from utils import log_info, log_warn, split_uncertainty
+
+
+class RingBuffer:
+    """
+    Last `capacity` timestamped samples, kept as float arrays.
+    Missing values are stored as NaN.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = np.full(capacity, np.nan)
+        self.values = np.full(capacity, np.nan)
+        self.count = 0
+
+    def append(self, timestamp, value):
+        n = self.count % self.capacity
+        self.times[n] = timestamp
+        self.values[n] = value
+        self.count += 1
+
+    def window(self, start, end=np.inf):
+        """Times and values of samples within [start, end), unordered."""
+        mask = (self.times >= start) & (self.times < end) & ~np.isnan(self.values)
+        return self.times[mask], self.values[mask]
+
+
+def aggregate(times, values):
+    """
+    Statistics of samples: count, mean, min, max and
+    slope (least squares, per hour).
+    """
+
+    count = len(values)
+    if count == 0:
+        return {'count': 0, 'mean': np.nan, 'min': np.nan, 'max': np.nan, 'slope': np.nan}
+
+    mean = values.mean()
+    slope = np.nan
+    if count > 1:
+        dt = times - times.mean()
+        ss = np.dot(dt, dt)
+        if ss > 0:
+            slope = np.dot(dt, values - mean) / ss * 3600
+
+    return {'count': count, 'mean': float(mean), 'min': float(values.min()),
+            'max': float(values.max()), 'slope': float(slope)}
+
+
+class Sampler:
+    """
+    Sample sensors in background every `interval` into ring buffers.
+
+    Samples are taken at fixed deadlines on the monotonic clock,
+    ticks missed by a slow read are skipped. pH is only sampled while
+    the solution tank is full, as the electrode may be dry otherwise.
+    Hold `busy` to keep the sampler off the CPU during timing critical
+    work, e.g. pumping.
+    """
+
+    # Channel name and units of stored values
+    channels = {
+        'ph': UR.pH,
+        'ph_temperature': UR.degC,
+        'supply_tank_volume': UR.L,
+        'temperature': UR.degC,
+        'solution_tank_is_full': None
+    }
+
+    def __init__(self, acquisition, interval, capacity):
+        self.acquisition = acquisition
+        self.interval = interval.m_as('s')
+        self.buffers = {name: RingBuffer(capacity) for name in self.channels}
+        self.latest = None
+        self.errors = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+        self.busy = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name='sampler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+        self.thread.join()
+
+    def _values(self, snapshot):
+        values = {}
+        errors = []
+
+        def read(name, get):
+            try:
+                value = get()
+                units = self.channels[name]
+                values[name] = float(value) if units is None else split_uncertainty(value, units)[0]
+            except Exception as e:
+                errors.append('%s: %s' % (name, e))
+
+        read('solution_tank_is_full', lambda: snapshot['solution_tank_is_full'])
+        if values.get('solution_tank_is_full'):
+            read('ph', lambda: snapshot.get_t_v_ph()[2])
+        read('ph_temperature', lambda: snapshot['ph_temperature'])
+        read('supply_tank_volume', lambda: snapshot['supply_tank_volume'])
+        if 'temperature' in snapshot:
+            read('temperature', lambda: snapshot['temperature'])
+
+        return values, errors
+
+    def sample(self):
+        """Read sensors once and store the values."""
+
+        with self.busy:
+            timestamp = time.monotonic()
+            snapshot = self.acquisition.read()
+            values, errors = self._values(snapshot)
+
+        with self.lock:
+            for name, buffer in self.buffers.items():
+                buffer.append(timestamp, values.get(name, np.nan))
+            self.latest = snapshot
+
+        if errors:
+            if self.errors == 0:
+                log_warn('Sampling failed: ' + ', '.join(errors))
+            self.errors += 1
+        elif self.errors > 0:
+            log_info('Sampling restored after %d errors' % self.errors)
+            self.errors = 0
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self.stopping:
+            self.sample()
+
+            deadline += self.interval
+            now = time.monotonic()
+            if deadline <= now:
+                missed = int((now - deadline) // self.interval) + 1
+                self.skipped += missed
+                deadline += missed * self.interval
+            self.wake.wait(deadline - now)
+
+    def aggregate(self, duration):
+        """
+        Statistics of each channel over the last `duration`,
+        in units of `channels`. See aggregate().
+        """
+
+        start = time.monotonic() - duration.m_as('s')
+        with self.lock:
+            return {name: aggregate(*b.window(start)) for name, b in self.buffers.items()}
+
+    @staticmethod
+    def format_aggregates(aggregates):
+        out = []
+        for name, a in aggregates.items():
+            if a['count'] > 0 and Sampler.channels[name] is not None:
+                out.append('{} {:.3g} [{:.3g}, {:.3g}] {:+.2g}/h'.format(
+                    name, a['mean'], a['min'], a['max'], a['slope']))
+        return ', '.join(out)
@@ -1,20 +1,32 @@
 #!/usr/bin/env python3
 
 import time
+import threading
 from datetime import datetime, timedelta
 from settings import UR
+from utils import log_warn
+from metrics import REGISTRY
 
 
-class Scheduler:
+job_jitter = REGISTRY.histogram('scheduler_jitter_seconds', 'Delay of job start after its tick', ['job'])
+job_duration = REGISTRY.histogram('scheduler_job_seconds', 'Job run duration', ['job'])
+job_skipped = REGISTRY.counter('scheduler_skipped_ticks_total', 'Ticks skipped after job overruns', ['job'])
+
+
+class Job:
     """
-    Execute job on schedule.
+    Job executed on a per-hour schedule.
 
-    Keeps per-hour schedule constant.
-    E.g. if job is set to run every 20 minutes, it will always be
-    executed at HH:00, HH:20 and HH:40.
+    If the job overruns past its next tick(s), `missed` policy applies:
+    - skip: missed ticks are skipped, job runs at the next aligned tick
+    - catch_up: job runs immediately once for each missed tick,
+      at most `max_catch_up` times, further ticks are skipped
     """
 
-    def __init__(self, period, job):
+    policies = ('skip', 'catch_up')
+    max_catch_up = 4
+
+    def __init__(self, name, period, func, missed='skip'):
         period_minutes = period.m_as('min')
         if not isinstance(period_minutes, int):
             raise Exception('Period must be an integer')
@@ -22,9 +34,30 @@ class Scheduler:
             raise Exception('Period must be greater than zero')
         if 60 % period_minutes != 0:
             raise Exception('Period must be a divider of 60')
+        if missed not in self.policies:
+            raise Exception('Unknown missed ticks policy "%s"' % missed)
 
+        self.name = name
         self.period_minutes = period_minutes
-        self.job = job
+        self.func = func
+        self.missed = missed
+        self.next_tick = None
+        self.jitter_metric = job_jitter.labels(name)
+        self.duration_metric = job_duration.labels(name)
+        self.skipped_metric = job_skipped.labels(name)
+
+        # Statistics, times are in seconds
+        self.runs = 0
+        self.jitter_sum = 0
+        self.jitter_max = 0
+        self.last_jitter = 0
+        self.last_duration = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.caught_up = 0
+
+        # Missed ticks still to run after an overrun
+        self.catch_up_pending = 0
 
     @staticmethod
     def round_int(value, base):
@@ -32,27 +65,133 @@ class Scheduler:
 
     def round_date(self, date):
         minute = self.round_int(date.minute, self.period_minutes)
-        return date.replace(minute=minute, second=0)
+        return date.replace(minute=minute, second=0, microsecond=0)
 
     def next_run(self, last_run):
         return self.round_date(last_run) + timedelta(minutes=self.period_minutes)
 
+    def run(self, now):
+        jitter = (now - self.next_tick).total_seconds()
+        self.runs += 1
+        self.last_jitter = jitter
+        self.jitter_sum += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+        self.jitter_metric.observe(jitter)
+
+        start = time.monotonic()
+        try:
+            self.func()
+        finally:
+            self.last_duration = time.monotonic() - start
+            self.duration_metric.observe(self.last_duration)
+            self._schedule_next()
+
+    def _schedule_next(self):
+        period = timedelta(minutes=self.period_minutes)
+        if self.catch_up_pending > 0:
+            # Catch-up runs are for ticks already past, they are not new overruns
+            self.catch_up_pending -= 1
+            self.caught_up += 1
+            if self.catch_up_pending > 0:
+                self.next_tick += period
+                return
+
+        tick = self.next_tick + period
+        now = datetime.utcnow()
+        if tick > now:
+            self.next_tick = tick
+            return
+
+        self.overruns += 1
+        missed = int((now - tick).total_seconds() // (60 * self.period_minutes)) + 1
+
+        if self.missed == 'catch_up':
+            self.catch_up_pending = min(missed, self.max_catch_up)
+            skipped = missed - self.catch_up_pending
+            # Run the oldest tick still to catch up now
+            self.next_tick = tick + period * skipped
+        else:
+            skipped = missed
+            self.next_tick = self.next_run(now)
+
+        self.skipped += skipped
+        self.skipped_metric.inc(skipped)
+        log_warn('Job %s overran by %.0f s, %d ticks skipped' % (
+            self.name, (now - tick).total_seconds(), skipped))
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'jitter_mean': self.jitter_sum / self.runs if self.runs else 0,
+            'jitter_max': self.jitter_max,
+            'last_jitter': self.last_jitter,
+            'last_duration': self.last_duration,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'caught_up': self.caught_up
+        }
+
+
+class Scheduler:
+    """
+    Execute jobs on schedule.
+
+    Keeps per-hour schedule constant.
+    E.g. if job is set to run every 20 minutes, it will always be
+    executed at HH:00, HH:20 and HH:40.
+
+    Scheduler sleeps until the next tick instead of polling.
+    The wait uses the monotonic clock, and is re-mapped to the wall
+    clock at least every `max_sleep` seconds in case the wall clock
+    was stepped (e.g. by NTP).
+    Jobs due at the same time are run in the order they were added.
+    """
+
+    max_sleep = 60
+
+    def __init__(self, period=None, job=None, missed='skip'):
+        self.jobs = []
+        self.stopping = False
+        self.wake = threading.Event()
+        if job is not None:
+            self.add_job('main', period, job, missed)
+
+    def add_job(self, name, period, func, missed='skip'):
+        job = Job(name, period, func, missed)
+        self.jobs.append(job)
+        return job
+
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+
+    def _sleep_until(self, date):
+        while not self.stopping:
+            remaining = (date - datetime.utcnow()).total_seconds()
+            if remaining <= 0:
+                return
+            self.wake.wait(min(remaining, self.max_sleep))
+
     def run(self):
-        next_run = self.next_run(datetime.utcnow())
-        while True:
-            now = datetime.utcnow()
-            if now > next_run:
-                next_run = self.next_run(now)
-                self.job()
-            time.sleep(1)
+        now = datetime.utcnow()
+        for job in self.jobs:
+            job.next_tick = job.next_run(now)
+
+        while not self.stopping:
+            job = min(self.jobs, key=lambda j: j.next_tick)
+            self._sleep_until(job.next_tick)
+            if self.stopping:
+                break
+            job.run(datetime.utcnow())
 
 
 def main():
-    s = Scheduler(3 * UR.min, None)
+    s = Scheduler()
+    job = s.add_job('test', 3 * UR.min, None)
 
     last_run = datetime.now()
     for n in range(1, 3600):
-        next_run = s.next_run(last_run)
+        next_run = job.next_run(last_run)
         print('%s %s' % (last_run.strftime('%H:%M:%S'), next_run.strftime('%H:%M:%S')))
         last_run += timedelta(seconds=1)
 
@@ -1,9 +1,14 @@
+import tempfile
+from os import path
 from pint import UnitRegistry
 from utils import config_file_path
 
 
-# Instantiate a common units registry
-UR = UnitRegistry(autoconvert_offset_to_baseunit=True)
+# Instantiate a common units registry.
+# Parsed definitions are cached to speed up the start-up,
+# cache is kept in tmpfs since root FS is read-only.
+UR = UnitRegistry(autoconvert_offset_to_baseunit=True,
+                  cache_folder=path.join(tempfile.gettempdir(), 'hydroctrl-pint'))
 UR.load_definitions(config_file_path('pint.txt'))
 
 
@@ -16,6 +21,29 @@ DATA_SPEC = (
     'nutrients_mL'
 )
 
+LOCAL_STORE_CONFIG = {
+    # Relative to the script directory, or absolute. Must be on a writable
+    # persistent FS, e.g. /var/lib/... if the root FS is read-only
+    'file_name': 'records.sqlite',
+    # Records to commit before WAL is synced to disk
+    'sync_every': 4
+}
+
+METRICS_CONFIG = {
+    # Prometheus scrapes http://host:port/metrics, bind to 0.0.0.0 to scrape from other hosts
+    'host': '127.0.0.1',
+    'port': 9108
+}
+
+TEMPERATURE_CONFIG = {
+    'bus_devices_path': '/sys/bus/w1/devices',
+    # Consumers within this time share a conversion
+    'max_age': 2 * UR.s,
+    # DS18B20 resolution, 9 to 12 bits (94 to 750 ms conversion), None to keep.
+    # Setting it and bulk conversion need root, otherwise devices convert one by one
+    'resolution': None
+}
+
 PH_CONFIG = {
     'temperature': {
         # 'value': 25 * UR.degC
@@ -26,10 +54,17 @@ PH_CONFIG = {
         'i2c_addr': 0x4F,
         'v_ref': 2.5 * UR.V,
         'v_off': 1.251 * UR.V,
-        'filter_samples': 256
+        'filter_samples': 256,
+        # Filter samples are spread over this time to reject mains hum,
+        # 100 ms is an integer number of periods at both 50 and 60 Hz
+        'sampling_time': 100 * UR.ms,
+        # One of adc.ADCFilter.estimators
+        'filter_estimator': 'mean'
     },
     'calibration': {
         'temperature': 24 * UR.degC,
+        # Two or more buffers, fitted by least squares. Voltages may have
+        # uncertainty, e.g. (1.426 * UR.V).plus_minus(0.002 * UR.V), to weight the fit
         'points': (
             {'ph': 4.0 * UR.pH, 'v': 1.426 * UR.V},
             {'ph': 7.0 * UR.pH, 'v': 1.250 * UR.V}
@@ -43,7 +78,11 @@ SUPPLY_TANK_CONFIG = {
         'i2c_addr': 0x48,
         'channel': 2,
         'fsr': 1024 * UR.mV,
-        'sps': 64
+        'sps': 64,
+        # ALERT/RDY pin, reads are paced by a timer 15% slower than sps if not connected
+        # 'gpio_rdy': 23,
+        # One of adc.ADCFilter.estimators
+        'filter_estimator': 'mean'
     },
     'calibration': {
         'pressure_offset': 26.5 * UR.cmH2O,
@@ -64,6 +103,7 @@ PUMP_X_CONFIG = {
     'gpio_step': 27,
     'wake_up_time': 1 * UR.ms,
     'max_frequency': 1 * UR.Hz,
+    'ramp_time': 0 * UR.s,
     'step_angle': 1.8 * UR.deg,
     'steps_per_volume': 1050 / UR.mL,
     'microsteps': 16
@@ -74,6 +114,7 @@ PUMP_Y_CONFIG = {
     'gpio_step': 6,
     'wake_up_time': 1 * UR.ms,
     'max_frequency': 1 * UR.Hz,
+    'ramp_time': 0 * UR.s,
     'step_angle': 1.8 * UR.deg,
     'steps_per_volume': 1050 / UR.mL,
     'microsteps': 16
@@ -89,5 +130,9 @@ CONTROLLER_CONFIG = {
     'desired_ph': 6.5 * UR.pH,
     'solution_volume': 60 * UR.L,
     'proportional_k': 0.5,
-    'iteration_period': 15 * UR.min
+    'iteration_period': 15 * UR.min,
+    # Sensors are sampled in background every sampling_interval
+    # and iterations use statistics over the period (e.g. 30 * UR.s).
+    # This changes the control input, None reads sensors at each iteration
+    'sampling_interval': None
 }
@@ -1,32 +1,101 @@
 #!/usr/bin/env python3
 
 import os
+import time
+import threading
 from os import path
-from settings import UR
+from concurrent.futures import ThreadPoolExecutor
+from settings import UR, TEMPERATURE_CONFIG
+from utils import log_warn
 
 
-class TemperatureInterface:
+class TemperatureService:
     """
-    DS18B20 interface.
+    DS18B20 readings shared by all consumers of a 1-Wire bus.
+
+    Conversion is started on all devices at once by the bus masters
+    (therm_bulk_read), so an update takes a single conversion time
+    regardless of the devices count. Results are read in parallel and
+    cached for `max_age`, consumers asking within that time share one
+    conversion. Bulk read needs write access to the bus master (root),
+    without it, or on older kernels, each device converts on its read.
+
+    Lower `resolution` (in bits) shortens the conversion, it needs
+    write access too. None leaves the devices configuration as is.
     """
 
-    bus_devices_path = '/sys/bus/w1/devices'
     family_code = 0x28
 
-    @classmethod
-    def discover_devices(cls):
-        prefix = '{:02x}-'.format(cls.family_code)
-        bus_devices = os.listdir(cls.bus_devices_path)
-        return [x for x in bus_devices if x.startswith(prefix)]
+    # Conversion time by resolution in bits, in seconds (see Datasheet)
+    conversion_times = {9: 0.094, 10: 0.188, 11: 0.375, 12: 0.75}
 
-    def __init__(self, device_id):
-        self.device_id = device_id
-        self.file_path = path.join('/sys/bus/w1/devices', device_id, 'w1_slave')
-        if not path.isfile(self.file_path):
-            raise Exception('File %s does not exist' % self.file_path)
+    # Service by bus devices path
+    services = {}
+    services_guard = threading.Lock()
 
-    def get_temperature(self):
-        lines = [line.strip() for line in open(self.file_path)]
+    def __init__(self, bus_devices_path='/sys/bus/w1/devices', max_age=2 * UR.s, resolution=None):
+        if resolution is not None and resolution not in self.conversion_times:
+            raise Exception('Unsupported resolution %s bits' % resolution)
+
+        self.bus_devices_path = bus_devices_path
+        self.max_age = max_age.m_as('s')
+        self.resolution = resolution
+        self.conversion_time = self.conversion_times[resolution or 12]
+        self.devices = []
+        self.readings = {}
+        self.conversions = 0
+        self.bulk_read = True
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='w1')
+
+    @classmethod
+    def shared(cls, bus_devices_path=None):
+        """Service of a bus, configured by TEMPERATURE_CONFIG on first use."""
+
+        bus_devices_path = bus_devices_path or TEMPERATURE_CONFIG['bus_devices_path']
+        with cls.services_guard:
+            if bus_devices_path not in cls.services:
+                cls.services[bus_devices_path] = cls(
+                    bus_devices_path,
+                    max_age=TEMPERATURE_CONFIG['max_age'],
+                    resolution=TEMPERATURE_CONFIG.get('resolution'))
+            return cls.services[bus_devices_path]
+
+    def discover_devices(self):
+        prefix = '{:02x}-'.format(self.family_code)
+        bus_devices = os.listdir(self.bus_devices_path)
+        return sorted(x for x in bus_devices if x.startswith(prefix))
+
+    def _bulk_read_paths(self):
+        if not self.bulk_read:
+            return []
+        paths = (path.join(self.bus_devices_path, x, 'therm_bulk_read')
+                 for x in os.listdir(self.bus_devices_path) if x.startswith('w1_bus_master'))
+        # Not writable by regular users, devices then convert on read
+        return [p for p in paths if os.access(p, os.W_OK)]
+
+    def add_device(self, device_id):
+        """Read the device on each update, sets its resolution if configured."""
+
+        file_path = path.join(self.bus_devices_path, device_id, 'w1_slave')
+        if not path.isfile(file_path):
+            raise Exception('File %s does not exist' % file_path)
+
+        with self.lock:
+            if device_id in self.devices:
+                return
+            if self.resolution is not None:
+                try:
+                    with open(path.join(self.bus_devices_path, device_id, 'resolution'), 'w') as f:
+                        f.write('%d\n' % self.resolution)
+                except OSError as e:
+                    log_warn('Cannot set resolution of %s, keeping the current one: %s' % (device_id, e))
+            self.devices.append(device_id)
+
+    def _read_device(self, device_id):
+        file_path = path.join(self.bus_devices_path, device_id, 'w1_slave')
+        with open(file_path) as f:
+            lines = [line.strip() for line in f]
         if len(lines) != 2:
             raise Exception('Invalid lines count')
 
@@ -34,9 +103,79 @@ class TemperatureInterface:
             raise Exception('CRC check failed')
 
         value = lines[1][lines[1].rindex('=') + 1:]
-        temp_C = int(value) / 1000.0
+        return int(value) / 1000.0
+
+    def _convert(self, bulk_read_paths):
+        """Returns False if conversion could not be triggered."""
+
+        try:
+            for p in bulk_read_paths:
+                with open(p, 'w') as f:
+                    f.write('trigger\n')
+        except OSError as e:
+            log_warn('Bulk temperature conversion failed, converting on read: %s' % e)
+            return False
+        time.sleep(self.conversion_time)
+
+        # Reads -1 while a conversion is in progress
+        deadline = time.monotonic() + self.conversion_time
+        for p in bulk_read_paths:
+            while time.monotonic() < deadline:
+                with open(p) as f:
+                    if f.read().strip() != '-1':
+                        break
+                time.sleep(0.01)
+        return True
+
+    def update(self):
+        """Convert and read all devices now."""
+        with self.lock:
+            self._update()
+
+    def _update(self):
+        bulk_read_paths = self._bulk_read_paths()
+        timestamp = time.monotonic()
+        if bulk_read_paths and not self._convert(bulk_read_paths):
+            self.bulk_read = False
+        self.conversions += 1
+
+        futures = [self.executor.submit(self._read_device, d) for d in self.devices]
+        for device_id, f in zip(self.devices, futures):
+            e = f.exception()
+            self.readings[device_id] = (timestamp, f.result() if e is None else e)
+
+    def get_temperature_C(self, device_id):
+        with self.lock:
+            reading = self.readings.get(device_id)
+            if reading is None or time.monotonic() - reading[0] > self.max_age:
+                self._update()
+                reading = self.readings[device_id]
+
+        if isinstance(reading[1], Exception):
+            raise reading[1]
+        return reading[1]
 
-        return temp_C * UR.degC
+
+class TemperatureInterface:
+    """
+    DS18B20 interface, see TemperatureService.
+    """
+
+    @classmethod
+    def discover_devices(cls):
+        """Devices of the configured bus, see TemperatureService.discover_devices."""
+        return TemperatureService.shared().discover_devices()
+
+    def __init__(self, device_id, service=None):
+        self.device_id = device_id
+        self.service = service or TemperatureService.shared()
+        self.service.add_device(device_id)
+
+        # Parsing units is expensive, keep them
+        self.unit_degC = UR.degC
+
+    def get_temperature(self):
+        return self.service.get_temperature_C(self.device_id) * self.unit_degC
 
 
 class ConstTemperatureInterface:
@@ -48,13 +187,15 @@ class ConstTemperatureInterface:
 
 
 def main():
-    devices = TemperatureInterface.discover_devices()
+    service = TemperatureService.shared()
+    devices = service.discover_devices()
     if len(devices) == 0:
         raise Exception('No devices found')
 
-    sensors = [TemperatureInterface(id) for id in devices]
+    sensors = [TemperatureInterface(id, service) for id in devices]
     while True:
         try:
+            service.update()
             for s in sensors:
                 temperature = s.get_temperature()
                 print('{} {}'.format(s.device_id, temperature))
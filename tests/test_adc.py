@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from adc import MCP3221, ADCFilter
+from settings import UR
+from fakes import FakeI2CBus
+
+
+def test_bulk_read_matches_single_reads():
+    single = MCP3221(i2c_busn=None, i2c_addr=0x4d, v_ref=2.5 * UR.V, i2c=FakeI2CBus())
+    bulk = MCP3221(i2c_busn=None, i2c_addr=0x4d, v_ref=2.5 * UR.V, i2c=FakeI2CBus())
+    expected = [single.get_value() for _ in range(300)]
+    assert bulk.get_values(300).tolist() == expected
+
+
+def test_sampling_time_spreads_bursts():
+    bus = FakeI2CBus()
+    adc = MCP3221(i2c_busn=None, i2c_addr=0x4d, v_ref=2.5 * UR.V, i2c=bus, sampling_time=20 * UR.ms)
+    adc.get_values(256)
+    start = adc.timer.now()
+    adc.get_values(256)
+    assert bus.transactions == 2 * adc.bursts
+    assert adc.timer.now() - start >= 0.02 * (adc.bursts - 1) / adc.bursts
+
+
+@pytest.mark.parametrize('estimator', ADCFilter.estimators)
+def test_estimators_report_sample_deviation(estimator):
+    bus = FakeI2CBus(level=2000, noise=20)
+    adc = MCP3221(i2c_busn=None, i2c_addr=0x4d, v_ref=2.5 * UR.V, i2c=bus)
+    adc_filter = ADCFilter(adc, 4096, estimator)
+    value, deviation = adc_filter.estimate(adc_filter._read_samples())
+    assert value == pytest.approx(2000, abs=2)
+    assert deviation == pytest.approx(20, rel=0.1)
+
+
+def test_trimmed_mean_rejects_spikes():
+    samples = np.random.default_rng(0).normal(1000, 5, 1000)
+    samples[::50] = 4095
+    value, deviation = ADCFilter(None, 0, 'trimmed_mean').estimate(samples)
+    assert value == pytest.approx(1000, abs=1)
+    assert deviation == pytest.approx(5, rel=0.15)
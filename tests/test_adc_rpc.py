@@ -0,0 +1,25 @@
+import pytest
+from adc import MCP3221
+from adc_rpc import ADCServer
+from settings import UR
+from fakes import FakeI2CBus
+
+
+@pytest.fixture(params=[None, 1000], ids=['on-demand', 'continuous'])
+def server(request):
+    adc = MCP3221(i2c_busn=None, i2c_addr=0x4d, v_ref=2.5 * UR.V, i2c=FakeI2CBus())
+    server = ADCServer(adc, host='127.0.0.1', port=0, stream_port=None, sampling_frequency_Hz=request.param)
+    yield server
+    server.close()
+
+
+def test_capture(server):
+    capture = server.get_capture_V(100, 5, with_times=True)
+    assert len(capture['samples_V']) == 5
+    assert capture['times_s'][0] == 0
+    assert capture['times_s'][-1] == pytest.approx(0.04, abs=0.01)
+
+
+def test_capture_of_no_samples_is_rejected(server):
+    with pytest.raises(Exception, match='At least one sample'):
+        server.get_capture_V(100, 0)
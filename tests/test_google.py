@@ -0,0 +1,55 @@
+import pytest
+from google import GoogleSheet, SheetsConnection
+from keepalive import KeepAliveConnection
+from local_store import timestamp_to_date
+from fakes import StaticCredentials, FakeHTTPServer, FakeSheetsServer
+
+
+def sample_records(count, start=1500000000):
+    return [{'date': timestamp_to_date(start + 900 * n), 'temperature_C': '25.0', 'pH': '6.00',
+             'supply_tank_L': '250', 'nutrients_mL': '0.0'} for n in range(count)]
+
+
+@pytest.fixture
+def sheets_server():
+    server = FakeSheetsServer()
+    yield server
+    server.close()
+
+
+def test_sheet_appends_in_one_request(sheets_server):
+    connection = SheetsConnection(credentials=StaticCredentials(), api_url=sheets_server.url)
+    sheet = GoogleSheet(connection=connection, sheet_id='test')
+    sheet.append_many(sample_records(10))
+    assert sheets_server.requests == 1
+    assert len(sheets_server.sheets['test']) == 10
+
+
+class EchoServer(FakeHTTPServer):
+    def handle(self, method, path, headers, body):
+        return 200, {'method': method}
+
+
+@pytest.mark.parametrize('method, attempts', [('GET', 2), ('POST', 1)])
+def test_sent_post_is_not_repeated(method, attempts):
+    server = EchoServer()
+    try:
+        connection = KeepAliveConnection(server.url)
+        assert connection.request(method, '/', {})[0] == 200
+
+        # The server handles the request, then the connection fails
+        server.requests = 0
+        original = connection.connection.getresponse
+
+        def failing_getresponse():
+            original().read()
+            raise ConnectionResetError()
+
+        connection.connection.getresponse = failing_getresponse
+        try:
+            connection.request(method, '/', {})
+        except OSError:
+            pass
+        assert server.requests == attempts
+    finally:
+        server.close()
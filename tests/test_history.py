@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import history
+from history import DataHistory
+
+
+@pytest.fixture
+def warnings(monkeypatch):
+    warnings = []
+    monkeypatch.setattr(history, 'log_warn', warnings.append)
+    return warnings
+
+
+def test_columns_and_window(warnings):
+    h = DataHistory()
+    h.extend([
+        ['date', 'temperature_C', 'pH', 'supply_tank_L', 'nutrients_mL'],
+        ['2020-01-01T10:00:00Z', '25.0', '6.00', '250', '0.0'],
+        ['2020-01-01T10:20:00Z', '25.5', 'n/a', '249'],
+        ['2020-01-01T10:40:00Z', '26.0', '6.10', '248', '1.5']
+    ])
+
+    assert len(h) == 3
+    assert h.column('date')[0] == 1577872800
+    assert np.isnan(h.column('pH')[1]) and np.isnan(h.column('nutrients_mL')[1])
+    window = h.window(start=1577872800 + 600, end=1577872800 + 2400)
+    assert window['temperature_C'].tolist() == [25.5]
+    assert not warnings
+
+
+def test_rows_with_bad_dates_are_skipped(warnings):
+    h = DataHistory()
+    h.extend([
+        ['2020-01-01T10:00:00Z', '25.0', '6.00', '250', '0.0'],
+        ['', '25.2', '6.05', '250', '0.0'],
+        ['yesterday', '25.4', '6.10', '250', '0.0'],
+        ['2020-01-01T10:40:00Z', '25.6', '6.15', '249', '0.0']
+    ])
+
+    assert h.column('date').tolist() == [1577872800, 1577875200]
+    assert h.column('pH').tolist() == pytest.approx([6.00, 6.15])
+    assert len(warnings) == 1 and 'yesterday' in warnings[0]
@@ -0,0 +1,116 @@
+import sqlite3
+import pytest
+from local_store import LocalStore, timestamp_to_date
+
+
+def record(ts, ph='6.00'):
+    return {'date': timestamp_to_date(ts), 'temperature_C': '25.0', 'pH': ph,
+            'supply_tank_L': '250', 'nutrients_mL': '0.0'}
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {'file_name': str(tmp_path / 'records.sqlite'), 'sync_every': 4}
+
+
+@pytest.fixture
+def store(config):
+    store = LocalStore(config)
+    yield store
+    store.close()
+
+
+def test_append_and_query(store):
+    records = [record(1500000000 + 900 * n) for n in range(5)]
+    for data in records:
+        store.append(data)
+
+    assert store.query() == records
+    assert store.query(start=1500000900, end=1500002700) == records[1:3]
+    assert store.last_timestamp() == 1500003600
+
+
+def test_same_second_and_clock_step_back(store):
+    store.register_consumer('sink')
+    records = [record(1500000900, '6.00'), record(1500000900, '6.10'), record(1500000000, '6.20')]
+    for data in records:
+        store.append(data)
+
+    # Replication follows append order, whatever the clock did
+    assert store.pending('sink') == records
+    assert store.query() == [records[2], records[0], records[1]]
+
+
+def test_consumer_starts_after_backlog(store):
+    store.append(record(1500000000))
+    store.register_consumer('sink')
+    assert store.pending_count('sink') == 0
+
+    store.append(record(1500000900))
+    assert store.pending('sink') == [record(1500000900)]
+
+
+def test_replicate_batch_acknowledges_sent_records(store):
+    store.register_consumer('sink')
+    records = [record(1500000000 + 900 * n) for n in range(5)]
+    for data in records:
+        store.append(data)
+
+    received = []
+
+    def append_many(batch):
+        received.extend(batch[:2])
+        return 2
+
+    assert not store.replicate_batch('sink', append_many, batch_size=3)
+    assert received == records[:2]
+    assert store.pending('sink') == records[2:]
+
+    assert store.replicate_batch('sink', lambda batch: received.extend(batch))
+    assert received == records
+    assert store.pending_count('sink') == 0
+
+
+def test_failed_append_keeps_records(store):
+    store.register_consumer('sink')
+    store.append(record(1500000000))
+
+    def append_many(batch):
+        raise Exception('offline')
+
+    with pytest.raises(Exception, match='offline'):
+        store.replicate_batch('sink', append_many)
+    assert store.pending_count('sink') == 1
+
+
+def test_reopen_keeps_records_and_cursors(config):
+    store = LocalStore(config)
+    store.register_consumer('sink')
+    for n in range(3):
+        store.append(record(1500000000 + 900 * n))
+    store.replicate_batch('sink', lambda batch: 1)
+    store.close()
+
+    store = LocalStore(config)
+    store.register_consumer('sink')
+    assert len(store.query()) == 3
+    assert store.pending('sink') == [record(1500000900), record(1500001800)]
+    store.close()
+
+
+def test_migrates_timestamp_keyed_store(config):
+    db = sqlite3.connect(config['file_name'])
+    db.execute('CREATE TABLE records (ts INTEGER PRIMARY KEY, temperature_C, pH, supply_tank_L, nutrients_mL)')
+    db.execute('CREATE TABLE cursors (name TEXT PRIMARY KEY, ts INTEGER NOT NULL)')
+    for n in range(3):
+        db.execute('INSERT INTO records VALUES (?, ?, ?, ?, ?)', (1500000000 + 900 * n, '25.0', '6.00', '250', '0.0'))
+    db.execute('INSERT INTO cursors VALUES (?, ?)', ('sink', 1500000900))
+    db.commit()
+    db.close()
+
+    store = LocalStore(config)
+    assert len(store.query()) == 3
+    assert store.pending('sink') == [record(1500001800)]
+    store.append(record(1500001800))
+    assert store.pending_count('sink') == 2
+    store.close()
@@ -0,0 +1,12 @@
+from metrics import Registry
+
+
+def test_extra_label_sets_are_merged():
+    registry = Registry()
+    errors = registry.counter('test_errors_total', 'Errors', ['message'])
+    for n in range(errors.max_label_sets + 10):
+        errors.labels('error %d' % n).inc()
+
+    assert len(errors.children) == errors.max_label_sets + 1
+    assert errors.labels(errors.overflow_value).value == 10
+    assert 'test_errors_total{message="other"} 10' in registry.expose().splitlines()
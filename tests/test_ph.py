@@ -0,0 +1,48 @@
+import pytest
+from ph import PHTheory, PHCalibration
+from settings import UR
+
+TEMP = 25 * UR.degC
+ADC_OFFSET = 1.251 * UR.V
+
+
+def buffer_v(ph, slope=0.98, offset_V=1.255):
+    """Electrode voltage in a buffer, for the given slope and offset."""
+    return offset_V - slope * PHTheory.ideal_slope_V_pH(TEMP.m_as(UR.degK)) * (ph - 7)
+
+
+def test_fit_of_several_points():
+    points = [{'ph': ph * UR.pH, 'v': buffer_v(ph) * UR.V} for ph in (4.01, 6.86, 7.0, 9.18, 10.01)]
+    calibration = PHCalibration(ADC_OFFSET, TEMP, points)
+
+    assert calibration.slope.m_as('') == pytest.approx(0.98)
+    assert calibration.offset.m_as('V') == pytest.approx(1.255)
+    assert calibration.residual.m_as('pH') == pytest.approx(0, abs=1e-9)
+    assert calibration.compute_ph(TEMP, buffer_v(5.5) * UR.V).m_as('pH') == pytest.approx(5.5)
+
+
+def test_points_with_uncertainty_are_weighted():
+    # The 7.0 buffer reads 3 mV off, with a large uncertainty
+    points = [{'ph': 4.0 * UR.pH, 'v': (buffer_v(4.0) * UR.V).plus_minus(0.0001 * UR.V)},
+              {'ph': 10.0 * UR.pH, 'v': (buffer_v(10.0) * UR.V).plus_minus(0.0001 * UR.V)},
+              {'ph': 7.0 * UR.pH, 'v': ((buffer_v(7.0) + 0.003) * UR.V).plus_minus(0.01 * UR.V)}]
+    weighted = PHCalibration(ADC_OFFSET, TEMP, points)
+    assert weighted.offset.m_as('V') == pytest.approx(1.255, abs=1e-4)
+
+    # Unless every point has uncertainty, points are weighted equally
+    points[0]['v'] = buffer_v(4.0) * UR.V
+    unweighted = PHCalibration(ADC_OFFSET, TEMP, points)
+    assert unweighted.offset.m_as('V') == pytest.approx(1.255 + 0.003 / 3, abs=1e-6)
+
+
+def test_bad_point_is_rejected():
+    points = [{'ph': ph * UR.pH, 'v': buffer_v(ph) * UR.V} for ph in (4.0, 7.0, 10.0)]
+    # Contaminated buffer, about 0.5 pH off
+    points.append({'ph': 9.0 * UR.pH, 'v': (buffer_v(9.0) + 0.03) * UR.V})
+    with pytest.raises(Exception, match='residual'):
+        PHCalibration(ADC_OFFSET, TEMP, points)
+
+
+def test_points_must_differ():
+    with pytest.raises(Exception, match='at least two|different'):
+        PHCalibration(ADC_OFFSET, TEMP, [{'ph': 7 * UR.pH, 'v': 1.255 * UR.V}] * 2)
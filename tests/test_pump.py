@@ -0,0 +1,57 @@
+import pytest
+from pump import PumpInterface, StepPulseEngine
+from settings import UR, PUMP_X_CONFIG, PUMP_Y_CONFIG
+from fakes import FakeGPIO
+
+
+@pytest.fixture
+def pumps():
+    gpio = FakeGPIO()
+    return (PumpInterface(dict(PUMP_X_CONFIG, ramp_time=0.2 * UR.s), gpio=gpio),
+            PumpInterface(dict(PUMP_Y_CONFIG, ramp_time=0 * UR.s), gpio=gpio))
+
+
+def test_schedule_is_merged_in_chunks(pumps, monkeypatch):
+    monkeypatch.setattr(StepPulseEngine, 'chunk_pulses', 7)
+    pump_x, pump_y = pumps
+    edges = list(StepPulseEngine.schedule([(pump_x, 100), (pump_y, 53)]))
+
+    assert len(edges) == 2 * (100 + 53)
+    assert [t for t, _, _ in edges] == sorted(t for t, _, _ in edges)
+    rising = [t for t, pin, level in edges if pin == pump_x.gpio_step and level]
+    assert rising == pytest.approx(pump_x.pulse_times(100).tolist())
+
+
+class StallingTimer:
+    """Timer of simulated time, the wait at `stall_edge` is late by `stall`."""
+
+    def __init__(self, stall_edge, stall):
+        self.time = 0
+        self.waits = 0
+        self.stall_edge = stall_edge
+        self.stall = stall
+        self.edge_times = []
+
+    def now(self):
+        return self.time
+
+    def wait_until(self, deadline):
+        self.time = max(self.time, deadline)
+        if self.waits == self.stall_edge:
+            self.time += self.stall
+        self.waits += 1
+        self.edge_times.append(self.time)
+
+
+def test_stall_shifts_the_schedule(pumps):
+    pump = pumps[1]
+    timer = StallingTimer(stall_edge=10, stall=0.01)
+    report = StepPulseEngine(pump.gpio, timer).run([(pump, 50)])
+
+    assert report['edges'] == 100
+    assert report['shifts'] == 1
+    assert report['achieved_s'] == pytest.approx(report['requested_s'] + 0.01)
+    # Edges after the stall keep their spacing instead of catching up
+    gaps = [b - a for a, b in zip(timer.edge_times[10:], timer.edge_times[11:])]
+    assert min(gaps) == pytest.approx(pump.pulse_width())
+    assert pump.gpio.edges[pump.gpio_step] == 100
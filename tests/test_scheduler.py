@@ -0,0 +1,97 @@
+import pytest
+from datetime import datetime, timedelta
+import scheduler
+from scheduler import Job
+from settings import UR
+
+
+class Clock:
+    """Wall clock of the scheduler, moved by the jobs."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def utcnow(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(datetime(2020, 1, 1, 10, 0))
+    monkeypatch.setattr(scheduler, 'datetime', clock)
+    return clock
+
+
+@pytest.fixture
+def warnings(monkeypatch):
+    warnings = []
+    monkeypatch.setattr(scheduler, 'log_warn', warnings.append)
+    return warnings
+
+
+def make_job(clock, missed, durations):
+    """20 minute job, its runs take `durations` in minutes."""
+
+    durations = iter(durations)
+
+    def func():
+        clock.now += timedelta(minutes=next(durations))
+
+    job = Job('test', 20 * UR.min, func, missed)
+    job.next_tick = clock.now
+    return job
+
+
+def run_due(job, clock, count):
+    ticks = []
+    for _ in range(count):
+        clock.now = max(clock.now, job.next_tick)
+        ticks.append(job.next_tick)
+        job.run(clock.now)
+    return ticks
+
+
+def test_jitter_stats(clock):
+    job = make_job(clock, 'skip', [1, 1])
+    job.run(clock.now + timedelta(seconds=0.5))
+    clock.now = job.next_tick
+    job.run(clock.now + timedelta(seconds=1.5))
+
+    stats = job.stats()
+    assert stats['runs'] == 2
+    assert stats['jitter_mean'] == pytest.approx(1.0)
+    assert stats['jitter_max'] == pytest.approx(1.5)
+    assert stats['last_jitter'] == pytest.approx(1.5)
+    assert stats['overruns'] == 0
+
+
+def test_skip_runs_at_next_aligned_tick(clock, warnings):
+    job = make_job(clock, 'skip', [47, 1])
+    ticks = run_due(job, clock, 2)
+
+    assert ticks[1] == datetime(2020, 1, 1, 11, 0)
+    stats = job.stats()
+    assert (stats['overruns'], stats['skipped'], stats['caught_up']) == (1, 2, 0)
+    assert len(warnings) == 1
+
+
+def test_catch_up_counts_overrun_once(clock, warnings):
+    job = make_job(clock, 'catch_up', [47, 0, 0, 1])
+    ticks = run_due(job, clock, 4)
+
+    assert ticks[1:] == [datetime(2020, 1, 1, 10, 20), datetime(2020, 1, 1, 10, 40), datetime(2020, 1, 1, 11, 0)]
+    stats = job.stats()
+    assert (stats['overruns'], stats['skipped'], stats['caught_up']) == (1, 0, 2)
+    assert len(warnings) == 1
+
+
+def test_catch_up_is_limited(clock, warnings):
+    job = make_job(clock, 'catch_up', [125] + [0] * 5)
+    ticks = run_due(job, clock, 6)
+
+    # Ticks 10:20 to 12:00 were missed, the oldest two are skipped
+    assert ticks[1] == datetime(2020, 1, 1, 11, 0)
+    assert ticks[5] == datetime(2020, 1, 1, 12, 20)
+    stats = job.stats()
+    assert (stats['overruns'], stats['skipped'], stats['caught_up']) == (1, 2, job.max_catch_up)
+    assert len(warnings) == 1
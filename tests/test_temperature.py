@@ -0,0 +1,36 @@
+import pytest
+from temperature import TemperatureService, TemperatureInterface
+from settings import UR, TEMPERATURE_CONFIG
+from fakes import FakeW1Tree
+
+
+def test_devices_share_one_conversion(tmp_path):
+    devices = {'28-000000000001': 21, '28-000000000002': 22}
+    tree = FakeW1Tree(str(tmp_path / 'w1'), dict(devices, **{'28-0000000000ff': 0}), crc_errors=('28-0000000000ff',))
+    service = TemperatureService(tree.root, resolution=9)
+    sensors = [TemperatureInterface(d, service) for d in devices]
+    bad = TemperatureInterface('28-0000000000ff', service)
+
+    assert [s.get_temperature().m_as('degC') for s in sensors] == [21, 22]
+    with pytest.raises(Exception, match='CRC check failed'):
+        bad.get_temperature()
+    assert service.conversions == 1
+    assert tree.resolution('28-000000000001') == 9
+
+
+def test_reads_without_bulk_conversion(tmp_path, monkeypatch):
+    tree = FakeW1Tree(str(tmp_path / 'w1'), {'28-000000000001': 21})
+    # As for regular users: bus master and resolution are not writable
+    monkeypatch.setattr('os.access', lambda path, mode: False)
+    service = TemperatureService(tree.root, max_age=0 * UR.s)
+    sensor = TemperatureInterface('28-000000000001', service)
+
+    tree.set_temperature('28-000000000001', 23.5)
+    assert sensor.get_temperature().m_as('degC') == 23.5
+
+
+def test_interface_discovers_devices(tmp_path, monkeypatch):
+    tree = FakeW1Tree(str(tmp_path / 'w1'), {'28-000000000002': 21, '28-000000000001': 22})
+    monkeypatch.setitem(TemperatureService.services, TEMPERATURE_CONFIG['bus_devices_path'],
+                        TemperatureService(tree.root))
+    assert TemperatureInterface.discover_devices() == ['28-000000000001', '28-000000000002']
@@ -0,0 +1,31 @@
+import time
+import pytest
+from thingspeak import Thingspeak
+from local_store import timestamp_to_date
+from fakes import FakeThingspeakServer
+
+
+def sample_records(count, start=1500000000):
+    return [{'date': timestamp_to_date(start + 900 * n), 'temperature_C': '25.0', 'pH': '6.00',
+             'supply_tank_L': '250', 'nutrients_mL': '0.0'} for n in range(count)]
+
+
+def test_reports_sent_points():
+    server = FakeThingspeakServer(update_interval=0.2)
+    try:
+        t = Thingspeak(key='key', channel_id='1', api_url=server.url)
+        t.update_interval = 0.2
+        records = sample_records(5)
+
+        assert t.append_many(records[:3]) == 3
+        # Within the update interval nothing is sent, the caller keeps the points
+        assert t.append_many(records[3:]) == 0
+        time.sleep(0.2)
+        server.fail_requests = 1
+        with pytest.raises(Exception):
+            t.append_many(records[3:])
+        time.sleep(0.2)
+        assert t.append_many(records[3:]) == 2
+        assert len(server.points) == 5
+    finally:
+        server.close()
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from ph import PHTheory, PHCalibration
+from water_tank import LinearInterpolation, PressureSensorCalibration
+from settings import UR, PH_CONFIG, SUPPLY_TANK_CONFIG
+
+
+def assert_same_measurement(reference, fast):
+    """Float fast paths match pint references, value and uncertainty."""
+    assert fast.value.magnitude == pytest.approx(reference.value.m_as(fast.units), rel=1e-9, abs=1e-9)
+    assert fast.error.magnitude == pytest.approx(reference.error.m_as(fast.units), rel=1e-9, abs=1e-9)
+
+
+@pytest.fixture
+def ph_calibration():
+    return PHCalibration(
+        adc_offset=PH_CONFIG['adc']['v_off'],
+        temp=PH_CONFIG['calibration']['temperature'],
+        points=PH_CONFIG['calibration']['points'])
+
+
+@pytest.mark.parametrize('temp', [22.5 * UR.degC, 295.65 * UR.K])
+def test_ph_matches_pint(ph_calibration, temp):
+    voltage = (1.3123 * UR.V).plus_minus(0.0021 * UR.V)
+    reference = PHTheory.compute_ph(temp, ph_calibration.offset, ph_calibration.slope, voltage)
+    assert_same_measurement(reference, ph_calibration.compute_ph(temp, voltage))
+
+
+def test_ph_array_matches_scalars(ph_calibration):
+    temp = 22.5 * UR.degC
+    voltages = np.linspace(1.1, 1.4, 7)
+    ph = ph_calibration.compute_ph(temp, voltages * UR.V)
+    expected = [ph_calibration.compute_ph(temp, v * UR.V).m_as('pH') for v in voltages]
+    assert ph.m_as('pH') == pytest.approx(expected, rel=1e-12)
+
+
+def test_pressure_matches_pint():
+    sensor = PressureSensorCalibration(SUPPLY_TANK_CONFIG['calibration']['pressure_offset'])
+    voltage = (0.3217 * UR.V).plus_minus(0.0004 * UR.V)
+    reference = voltage / sensor.sensitivity - sensor.pressure_offset
+    assert_same_measurement(reference, sensor.compute_pressure(voltage))
+
+
+def test_interpolation_matches_pint():
+    points = SUPPLY_TANK_CONFIG['calibration']['points']
+    interpolation = LinearInterpolation(
+        x=[p['pressure'] for p in points],
+        y=[p['volume'] for p in points])
+    pressure = (31.7 * UR.cmH2O).plus_minus(0.2 * UR.cmH2O)
+
+    x1, x2 = interpolation.x[0], interpolation.x[1]
+    y1, y2 = interpolation.y[0], interpolation.y[1]
+    y = y1 + (pressure - x1) / (x2 - x1) * (y2 - y1)
+    reference = UR.Measurement(y.magnitude.nominal_value, y.magnitude.std_dev, y.units)
+    assert_same_measurement(reference, interpolation(pressure))
+
+
+def test_interpolation_array_matches_numpy():
+    # Horizontal cylinder tank, 60 cm diameter, 1 m long: volume by water level
+    radius_cm = 30
+    levels_cm = np.linspace(0, 2 * radius_cm, 500)
+    angles = 2 * np.arccos(1 - levels_cm / radius_cm)
+    volumes_L = radius_cm ** 2 / 2 * (angles - np.sin(angles)) * 100 / 1000
+    interpolation = LinearInterpolation(
+        x=[v * UR.cmH2O for v in levels_cm],
+        y=[v * UR.L for v in volumes_L])
+
+    batch = np.random.default_rng(0).uniform(0, 2 * radius_cm, 1000)
+    y, _ = interpolation.interpolate(batch)
+    np.testing.assert_allclose(y, np.interp(batch, levels_cm, volumes_L), atol=1e-9)
+    assert [interpolation.interpolate(x)[0] for x in batch[:50]] == pytest.approx(y[:50], abs=1e-9)
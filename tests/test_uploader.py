@@ -0,0 +1,126 @@
+import time
+import pytest
+import uploader
+from uploader import Sink, Uploader
+from local_store import LocalStore, timestamp_to_date
+
+
+def record(ts):
+    return {'date': timestamp_to_date(ts), 'temperature_C': '25.0', 'pH': '6.00',
+            'supply_tank_L': '250', 'nutrients_mL': '0.0'}
+
+
+@pytest.fixture
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(uploader.random, 'uniform', lambda low, high: 1)
+
+
+def test_backoff_grows_exponentially(no_jitter):
+    sink = Sink('test', None)
+    delays = []
+    for _ in range(sink.failure_threshold - 1):
+        sink.failed(1000)
+        delays.append(sink.next_attempt - 1000)
+    assert delays == [5, 10, 20, 40]
+    assert sink.state == 'closed'
+
+
+def test_backoff_is_capped(no_jitter, monkeypatch):
+    monkeypatch.setattr(Sink, 'failure_threshold', 100)
+    sink = Sink('test', None)
+    for _ in range(10):
+        sink.failed(1000)
+    assert sink.next_attempt == 1000 + sink.backoff_max
+
+
+def test_backoff_jitter_bounds():
+    sink = Sink('test', None)
+    sink.failures = 2
+    for _ in range(100):
+        sink.failed(1000)
+        sink.failures = 2
+        assert 1000 + 10 <= sink.next_attempt <= 1000 + 30
+
+
+def test_circuit_opens_probes_and_closes(no_jitter):
+    sink = Sink('test', None)
+    for _ in range(sink.failure_threshold):
+        sink.failed(1000)
+    assert sink.state == 'open'
+    assert not sink.ready(1000 + sink.open_time - 1)
+    assert sink.ready(1000 + sink.open_time)
+
+    # A failed probe opens the circuit again
+    sink.probe()
+    assert sink.state == 'half-open'
+    sink.failed(3000)
+    assert sink.state == 'open'
+    assert sink.next_attempt == 3000 + sink.open_time
+
+    sink.probe()
+    sink.succeeded(5000, 3)
+    assert sink.state == 'closed'
+    assert sink.failures == 0
+    assert sink.ready(5000)
+    assert sink.sent_total == 3
+
+
+@pytest.fixture
+def store(tmp_path):
+    config = {'file_name': str(tmp_path / 'records.sqlite'), 'sync_every': 4}
+    store = LocalStore(config)
+    yield config, store
+    store.close()
+
+
+def test_failing_then_recovering_sink(store, no_jitter):
+    config, store = store
+    received = []
+    failures = [Exception('offline')] * 2
+
+    def append_many(batch):
+        if failures:
+            raise failures.pop()
+        received.extend(batch)
+
+    up = Uploader(config, {'sink': append_many})
+    store.register_consumer('sink')
+    records = [record(1500000000 + 900 * n) for n in range(3)]
+    for data in records:
+        store.append(data)
+
+    sink = up.sinks[0]
+    for failures_count in (1, 2):
+        up._upload(store, sink)
+        assert sink.failures == failures_count
+        assert store.pending_count('sink') == 3
+        assert not sink.ready(time.monotonic())
+
+    up._upload(store, sink)
+    assert received == records
+    assert store.pending_count('sink') == 0
+    assert up.stats()['sink']['state'] == 'closed'
+
+
+def test_partial_send_acknowledges_sent_records(store):
+    config, store = store
+    received = []
+
+    def append_many(batch):
+        received.extend(batch[:2])
+        return 2
+
+    up = Uploader(config, {'sink': append_many})
+    store.register_consumer('sink')
+    records = [record(1500000000 + 900 * n) for n in range(5)]
+    for data in records:
+        store.append(data)
+
+    sink = up.sinks[0]
+    start = time.monotonic()
+    up._upload(store, sink)
+    assert received == records[:2]
+    assert store.pending('sink') == records[2:]
+    assert sink.failures == 0
+    # The rest is sent after the throttle delay, not in a busy loop
+    assert sink.next_attempt >= start + up.throttle_delay
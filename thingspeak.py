@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 
-import urllib.request
+import time
 import urllib.parse
-import urllib.error
 from datetime import datetime
+from keepalive import KeepAliveConnection
 from utils import config_file_path
 import settings
 
@@ -11,47 +11,93 @@ import settings
 class Thingspeak:
     """
     Log data to the Thingspeak channel.
+
+    Points are uploaded with the bulk update API over a kept-alive
+    connection, in batches of up to `max_batch` points. Requests are
+    not sent more often than `update_interval` allows, points which
+    would exceed it are left to the caller to send later.
     """
 
-    def __init__(self):
-        with open(config_file_path('thingspeak_key.txt')) as f:
-            self.key = f.read().strip()
+    api_url = 'https://api.thingspeak.com'
 
-    def append(self, data):
+    # Minimal time between updates of a free account, in seconds
+    update_interval = 15
+
+    # Bulk update limit of a free account
+    max_batch = 960
+
+    def __init__(self, key=None, channel_id=None, api_url=None):
+        if key is None:
+            with open(config_file_path('thingspeak_key.txt')) as f:
+                key = f.read().strip()
+
+        if channel_id is None:
+            with open(config_file_path('thingspeak_channel_id.txt')) as f:
+                channel_id = f.read().strip()
+
+        self.key = key
+        self.path = '/channels/{}/bulk_update.json'.format(urllib.parse.quote(channel_id))
+        self.connection = KeepAliveConnection(api_url or self.api_url)
+        self.last_update = None
+
+    @staticmethod
+    def _to_point(data):
         if len(data) != len(settings.DATA_SPEC):
             raise Exception('Invalid data fields count')
 
-        values = {
-            'api_key': self.key,
-            'created_at': data['date']
-        }
+        point = {'created_at': data['date']}
 
         count = 1
         for k in settings.DATA_SPEC:
             if k != 'date':
-                values['field' + str(count)] = data[k]
+                point['field' + str(count)] = data[k]
                 count += 1
 
-        url = 'https://api.thingspeak.com/update'
-        postdata = urllib.parse.urlencode(values).encode('ascii')
-        req = urllib.request.Request(url, postdata)
+        return point
+
+    def append_many(self, data_list):
+        """
+        Upload points, in order. Returns the number of points sent,
+        the rest was rate limited. Raises if an update failed before
+        any point was sent.
+        """
 
-        try:
-            response = urllib.request.urlopen(req)
-            response_data = response.read()
-            response.close()
-            if response_data == b'0':
-                raise Exception('Update failed')
-        except urllib.error.HTTPError as e:
-            raise Exception('Server could not fulfill the request: ' + str(e.code))
-        except urllib.error.URLError as e:
-            raise Exception('Failed to reach server: ' + str(e.reason))
+        points = [self._to_point(data) for data in data_list]
+
+        sent = 0
+        while sent < len(points):
+            now = time.monotonic()
+            if self.last_update is not None and now - self.last_update < self.update_interval:
+                break
+
+            batch = points[sent:sent + self.max_batch]
+            body = {'write_api_key': self.key, 'updates': batch}
+
+            try:
+                status, data = self.connection.request('POST', self.path, body)
+                # Counted from the response, the server may have received it late
+                self.last_update = time.monotonic()
+                if status not in (200, 202):
+                    raise Exception('Thingspeak update failed with status {}: {}'.format(status, data[:200]))
+            except Exception:
+                if sent == 0:
+                    raise
+                # Report what was sent, the error recurs on the next call
+                break
+
+            sent += len(batch)
+
+        return sent
+
+    def append(self, data):
+        return self.append_many([data])
 
 
 def main():
     t = Thingspeak()
     date = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
-    t.append({'date': date, 'temperature_C': 25, 'pH': 6.0, 'supply_tank_L': 250, 'nutrients_mL': 0})
+    if t.append({'date': date, 'temperature_C': 25, 'pH': 6.0, 'supply_tank_L': 250, 'nutrients_mL': 0}) == 0:
+        raise Exception('Update was rate limited')
 
 
 if __name__ == '__main__':
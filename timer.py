@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import os
+import time
+from math import sqrt
+from contextlib import contextmanager
+
+
+class PrecisionTimer:
+    """
+    Wait for absolute deadlines without keeping CPU busy.
+
+    The timer sleeps until `spin_margin` before the deadline and
+    spins for the rest of the wait. On Linux, time.sleep is implemented
+    with clock_nanosleep on the monotonic clock.
+
+    Waits are given absolute deadlines, so a late wake-up is not
+    carried over to the following waits.
+
+    The margin is calibrated at the first wait from the observed
+    sleep overshoot, and grows (up to a limit) if a sleep wakes up
+    past the deadline.
+    """
+
+    # Sleep duration used for calibration
+    calibration_sleep = 0.0005
+    calibration_count = 20
+
+    # Safety factor applied to the worst observed sleep overshoot
+    margin_factor = 1.5
+
+    # Longer overshoots are caused by preemption, spinning would not help
+    max_spin_margin = 0.001
+
+    def __init__(self, spin_margin=None):
+        self.spin_margin = spin_margin
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.count = 0
+        self.overshoot_sum = 0
+        self.overshoot_sq_sum = 0
+        self.overshoot_max = 0
+        self.late_wakeups = 0
+
+    def calibrate(self):
+        worst = 0
+        for _ in range(0, self.calibration_count):
+            start = time.monotonic()
+            time.sleep(self.calibration_sleep)
+            worst = max(worst, time.monotonic() - start - self.calibration_sleep)
+        self.spin_margin = min(worst * self.margin_factor, self.max_spin_margin)
+
+    @staticmethod
+    def now():
+        return time.monotonic()
+
+    def wait_until(self, deadline):
+        """Return at `deadline`, a time.monotonic() value."""
+
+        if self.spin_margin is None:
+            self.calibrate()
+
+        remaining = deadline - time.monotonic()
+        if remaining > self.spin_margin:
+            time.sleep(remaining - self.spin_margin)
+            now = time.monotonic()
+            if now > deadline:
+                # Sleep overshoot exceeded the margin
+                self.late_wakeups += 1
+                self.spin_margin = min((now - deadline + self.spin_margin) * self.margin_factor,
+                                       self.max_spin_margin)
+        else:
+            now = time.monotonic()
+
+        while now < deadline:
+            now = time.monotonic()
+
+        overshoot = now - deadline
+        self.count += 1
+        self.overshoot_sum += overshoot
+        self.overshoot_sq_sum += overshoot * overshoot
+        self.overshoot_max = max(self.overshoot_max, overshoot)
+
+    def delay(self, secs):
+        self.wait_until(time.monotonic() + secs)
+
+    def stats(self):
+        """Overshoot statistics in seconds: mean, RMS and maximum."""
+
+        if self.count == 0:
+            return {'count': 0, 'mean': 0, 'rms': 0, 'max': 0, 'late_wakeups': 0}
+
+        return {
+            'count': self.count,
+            'mean': self.overshoot_sum / self.count,
+            'rms': sqrt(self.overshoot_sq_sum / self.count),
+            'max': self.overshoot_max,
+            'late_wakeups': self.late_wakeups
+        }
+
+    def format_stats(self):
+        s = self.stats()
+        return '{} waits, overshoot mean {:.1f} us, rms {:.1f} us, max {:.1f} us, {} late wake-ups'.format(
+            s['count'], s['mean'] * 1e6, s['rms'] * 1e6, s['max'] * 1e6, s['late_wakeups'])
+
+
+@contextmanager
+def realtime(cpu=None, priority=50):
+    """
+    Run the calling thread with SCHED_FIFO scheduling, pinned to `cpu`
+    if set, restoring the previous settings on exit.
+
+    Spinning at real time priority starves other tasks on that core,
+    so pin to a core that is not needed otherwise. Requires root or
+    CAP_SYS_NICE, without them the thread keeps normal scheduling.
+    Yields True if real time scheduling is enabled.
+    """
+
+    affinity = os.sched_getaffinity(0)
+    policy = os.sched_getscheduler(0)
+    param = os.sched_getparam(0)
+
+    try:
+        if cpu is not None:
+            os.sched_setaffinity(0, {cpu})
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        enabled = True
+    except PermissionError:
+        enabled = False
+
+    try:
+        yield enabled
+    finally:
+        if enabled:
+            os.sched_setscheduler(0, policy, param)
+        if cpu is not None:
+            os.sched_setaffinity(0, affinity)
+
+
+def main():
+    timer = PrecisionTimer()
+    for period in (0.0001, 0.001, 0.01):
+        timer.reset_stats()
+        deadline = timer.now()
+        start_cpu = time.process_time()
+        for _ in range(0, int(0.5 / period)):
+            deadline += period
+            timer.wait_until(deadline)
+        cpu = time.process_time() - start_cpu
+        print('period {:.1f} ms, margin {:.0f} us, CPU load {:.0f}%: {}'.format(
+            period * 1e3, timer.spin_margin * 1e6, 100 * cpu / 0.5, timer.format_stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import time
+import random
+import threading
+from collections import deque
+from local_store import LocalStore
+from utils import log_info, log_warn, log_exception_trace
+from metrics import REGISTRY
+
+
+upload_seconds = REGISTRY.histogram('upload_seconds', 'Upload attempt duration', ['sink'])
+upload_failures = REGISTRY.counter('upload_failures_total', 'Failed upload attempts', ['sink'])
+upload_records = REGISTRY.counter('upload_records_total', 'Records uploaded', ['sink'])
+
+
+class Sink:
+    """
+    Upload state of a remote database.
+
+    Failed uploads are retried with exponential backoff and jitter.
+    After `failure_threshold` consecutive failures the circuit opens:
+    no attempts are made for `open_time`, then a single probe is let
+    through (half-open state), which closes the circuit on success.
+    """
+
+    backoff_base = 5
+    backoff_max = 300
+    failure_threshold = 5
+    open_time = 1800
+
+    # Window to compute the drain rate over, in seconds
+    rate_window = 3600
+
+    def __init__(self, name, append_many):
+        self.name = name
+        self.append_many = append_many
+        self.state = 'closed'
+        self.failures = 0
+        self.next_attempt = 0
+        self.sent_total = 0
+        self.sent_log = deque()
+
+    def ready(self, now):
+        return now >= self.next_attempt
+
+    def succeeded(self, now, count):
+        if self.state != 'closed':
+            log_info('Upload to %s restored' % self.name)
+        self.state = 'closed'
+        self.failures = 0
+        self.next_attempt = now
+
+        if count > 0:
+            self.sent_total += count
+            self.sent_log.append((now, count))
+        while self.sent_log and self.sent_log[0][0] < now - self.rate_window:
+            self.sent_log.popleft()
+
+    def failed(self, now):
+        self.failures += 1
+
+        if self.state == 'half-open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                log_warn('Upload to %s suspended for %d s' % (self.name, self.open_time))
+            self.state = 'open'
+            self.next_attempt = now + self.open_time
+            return
+
+        backoff = min(self.backoff_base * 2 ** (self.failures - 1), self.backoff_max)
+        self.next_attempt = now + backoff * random.uniform(0.5, 1.5)
+
+    def probe(self):
+        if self.state == 'open':
+            self.state = 'half-open'
+
+    def drain_rate(self, now):
+        """Records sent per hour over the last `rate_window`."""
+        sent = sum(count for t, count in self.sent_log if t >= now - self.rate_window)
+        return sent * 3600 / self.rate_window
+
+
+class Uploader:
+    """
+    Replicate the local store to remote databases on a background thread.
+
+    The outbox of each remote database is its backlog in the local store,
+    so it survives restarts. Records are read in batches of `batch_size`,
+    which bounds the memory used. The control loop only has to commit
+    records to the store and call notify().
+    """
+
+    batch_size = 500
+
+    # Delay before sending the rest to a sink which took only part of the
+    # records (e.g. Thingspeak rate limit), in seconds
+    throttle_delay = 15
+
+    def __init__(self, local_store_config, sinks):
+        self.local_store_config = local_store_config
+        self.sinks = [Sink(name, append_many) for name, append_many in sinks.items()]
+        self.wake = threading.Event()
+        self.stopping = False
+        self.pending = {s.name: 0 for s in self.sinks}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name='uploader', daemon=True)
+
+    def start(self):
+        # Register before records are committed, for them not to be skipped
+        store = LocalStore(self.local_store_config)
+        for sink in self.sinks:
+            store.register_consumer(sink.name)
+        store.close()
+
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+        self.thread.join()
+
+    def notify(self):
+        """Signal that new records were committed to the store."""
+        self.wake.set()
+
+    def _upload(self, store, sink):
+        now = time.monotonic()
+        sink.probe()
+
+        sent = 0
+
+        def append_many(batch):
+            nonlocal sent
+            count = sink.append_many(batch)
+            count = len(batch) if count is None else count
+            sent += count
+            return count
+
+        try:
+            complete = store.replicate_batch(sink.name, append_many, batch_size=self.batch_size)
+        except Exception as e:
+            log_warn('Upload to %s failed: %s' % (sink.name, e))
+            log_exception_trace()
+            sink.failed(time.monotonic())
+            upload_failures.labels(sink.name).inc()
+        else:
+            sink.succeeded(now, sent)
+            if not complete:
+                sink.next_attempt = now + self.throttle_delay
+        upload_seconds.labels(sink.name).observe(time.monotonic() - now)
+        upload_records.labels(sink.name).inc(sent)
+
+        with self.lock:
+            self.pending[sink.name] = store.pending_count(sink.name)
+
+    def _run(self):
+        # SQLite connections can't be shared between threads
+        store = LocalStore(self.local_store_config)
+
+        while not self.stopping:
+            self.wake.clear()
+            for sink in self.sinks:
+                if sink.ready(time.monotonic()):
+                    self._upload(store, sink)
+
+            # Sleep until a retry is due or new records arrive
+            now = time.monotonic()
+            with self.lock:
+                retries = [max(s.next_attempt - now, 0) for s in self.sinks if self.pending[s.name] > 0]
+            self.wake.wait(min(retries) if retries else None)
+
+        store.close()
+
+    def stats(self):
+        """Upload state by sink name: circuit state, pending records and drain rate."""
+
+        now = time.monotonic()
+        with self.lock:
+            pending = dict(self.pending)
+
+        return {s.name: {
+            'state': s.state,
+            'pending': pending[s.name],
+            'failures': s.failures,
+            'sent_total': s.sent_total,
+            'drain_rate_per_hour': s.drain_rate(now)
+        } for s in self.sinks}
+
+    def format_stats(self):
+        return ', '.join('{} {} pending {} ({:.0f}/h)'.format(
+            name, s['state'], s['pending'], s['drain_rate_per_hour']) for name, s in self.stats().items())
@@ -61,25 +61,6 @@ def wait_for_ntp():
     log_info('NTP status OK')
 
 
-def retry(job, error_msg, attempts=3, delay=5, rethrow=True):
-    while True:
-        try:
-            return job()
-        except Exception:
-            attempts -= 1
-
-            log_info('%s, %d attempts left' % (error_msg, attempts))
-            log_exception_trace()
-
-            if attempts == 0:
-                break
-            else:
-                time.sleep(delay)
-
-    if rethrow:
-        raise Exception(error_msg)
-
-
 def config_file_path(file_name):
     script_dir = path.dirname(path.abspath(__file__))
     return path.join(script_dir, file_name)
@@ -89,17 +70,19 @@ def in_range(value, range):
     return min(range) <= value <= max(range)
 
 
-def delay(secs):
+def split_uncertainty(x, units):
     """
-    This is more precise than time.sleep at the expense of
-    keeping CPU busy.
+    Magnitude of a Quantity or Measurement in given units (a Unit object),
+    returned as (nominal value, standard deviation).
+    Standard deviation is None for a Quantity.
     """
 
-    start = time.monotonic()
-    while secs > 0:
-        end = time.monotonic()
-        secs -= end - start
-        start = end
+    if x.units != units:
+        x = x.to(units)
+    m = x.magnitude
+    if hasattr(m, 'nominal_value'):
+        return m.nominal_value, m.std_dev
+    return m, None
 
 
 def drop_uncertainty(*iterables):
@@ -1,43 +1,108 @@
 #!/usr/bin/env python3
 
+from bisect import bisect_right
+import numpy as np
 from adc import ADS1115, ADCFilter
 from settings import UR, SUPPLY_TANK_CONFIG
+from utils import split_uncertainty
 
 
 class LinearInterpolation:
     """
-    Interpolate a 1-D function.
+    Interpolate a 1-D function piecewise linearly.
 
-    `x` and `y` are arrays of values used to approximate some function f: ``y = f(x)``.
+    `x` and `y` are arrays of quantities used to approximate some function f: ``y = f(x)``.
+    Points are converted to floats (in units of the first point) once,
+    sorted by `x`, and segment slopes are precomputed, so a lookup is
+    a binary search and does not involve pint arithmetic.
+
+    Outside of the points range `extrapolate` policy applies:
+    - linear: extend the first and the last segment
+    - clip: hold the first and the last `y`
+    - error: raise an exception
     """
 
-    def __init__(self, x, y):
+    policies = ('linear', 'clip', 'error')
+
+    def __init__(self, x, y, extrapolate='linear'):
         if len(x) != len(y):
             raise Exception('Arrays must have the same number of elements')
         if len(x) < 2:
             raise Exception('At least two points are required')
+        if extrapolate not in self.policies:
+            raise Exception('Unknown extrapolation policy "%s"' % extrapolate)
         self.x = x
         self.y = y
+        self.extrapolate = extrapolate
+        self.x_units = x[0].units
+        self.y_units = y[0].units
+
+        points = sorted(zip((float(v.m_as(self.x_units)) for v in x), (float(v.m_as(self.y_units)) for v in y)))
+        self.x_values = [p[0] for p in points]
+        self.y_values = [p[1] for p in points]
+        if any(x2 <= x1 for x1, x2 in zip(self.x_values, self.x_values[1:])):
+            raise Exception('Points must have distinct x values')
+        self.slopes = [(y2 - y1) / (x2 - x1) for x1, x2, y1, y2 in zip(
+            self.x_values, self.x_values[1:], self.y_values, self.y_values[1:])]
+
+        # Same as arrays, for array input
+        self.x_array = np.array(self.x_values)
+        self.y_array = np.array(self.y_values)
+        self.slope_array = np.array(self.slopes)
+
+    def _interpolate_scalar(self, x):
+        x_values = self.x_values
+        if not x_values[0] <= x <= x_values[-1]:
+            if self.extrapolate == 'error':
+                raise Exception('%g %s is out of interpolation range' % (x, self.x_units))
+            if self.extrapolate == 'clip':
+                return (self.y_values[0] if x < x_values[0] else self.y_values[-1]), 0.0
+
+        i = bisect_right(x_values, x) - 1
+        i = min(max(i, 0), len(self.slopes) - 1)
+        slope = self.slopes[i]
+        return self.y_values[i] + (x - x_values[i]) * slope, slope
+
+    def _interpolate_array(self, x):
+        x_array = self.x_array
+        below = x < x_array[0]
+        above = x > x_array[-1]
+        if self.extrapolate == 'error' and (below.any() or above.any()):
+            raise Exception('Values are out of interpolation range')
+
+        i = np.searchsorted(x_array, x, side='right') - 1
+        np.clip(i, 0, len(self.slope_array) - 1, out=i)
+        slope = self.slope_array[i]
+        y = self.y_array[i] + (x - x_array[i]) * slope
+
+        if self.extrapolate == 'clip':
+            y[below] = self.y_array[0]
+            y[above] = self.y_array[-1]
+            slope[below | above] = 0
+        return y, slope
+
+    def interpolate(self, x, x_dev=None):
+        """
+        Interpolate floats or arrays in units of the points.
+        Returns (y, y standard deviation), deviation is None if `x_dev` is.
+        """
+
+        if np.ndim(x) == 0:
+            y, slope = self._interpolate_scalar(float(x))
+        else:
+            y, slope = self._interpolate_array(np.asarray(x, dtype=float))
+
+        if x_dev is None:
+            return y, None
+        return y, np.abs(slope) * x_dev if np.ndim(slope) else abs(slope) * x_dev
 
     def __call__(self, x_new):
-        distances = [abs(v - x_new) for v in self.x]
-        indexes = list(range(len(distances)))
-        indexes.sort(key=distances.__getitem__)
-        i1 = indexes[0]
-        i2 = indexes[1]
-
-        x1 = self.x[i1]
-        x2 = self.x[i2]
-        y1 = self.y[i1]
-        y2 = self.y[i2]
-
-        y_new = y1 + (x_new - x1) / (x2 - x1) * (y2 - y1)
+        x_new, x_new_dev = split_uncertainty(x_new, self.x_units)
+        y_new, y_new_dev = self.interpolate(x_new, x_new_dev)
 
-        # Pint forgets to convert Quantity with uncertainty into Measurement
-        if type(y_new) == UR.Quantity:
-            y_new = UR.Measurement(y_new.magnitude.nominal_value, y_new.magnitude.std_dev, y_new.units)
-
-        return y_new
+        if y_new_dev is None:
+            return y_new * self.y_units
+        return UR.Measurement(y_new, y_new_dev, self.y_units)
 
 
 class PressureSensorCalibration:
@@ -50,9 +115,21 @@ class PressureSensorCalibration:
 
     def __init__(self, pressure_offset):
         self.pressure_offset = pressure_offset
+        self.sensitivity_V_kPa = self.sensitivity.m_as('V / kPa')
+        self.pressure_offset_kPa = pressure_offset.m_as('kPa')
+
+        # Parsing units is expensive, keep them
+        self.unit_V = UR.V
+        self.unit_kPa = UR.kPa
 
     def compute_pressure(self, voltage):
-        return voltage / self.sensitivity - self.pressure_offset
+        v_V, v_dev_V = split_uncertainty(voltage, self.unit_V)
+
+        pressure_kPa = v_V / self.sensitivity_V_kPa - self.pressure_offset_kPa
+
+        if v_dev_V is None:
+            return pressure_kPa * self.unit_kPa
+        return UR.Measurement(pressure_kPa, v_dev_V / self.sensitivity_V_kPa, self.unit_kPa)
 
 
 class PressureSensorInterface:
@@ -60,21 +137,24 @@ class PressureSensorInterface:
     Complete MP3V5050DP pressure sensor interface with calibration.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, i2c=None):
         adc_sps = config['adc']['sps']
 
         adc = ADS1115(
             i2c_busn=config['adc']['i2c_busn'],
-            i2c_addr=config['adc']['i2c_addr'])
+            i2c_addr=config['adc']['i2c_addr'],
+            i2c=i2c)
 
         adc.config(
             channel=config['adc']['channel'],
             fsr=config['adc']['fsr'],
-            sps=adc_sps)
+            sps=adc_sps,
+            gpio_rdy=config['adc'].get('gpio_rdy'))
 
         self.adc = ADCFilter(
             adc=adc,
-            samples_count=adc_sps)
+            samples_count=adc_sps,
+            estimator=config['adc']['filter_estimator'])
 
         self.calibration = PressureSensorCalibration(
             pressure_offset=config['calibration']['pressure_offset'])
@@ -93,13 +173,13 @@ class WaterTankInterface:
     Complete water tank interface with calibration.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, i2c=None):
         points = config['calibration']['points']
         self.calibration = LinearInterpolation(
             x=[p['pressure'] for p in points],
             y=[p['volume'] for p in points])
 
-        self.sensor = PressureSensorInterface(config)
+        self.sensor = PressureSensorInterface(config, i2c)
 
     def get_volume_and_pressure_and_voltage(self):
         pressure, voltage = self.sensor.get_pressure_and_voltage()